@@ -1,10 +1,7 @@
-import logging
+from time import perf_counter
 
-from mesa import Agent
 import numpy
 
-logger = logging.getLogger('medical_diagnosis')
-
 
 def dot(x, y):
     """
@@ -32,6 +29,47 @@ def transform_convincing_value(array, inv=False):
         return numpy.multiply(array, 2) - 1
 
 
+def influence_colleagues(belief_matrix, speaker_idx, influence, stubbornness, alpha=0.25, colleagues=None):
+    """
+    Applies the influence of one speaker to all of its colleagues at once. The belief arrays of the whole committee
+    are kept as the rows of ``belief_matrix``, which is updated in place. The rule is the same one described in
+    :func:`default_case_influencing`, but evaluated as a single masked and clipped array operation instead of looping
+    over every colleague and every argument.
+
+    With ``colleagues`` only those rows are gathered, updated and scattered back, so the cost is proportional to the
+    number of neighbours of the speaker in the influence graph instead of the size of the committee.
+
+    Args:
+        belief_matrix (numpy.ndarray): (n_doctors, n_args) matrix holding the belief array of every doctor
+        speaker_idx (int): Row of the doctor that speaks
+        influence (float): How good the speaker is at convincing people
+        stubbornness (numpy.ndarray): Stubbornness of every doctor in the committee, indexed like the rows of
+            ``belief_matrix``
+        alpha (float): Constant parameter to better simulate a real speed for convincing other people
+        colleagues (numpy.ndarray): Rows of the doctors the speaker can influence, not including the speaker. By
+            default, everyone else in the committee
+
+    Returns:
+        The change in the committee's sum of convincing values, so that it can be patched instead of recomputed
+    """
+    others = numpy.arange(len(belief_matrix)) != speaker_idx if colleagues is None else colleagues
+    agent_conv_array = transform_convincing_value(belief_matrix[speaker_idx])  # A'
+    colleague_conv_array = transform_convincing_value(belief_matrix[others])  # B'
+    signs_agent = numpy.sign(agent_conv_array)
+    # Can't influence others with higher beliefs in that argument
+    can_influence = numpy.sign(agent_conv_array - colleague_conv_array) == signs_agent
+    eta = influence * (1 - stubbornness[others]) * alpha  # Regulates the influence, one value per colleague
+    new_conv_array = colleague_conv_array + eta[:, None] * agent_conv_array
+    # An agent can only influence up to the same level of uncertainty that he has. So we limit it in case the update
+    # step becomes too big
+    new_conv_array = numpy.where(signs_agent * agent_conv_array > signs_agent * new_conv_array,
+                                 new_conv_array, agent_conv_array)
+    new_conv_array = numpy.where(can_influence, new_conv_array, colleague_conv_array)
+    # Convert B' back to B
+    belief_matrix[others] = transform_convincing_value(new_conv_array, inv=True)
+    return numpy.sum(new_conv_array - colleague_conv_array, axis=0)
+
+
 def default_case_influencing(agent):
     """
     Simulates how an agent influence others. We define a convincing value, which reflects how far from 0.5 the belief
@@ -48,55 +86,101 @@ def default_case_influencing(agent):
     Returns:
         None
     """
-    logger.info("Doctor {} speaks now, trying to influence the other doctors".format(agent.unique_id))
-
-    agent_conv_array = transform_convincing_value(agent.belief_array)  # A'
-    for colleague in agent.model.schedule.agents:
-        if colleague != agent:
-            colleague_conv_array = transform_convincing_value(colleague.belief_array)  # B'
-            signs_agent = numpy.sign(agent_conv_array)
-            signs_vector = numpy.sign(agent_conv_array - colleague_conv_array)  # (A' - B')
-            for arg_idx, _ in enumerate(agent.belief_array):  # Loop over every argument
-                # Can't influence others with higher beliefs in that argument
-                if signs_vector[arg_idx] == signs_agent[arg_idx]:
-                    alpha = 0.25  # constant parameter to better simulate a real speed for convincing other people
-                    eta = agent.influence * (1 - colleague.stubbornness) * alpha  # Regulates the influence
-                    delta_belief = eta * agent_conv_array[arg_idx]
-                    # An agent can only influence up to the same level of uncertainty that he has. So we limit it in
-                    # case the update step becomes too big
-                    if (signs_agent[arg_idx] * agent_conv_array[arg_idx]) > (
-                            signs_agent[arg_idx] * (colleague_conv_array[arg_idx] + delta_belief)):
-                        new_val = colleague_conv_array[arg_idx] + delta_belief
-                    else:
-                        new_val = agent_conv_array[arg_idx]
-
-                    colleague_conv_array[arg_idx] = new_val
-            # Convert B' back to B
-            colleague.belief_array = transform_convincing_value(colleague_conv_array, inv=True).tolist()
-
-
-class DoctorAgent(Agent):
+    model = agent.model
+    model.committee_conv_sum += influence_colleagues(model.belief_matrix, agent._doctor_id, agent.influence,
+                                                     model.stubbornness_vector,
+                                                     colleagues=model.influence_neighbours(agent._doctor_id))
+    if model.trace_turns or model.trace is not None:
+        model.record_turn(agent)
+
+
+class DoctorAgent:
     """
         The agent model class for the doctors.
 
+        A doctor is only a handle to its row of the committee arrays of the model (``belief_matrix``,
+        ``influence_vector`` and ``stubbornness_vector``), so it holds no state of its own. It has ``__slots__`` instead
+        of a ``__dict__``, and implements the part of mesa's ``Agent`` that the scheduler uses (``unique_id``,
+        ``model``, ``random`` and ``step``) instead of deriving from it, as mesa's ``Agent`` has a ``__dict__``. That
+        keeps large committees cheap: an agent takes 48 bytes instead of about 150.
+
         Attributes:
-            _doctor_id: agent's unique ID
-            belief_array (list): Represents how the doctor believes in each of the arguments presented. A 1
+            _doctor_id: agent's unique ID. It is also the row of the model's belief matrix that holds this doctor's
+                state
+            belief_array (numpy.ndarray): Represents how the doctor believes in each of the arguments presented. A 1
                 represents absolute certainty while 0 represents complete disbelief. -1 means the agent doesn't have
-                knowledge for that argument yet
+                knowledge for that argument yet. It is a view into ``model.belief_matrix``
             stubbornness (float): How difficult it is to change this doctor's mind. From 0 to 1, 1 being impossible
                 to change his mind
             influence (float): How good is the agent at convincing people. From 0 to 1, 1 being the highest chances
                 of convincing
      """
-
-    def __init__(self, unique_id, model, belief_array, influence=0.5, stubbornness=0.5):
-        super().__init__(unique_id, model)
-
-        self._doctor_id = unique_id
-        self.belief_array = belief_array
+    __slots__ = ("unique_id", "model")
+
+    def __init__(self, unique_id, model, belief_array=None, influence=0.5, stubbornness=0.5):
+        """
+        Writes the doctor's state into the model's arrays. When ``belief_array`` is not given, the row of the belief
+        matrix is left as it is. Use :meth:`handle` for a doctor whose whole state is already in the arrays.
+        """
+        self.unique_id = unique_id
+        self.model = model
+        if belief_array is not None:
+            self.belief_array = belief_array
         self.influence = influence
         self.stubbornness = stubbornness
 
+    @classmethod
+    def handle(cls, unique_id, model):
+        """
+        Returns:
+            A doctor for row ``unique_id`` of the model's arrays, which are left as they are
+        """
+        doctor = cls.__new__(cls)
+        doctor.unique_id = unique_id
+        doctor.model = model
+        return doctor
+
+    @property
+    def _doctor_id(self):
+        return self.unique_id
+
+    @property
+    def random(self):
+        return self.model.random
+
+    @property
+    def belief_array(self):
+        return self.model.belief_matrix[self.unique_id]
+
+    @belief_array.setter
+    def belief_array(self, value):
+        # Keep the committee's running sum of convincing values in sync with the new beliefs
+        model = self.model
+        model.committee_conv_sum -= transform_convincing_value(model.belief_matrix[self.unique_id])
+        model.belief_matrix[self.unique_id] = value
+        model.committee_conv_sum += transform_convincing_value(model.belief_matrix[self.unique_id])
+
+    @property
+    def influence(self):
+        return self.model.influence_vector[self.unique_id]
+
+    @influence.setter
+    def influence(self, value):
+        self.model.influence_vector[self.unique_id] = value
+
+    @property
+    def stubbornness(self):
+        return self.model.stubbornness_vector[self.unique_id]
+
+    @stubbornness.setter
+    def stubbornness(self, value):
+        self.model.stubbornness_vector[self.unique_id] = value
+
     def step(self):
-        default_case_influencing(self)
+        profiler = self.model.profiler
+        if profiler is None:
+            default_case_influencing(self)
+        else:
+            start = perf_counter()
+            default_case_influencing(self)
+            profiler.add("influencing", perf_counter() - start)
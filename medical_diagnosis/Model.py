@@ -1,21 +1,82 @@
-from functools import partial
+import colorsys
+import copy
 import logging
+import random
+import time
 import numpy
 
 from mesa import Model
 from mesa.time import RandomActivation, BaseScheduler
-from mesa.datacollection import DataCollector
 
 from medical_diagnosis.DoctorAgent import DoctorAgent, transform_convincing_value
-from medical_diagnosis.initialisations import initialisations
+from medical_diagnosis.datacollection import ColumnarDataCollector
+from medical_diagnosis.equilibrium import solve_equilibrium
+from medical_diagnosis.initialisations import get_scenario, sample_committees
+from medical_diagnosis.profiling import PhaseProfiler
+from medical_diagnosis.topology import make_topology, neighbour_lists
+from medical_diagnosis.trace import TraceRecorder
 
 ARGUMENT_NAMES = ('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J')
+# Relevance of every argument for every disease in the scripted cases
+DEFAULT_CASE_WEIGHTS = {"Zika": (0.4, 0., 0.6, 0., 0.),
+                        "Chikungunya": (0., 0.25, 0., 0.25, 0.5)}
 COLORS = ('#00FF00', '#FF0000', '#0000FF', '#383B38', '#FF00FF',
           '#8000FF', '#FF7F00', '#F6F90E', '#6E1122', '#3B541F')
 
 logger = logging.getLogger('medical_diagnosis')
 
 
+def argument_names(n_args):
+    """
+    Generates labels for any number of arguments, in spreadsheet-column style: A, B, ..., Z, AA, AB, ... The first ten
+    are the same as ARGUMENT_NAMES.
+    """
+    names = []
+    for i in range(1, n_args + 1):
+        name = ""
+        while i:
+            i, remainder = divmod(i - 1, 26)
+            name = chr(ord('A') + remainder) + name
+        names.append(name)
+    return names
+
+
+def argument_colors(n_colors):
+    """
+    Generates colors for any number of series. The first ten are COLORS, the rest are spread around the hue circle
+    with the golden ratio so that consecutive ones look different.
+    """
+    colors = list(COLORS[:n_colors])
+    for i in range(len(colors), n_colors):
+        r, g, b = colorsys.hsv_to_rgb((i * 0.618033988749895) % 1, 0.8, 0.9)
+        colors.append("#{:02X}{:02X}{:02X}".format(int(r * 255), int(g * 255), int(b * 255)))
+    return colors
+
+
+def make_weight_matrix(arg_weight_vector, diseases, n_args):
+    """
+    Builds the (n_diseases, n_args) matrix with the relevance of every argument for every disease.
+
+    Args:
+        arg_weight_vector: Either a dict with one weight vector per disease name, or an array that is already a
+            (n_diseases, n_args) matrix. If None, all the weights are zero
+        diseases (list): Names of the diseases, in the order of the rows
+        n_args (int): Number of arguments
+
+    Returns:
+        numpy.ndarray (n_diseases, n_args)
+    """
+    if arg_weight_vector is None:
+        return numpy.zeros((len(diseases), n_args))
+    if isinstance(arg_weight_vector, dict):
+        arg_weight_vector = [arg_weight_vector[disease] for disease in diseases]
+    weight_matrix = numpy.array(arg_weight_vector, dtype=float)
+    if weight_matrix.shape != (len(diseases), n_args):
+        raise ValueError("The weight matrix must have shape {}, got {}".format((len(diseases), n_args),
+                                                                               weight_matrix.shape))
+    return weight_matrix
+
+
 def calculate_avg_belief(idx, model):
     """
     Calculates the mean of the belief for a certain argument between all agents
@@ -26,23 +87,21 @@ def calculate_avg_belief(idx, model):
     Returns:
         Mean value for the belief in an argument between agents
     """
-    avg = 0
-    for agent in model.schedule.agents:
-        avg += agent.belief_array[idx]
-    avg = avg / len(model.schedule.agents)
-    return avg
+    return model.belief_matrix[:, idx].mean()
 
 
-def random_belief_array(lenght, mu=0.5, sigma=0.25):
-    return numpy.random.normal(mu, sigma, lenght).tolist()
+def random_belief_array(lenght, mu=0.5, sigma=0.25, rng=numpy.random):
+    return rng.normal(mu, sigma, lenght)
 
 
-def random_influence(mu=0.5, sigma=0.25):
-    return numpy.random.normal(mu, sigma)
+def random_influence(mu=0.5, sigma=0.25, rng=numpy.random):
+    return rng.normal(mu, sigma)
 
 
 def softmax(x):
-    return numpy.exp(x) / sum(numpy.exp(x))
+    # Shifted by the maximum so that the committee sums of large committees do not overflow
+    e = numpy.exp(x - numpy.max(x))
+    return e / e.sum()
 
 
 def get_belief_val(idx, agent):
@@ -57,6 +116,10 @@ def get_final_decision(model):
     return model.final_decision
 
 
+def get_convergence_step(model):
+    return model.converged_step
+
+
 def log_belief_arrays(model):
     for doctor in model.schedule.agents:
         text = "Doctor {}: {}".format(doctor._doctor_id, numpy.round(doctor.belief_array, 2))
@@ -82,131 +145,449 @@ class MedicalModel(Model):
     LIST_OF_DISEASES = {"X": "Zika",
                         "Y": "Chikungunya"}
 
-    def __init__(self, N=3, n_init_arg=5, experiment_case="default", sigma=0.25, arg_weight_vector=None):
+    # Criteria that can be used to stop a simulation once the committee has converged:
+    #   belief_delta: no belief changed more than the tolerance during a step
+    #   probabilities: no diagnosis probability changed more than the tolerance during a step
+    #   decision: the final decision did not flip during a step
+    CONVERGENCE_CRITERIA = ("belief_delta", "probabilities", "decision")
+    # Default number of consecutive steps every criterion must hold. The decision rarely flips between two steps even
+    # when the committee is still moving, so with a short window it stops runs that would still change their decision
+    # (over 120 batch runs, 20 of them with a window of 1 and 2 of them with 20, against none for the other criteria)
+    CONVERGENCE_WINDOWS = {"belief_delta": 1, "probabilities": 5, "decision": 20}
+    # How much the model reports about the argumentation:
+    #   off: nothing is formatted or written
+    #   summary: the belief arrays and the committee decision are logged once per step
+    #   full: as summary, plus a binary record of the committee after every speaker's turn (see trace.py)
+    TRACE_LEVELS = ("off", "summary", "full")
+
+    def __init__(self, N=3, n_init_arg=5, experiment_case="default", sigma=0.25, arg_weight_vector=None, seed=None,
+                 convergence=None, convergence_tol=1e-6, convergence_window=None, trace_turns=False, trace_level="summary",
+                 trace_file="trace.bin", max_steps=50, diseases=None, topology=None, profile=False,
+                 profile_callback=None, profile_file=None, dtype=float):
+        """
+        Args:
+            arg_weight_vector: Relevance of every argument for every disease. Either a dict with one weight vector per
+                disease, or a (n_diseases, n_args) matrix. See make_weight_matrix
+            diseases (list): Names of the diseases the committee chooses from. Defaults to LIST_OF_DISEASES
+            convergence (str): One of CONVERGENCE_CRITERIA. When given, the model stops running (``running`` is set
+                to False) once the criterion has held for ``convergence_window`` consecutive steps. None never stops
+            convergence_tol (float): Tolerance for the belief_delta and probabilities criteria
+            convergence_window (int): Number of consecutive steps the criterion must hold. Defaults to the one of the
+                criterion in CONVERGENCE_WINDOWS. The decision criterion needs at least 2
+            trace_turns (bool): If True, the committee diagnosis is also computed after every speaker's turn and
+                stored in ``turn_diagnoses``
+            trace_level (str): One of TRACE_LEVELS
+            trace_file (str): File where the binary trace is written when trace_level is full
+            max_steps (int): Expected number of steps, used to size the data collector's buffers. Running longer is
+                fine, the buffers grow as needed
+            topology: Who can influence whom. By default every doctor influences every other doctor. It can be the
+                name of one of the generated topologies (see topology.TOPOLOGIES), a networkx graph, or a CSR
+                adjacency (see topology.neighbour_lists)
+            profile (bool): If True, the time spent in every phase of the step is accumulated in ``profiler``
+            profile_callback: Called with ``(step, timings)`` after every step when profiling
+            profile_file (str): File where the timings of every step are appended when profiling
+            dtype: Float type of the beliefs, influence and stubbornness of the committee and of the recorded
+                beliefs. ``numpy.float32`` halves their memory for very large committees. The committee sum and the
+                probabilities are always computed in float64
+        """
+        if convergence is not None and convergence not in self.CONVERGENCE_CRITERIA:
+            raise ValueError("Unknown convergence criterion: {}".format(convergence))
+        if convergence_window is None:
+            convergence_window = self.CONVERGENCE_WINDOWS.get(convergence, 1)
+        if convergence == "decision" and convergence_window < 2:
+            raise ValueError("The decision criterion needs a convergence_window of at least 2")
+        if trace_level not in self.TRACE_LEVELS:
+            raise ValueError("Unknown trace level: {}".format(trace_level))
         self.num_agents = N
         self.n_initial_arguments = n_init_arg  # Number of initial arguments that doctors will consider
         self.experiment_case = experiment_case
         self.diagnosis_text = ""
-        self.diagnosis_probabilities = numpy.zeros(len(self.LIST_OF_DISEASES)).tolist()
+        # The scripted cases are always about LIST_OF_DISEASES
+        if diseases is None or experiment_case != "batch":
+            diseases = self.LIST_OF_DISEASES.values()
+        self.diseases = list(diseases)
+        self.argument_names = argument_names(self.n_initial_arguments)
+        self.diagnosis_probabilities = numpy.zeros(len(self.diseases))
         self.final_decision = None
-        # How relevant is said argument to reach conclusion X or Y
-        if arg_weight_vector is not None:
-            self.arg_weight_vector = arg_weight_vector
-        else:
-            self.arg_weight_vector = {"Zika": numpy.zeros(self.n_initial_arguments, dtype=float),
-                                      "Chikungunya": numpy.zeros(self.n_initial_arguments, dtype=float)}
+        self.convergence = convergence
+        self.convergence_tol = convergence_tol
+        self.convergence_window = convergence_window
+        self.converged_step = None  # Last step that changed the state, once the committee has converged
+        self._stable_steps = 0
+        # How relevant is said argument to reach each of the conclusions, one row per disease
+        self.weight_matrix = make_weight_matrix(arg_weight_vector, self.diseases, self.n_initial_arguments)
+        # Mesa already seeds self.random (used by the scheduler) with the seed keyword. Without a seed the global numpy
+        # random state is used, as before.
+        self.np_random = numpy.random if seed is None else numpy.random.default_rng(seed)
         self.schedule = RandomActivation(self)  # Every tick, agents move in a different random order
+        # The state of the whole committee is kept in arrays, one row/entry per doctor. Each DoctorAgent reads and
+        # writes its own row, so the influencing step can update all colleagues with a single array operation.
+        # Rows start at complete uncertainty (convincing value 0), which is what the running sum starts from.
+        self.dtype = numpy.dtype(dtype)
+        self.belief_matrix = numpy.full((self.num_agents, self.n_initial_arguments), 0.5, dtype=self.dtype)
+        self.influence_vector = numpy.zeros(self.num_agents, dtype=self.dtype)
+        self.stubbornness_vector = numpy.zeros(self.num_agents, dtype=self.dtype)
+        # Sum of the convincing values of all doctors, patched every time a belief array changes
+        self.committee_conv_sum = numpy.zeros(self.n_initial_arguments, dtype=float)
+        self.sigma = sigma
+        self.topology = topology
+        # Influence graph in CSR form, None when everyone influences everyone
+        self.influence_graph = None
+        self.profiler = PhaseProfiler(profile_callback, profile_file) if profile else None
+        self.trace_turns = trace_turns
+        self.turn_diagnoses = []  # (step, speaker, diagnosis probabilities) after every turn, if trace_turns is set
+        self.trace_level = trace_level
+        self.log_enabled = trace_level != "off"
+        self.trace = None
+        if trace_level == "full":
+            self.trace = TraceRecorder(trace_file, self.num_agents, self.n_initial_arguments,
+                                       len(self.diseases))
+
+        if self.experiment_case != "batch" and arg_weight_vector is None:
+            if self.n_initial_arguments != 5:
+                raise ValueError("The scripted cases need an arg_weight_vector for other than 5 initial arguments")
+            # Hard coding the weight vectors for the default case, as we feel like they should be..
+            self.weight_matrix = make_weight_matrix(DEFAULT_CASE_WEIGHTS, self.diseases, self.n_initial_arguments)
 
-        if self.experiment_case == "batch":  # Batch run case
-            for i in range(self.num_agents):
-                belief_array = random_belief_array(lenght=self.n_initial_arguments, sigma=sigma)
-                doctor = DoctorAgent(i, self, belief_array)
-                # Random influence values
-                doctor.influence = random_influence(0.5, 0.25)
-                doctor.stubbornness = random_influence(0.5, 0.25)
-                self.schedule.add(doctor)
+        # The doctors start at complete uncertainty, their state is drawn by initialise_committee
+        for i in range(self.num_agents):
+            self.schedule.add(DoctorAgent.handle(i, self))
 
-        else:
-            if (self.num_agents != 3) or (self.n_initial_arguments != 5):
-                print("Sorry, the default case only works with 3 doctors and 5 initial arguments")
-                exit()
-            # Hard coding the weight vectors for the default case, as we feel like they should be..
-            self.arg_weight_vector["Zika"] = numpy.asarray([0.4, 0., 0.6, 0., 0.])
-            self.arg_weight_vector["Chikungunya"] = numpy.asarray([0., 0.25, 0., 0.25, 0.5])
+        # Collects the average belief for each argument, the diagnosis probabilities and the belief array of each
+        # agent in every step of the simulation
+        self.datacollector = ColumnarDataCollector(self.num_agents, self.argument_names, self.diseases,
+                                                   capacity=max_steps + 1, dtype=self.dtype)
 
-            # call intialisation with number of doctors, case number and number of arguments
-            placeholder = initialisations(nb_doctors=self.num_agents, case=self.experiment_case, n_args=5)
-            belief_array = placeholder[0]
-            influence_stubborn_list = placeholder[1]
+        self.initialise_committee(seed)
 
-            # For testing different cases
-            for i in range(self.num_agents):
-                doctor = DoctorAgent(i, self, belief_array[i])
-                doctor.influence, doctor.stubbornness = influence_stubborn_list[i]
-                self.schedule.add(doctor)
+    def initialise_committee(self, seed=None):
+        """
+        Draws the influence graph (if it is generated) and the state of every doctor, and computes the initial
+        committee decision. Called when the model is built and when it is recycled.
+        """
+        rng = self.random if seed is not None else random
+        if isinstance(self.topology, str) or (self.topology is not None and self.influence_graph is None):
+            topology = self.topology
+            if isinstance(topology, str):
+                topology = make_topology(topology, self.num_agents, rng=rng)
+            self.influence_graph = neighbour_lists(topology, self.num_agents)
 
-            logger.info("Starting simulation for the default case. The initial set of arguments is the following:")
+        if self.experiment_case == "batch":  # Batch run case
+            # The beliefs, influence and stubbornness of every doctor in turn, as random_belief_array and
+            # random_influence would draw them one doctor after the other, but in a single draw
+            n_args = self.n_initial_arguments
+            scale = numpy.full(n_args + 2, 0.25)
+            scale[:n_args] = self.sigma
+            draws = self.np_random.normal(0.5, scale, (self.num_agents, n_args + 2))
+            self.belief_matrix[:] = draws[:, :n_args]
+            self.influence_vector[:] = draws[:, n_args]
+            self.stubbornness_vector[:] = draws[:, n_args + 1]
+            self.committee_conv_sum[:] = transform_convincing_value(self.belief_matrix).sum(axis=0)
 
-        self.calculate_committee()  # Calculates initial point for the committee decision.
+        else:
+            # A committee of the scripted case, drawn as an ensemble of one
+            beliefs, influence, stubbornness = sample_committees(get_scenario(self.experiment_case), 1,
+                                                                 self.num_agents, self.n_initial_arguments,
+                                                                 rng=self.np_random if seed is not None else None)
+            self.belief_matrix[:] = beliefs[0]
+            self.influence_vector[:] = influence[0]
+            self.stubbornness_vector[:] = stubbornness[0]
+            self.committee_conv_sum[:] = transform_convincing_value(self.belief_matrix).sum(axis=0)
+
+            if self.log_enabled:
+                logger.info("Starting simulation for the default case. The initial set of arguments is the "
+                            "following:")
+                log_belief_arrays(self)
 
-        # Create dictionary where avg_belief will be tracked for each argument
-        dict_model_collector = {}
-        for i in range(self.n_initial_arguments):
-            avg_belief = partial(calculate_avg_belief, i)
-            dict_model_collector[ARGUMENT_NAMES[i]] = avg_belief
-        # Create dictionary where the diagnosis probabilities will be tracked
-        for i, disease in enumerate(self.LIST_OF_DISEASES.values()):
-            disease_prob = partial(get_diagnosis_probabilities, i)
-            dict_model_collector[disease] = disease_prob
-        # Create dictionary where the belief array of each agent will be tracked
-        belief_array_collector = {}
-        for arg_idx in range(self.n_initial_arguments):
-            belief_value = partial(get_belief_val, arg_idx)
-            belief_array_collector[ARGUMENT_NAMES[arg_idx]] = belief_value
-
-        # Collects data that will be collected in every step of the simulation
-        self.datacollector = DataCollector(
-            model_reporters=dict_model_collector,
-            agent_reporters=belief_array_collector)
+        self.calculate_committee()  # Calculates initial point for the committee decision.
+        if self.trace is not None:
+            self.trace.record(0, -1, self.belief_matrix, self.diagnosis_probabilities)
 
         self.running = True
         self.datacollector.collect(self)
 
+    def recycle(self, seed=None):
+        """
+        Puts the model back at step 0 with a new committee, exactly as if it had just been built with the same
+        parameters and ``seed``, but reusing its agents and buffers. This is what makes pooling models cheaper than
+        building new ones.
+
+        Args:
+            seed (int): Seed of the new committee. None behaves like building the model without a seed
+        """
+        # The trace and the profiler's step file only describe the previous run, so they are completed instead of
+        # written over, and the new run does not write them
+        self.close()
+        # Same seeding as mesa's Model.__new__
+        self._seed = seed if seed is not None else time.time()
+        self.random.seed(self._seed)
+        self.np_random = numpy.random if seed is None else numpy.random.default_rng(seed)
+        self.schedule.steps = 0
+        self.schedule.time = 0
+        self.diagnosis_text = ""
+        self.final_decision = None
+        self.converged_step = None
+        self._stable_steps = 0
+        self.turn_diagnoses = []
+        self.datacollector.truncate(0)
+        if self.profiler is not None:
+            self.profiler.reset()
+        self.belief_matrix.fill(0.5)
+        self.committee_conv_sum.fill(0.)
+        self.initialise_committee(seed)
+
+    def snapshot(self):
+        """
+        Captures the state the argumentation continues from, as a few flat arrays that can be saved with
+        ``numpy.savez(file, **model.snapshot())``. The recorded history is not part of it.
+
+        Returns:
+            dict with the ``beliefs`` matrix, the ``influence`` and ``stubbornness`` vectors, the diagnosis
+            ``probabilities``, the ``counters`` (steps, time, converged step or -1, stable steps, running and number
+            of records) and the state of the random generator of the speaking order (``rng_state`` and ``rng_gauss``)
+        """
+        version, rng_state, rng_gauss = self.random.getstate()
+        return {"beliefs": self.belief_matrix.copy(),
+                "influence": self.influence_vector.copy(),
+                "stubbornness": self.stubbornness_vector.copy(),
+                "probabilities": numpy.array(self.diagnosis_probabilities),
+                "counters": numpy.array([self.schedule.steps, self.schedule.time,
+                                         -1 if self.converged_step is None else self.converged_step,
+                                         self._stable_steps, self.running, self.datacollector.n_records],
+                                        dtype=numpy.int64),
+                "rng_state": numpy.array(rng_state, dtype=numpy.uint32),
+                "rng_gauss": numpy.array(numpy.nan if rng_gauss is None else rng_gauss)}
+
+    def restore(self, snapshot):
+        """
+        Puts the model back in the state of a snapshot of a model with the same number of doctors and arguments. If
+        the model has recorded the steps up to the snapshot, as when rolling it back, their history is kept. Otherwise
+        the history starts again at the restored step.
+
+        Args:
+            snapshot: As returned by snapshot, or the file it was saved to loaded with ``numpy.load``
+        """
+        beliefs = numpy.asarray(snapshot["beliefs"], dtype=float)
+        if beliefs.shape != self.belief_matrix.shape:
+            raise ValueError("The snapshot is of a committee of shape {}, the model has {}".format(
+                beliefs.shape, self.belief_matrix.shape))
+        self.belief_matrix[:] = beliefs
+        self.committee_conv_sum[:] = transform_convincing_value(self.belief_matrix).sum(axis=0)
+        self.influence_vector[:] = snapshot["influence"]
+        self.stubbornness_vector[:] = snapshot["stubbornness"]
+        steps, time_, converged_step, stable_steps, running, n_records = (int(x) for x in snapshot["counters"])
+        self.schedule.steps = steps
+        self.schedule.time = time_
+        self.converged_step = None if converged_step < 0 else converged_step
+        self._stable_steps = stable_steps
+        self.running = bool(running)
+        rng_gauss = float(snapshot["rng_gauss"])
+        self.random.setstate((3, tuple(int(x) for x in snapshot["rng_state"]),
+                              None if numpy.isnan(rng_gauss) else rng_gauss))
+        self.calculate_committee()
+
+        collector = self.datacollector
+        if n_records and collector.n_records >= n_records and collector.steps[n_records - 1] == steps:
+            collector.truncate(n_records)
+        else:
+            collector.truncate(0)
+            collector.collect(self)
+
+    def fork(self):
+        """
+        Branches the model off, for counterfactual runs from its current state. The branch is an independent model
+        (changing its beliefs, influence or stubbornness does not change this one) that continues exactly as this one
+        would, with the same speaking orders. The recorded history is shared until one of the two writes over the
+        other's records, so forking costs the size of the committee, not of the history. Branches are not profiled.
+
+        Returns:
+            MedicalModel
+        """
+        if self.trace is not None:
+            raise ValueError("A model that writes a trace file can not be forked")
+        branch = copy.copy(self)
+        branch.random = random.Random()
+        branch.random.setstate(self.random.getstate())
+        if isinstance(self.np_random, numpy.random.Generator):
+            branch.np_random = copy.deepcopy(self.np_random)
+        branch.belief_matrix = self.belief_matrix.copy()
+        branch.influence_vector = self.influence_vector.copy()
+        branch.stubbornness_vector = self.stubbornness_vector.copy()
+        branch.committee_conv_sum = self.committee_conv_sum.copy()
+        branch.turn_diagnoses = list(self.turn_diagnoses)
+        branch.profiler = None
+        branch.datacollector = self.datacollector.fork()
+        branch.schedule = RandomActivation(branch)
+        branch.schedule.steps = self.schedule.steps
+        branch.schedule.time = self.schedule.time
+        for agent in self.schedule.agents:
+            branch.schedule.add(DoctorAgent.handle(agent.unique_id, branch))
+        return branch
+
     def step(self):
         """
             Advance the model by one step.
             Randomly initialize doctors and print out ensemble decision,
             based on initial belief vectors and atom probabilities
         """
-        logger.info('-' * 40)
-        logger.info("Beginning of a new argumentation round. Doctor belief arrays before argumentation are:")
-        log_belief_arrays(self)
+        previous_beliefs = self.belief_matrix.copy() if self.convergence == "belief_delta" else None
+        previous_probabilities = self.diagnosis_probabilities
+        previous_decision = self.final_decision
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start_step()
 
         self.schedule.step()
-        logger.info("Doctor belief arrays after argumentation:")
-        log_belief_arrays(self)
+        if profiler is not None:
+            profiler.lap("schedule")
         self.calculate_committee()
-        logger.info("Probability for the diagnosis being {} is: {}".format(self.LIST_OF_DISEASES['X'],
-                                                                           round(self.diagnosis_probabilities[0], 2)))
-        logger.info("Probability for the diagnosis being {} is: {}".format(self.LIST_OF_DISEASES['Y'],
-                                                                           round(self.diagnosis_probabilities[1], 2)))
-        if self.diagnosis_probabilities[0] > self.diagnosis_probabilities[1]:
-            disease = self.LIST_OF_DISEASES['X']
+        if profiler is not None:
+            profiler.lap("calculate_committee")
+        if self.log_enabled:
+            self.log_summary()
+        if self.trace is not None:
+            self.trace.flush()
+        if profiler is not None:
+            profiler.lap("logging")
+        if self.convergence is not None:
+            self.check_convergence(previous_beliefs, previous_probabilities, previous_decision)
+        if profiler is not None:
+            profiler.lap("convergence")
+
+        self.datacollector.collect(self)
+        if profiler is not None:
+            profiler.lap("collect")
+            profiler.end_step(self.schedule.steps)
+
+    def check_convergence(self, previous_beliefs, previous_probabilities, previous_decision):
+        """
+        Updates the count of consecutive stable steps with the changes made by the last step, and stops the model
+        when it reaches the convergence window.
+
+        Args:
+            previous_beliefs (numpy.ndarray): Belief matrix before the step. Only needed for belief_delta
+            previous_probabilities (numpy.ndarray): Diagnosis probabilities before the step
+            previous_decision (str): Final decision before the step
+        """
+        if self.convergence == "belief_delta":
+            stable = numpy.max(numpy.abs(self.belief_matrix - previous_beliefs)) < self.convergence_tol
+        elif self.convergence == "probabilities":
+            stable = numpy.max(numpy.abs(self.diagnosis_probabilities - previous_probabilities)) < self.convergence_tol
         else:
-            disease = self.LIST_OF_DISEASES['Y']
-        self.final_decision = disease
-        self.diagnosis_text = "The diagnosis for the patient is: {}.".format(disease)
+            stable = self.final_decision == previous_decision
+        self._stable_steps = self._stable_steps + 1 if stable else 0
+
+        if self._stable_steps >= self.convergence_window:
+            self.converged_step = self.schedule.steps - self._stable_steps
+            self.running = False
+            self.close()
+            if self.log_enabled:
+                logger.info("The committee converged at step {}".format(self.converged_step))
+
+    def close_trace(self):
+        """
+        Closes the binary trace file, if the model writes one. The model is not traced anymore afterwards.
+        """
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+    def close(self):
+        """
+        Closes the files the model writes: the binary trace and the step file of the profiler. Called when the
+        committee converges, and to be called by whoever runs the model when it stops it before that. The profiler
+        keeps its counters.
+        """
+        self.close_trace()
+        if self.profiler is not None:
+            self.profiler.close()
+
+    def log_summary(self):
+        """
+        Logs the belief arrays and the committee decision at the end of a step.
+        """
+        logger.info('-' * 40)
+        logger.info("Doctor belief arrays after argumentation round {}:".format(self.schedule.steps))
+        log_belief_arrays(self)
+        for disease, probability in zip(self.diseases, self.diagnosis_probabilities):
+            logger.info("Probability for the diagnosis being {} is: {}".format(disease, round(probability, 2)))
         logger.info(self.diagnosis_text)
 
-        self.datacollector.collect(self)
+    def committee_diagnosis(self, conv_sum=None):
+        """
+        Computes the committee's diagnosis probabilities from the running sum of convincing values, so it costs
+        O(n_args) whatever the size of the committee.
 
-    def calculate_committee(self):
-        # Calculate the sum over all the belief arrays of all the doctors. Convincing values are used, so values <
-        # 0.5 will have a negative value, being beliefs closer to 0 convincing values closer to -1
-        committee_sum = numpy.zeros(self.n_initial_arguments)
-        for doctor in self.schedule.agents:
-            conv_val = transform_convincing_value(doctor.belief_array)
-            committee_sum = numpy.add(committee_sum, conv_val)
-        committee_sum = transform_convincing_value(committee_sum, inv=True)
+        Args:
+            conv_sum (numpy.ndarray): Sum of the convincing values of another state of the committee. Defaults to the
+                current one
+
+        Returns:
+            numpy.ndarray with the probability of every disease in ``diseases``
+        """
+        if conv_sum is None:
+            conv_sum = self.committee_conv_sum
+        # The sum is over the convincing values of all the doctors, so values < 0.5 will have a negative value, being
+        # beliefs closer to 0 convincing values closer to -1
+        committee_sum = transform_convincing_value(conv_sum, inv=True)
         # Convert it to probabilities
         probabilities_committee = softmax(committee_sum)
-        probability_zika = sum(numpy.multiply(self.arg_weight_vector["Zika"], probabilities_committee)) / sum(
-            probabilities_committee)
-        probability_chikv = sum(numpy.multiply(self.arg_weight_vector["Chikungunya"], probabilities_committee)) / sum(
-            probabilities_committee)
+        # Weighted evidence for every disease, as a single matrix-vector product
+        disease_scores = self.weight_matrix @ probabilities_committee / probabilities_committee.sum()
+
+        return softmax(disease_scores)
 
-        probabilities = softmax([probability_zika, probability_chikv])
+    def equilibrium(self, tol=1e-10, max_iter=1000):
+        """
+        Computes where the argumentation ends up from the current state, without stepping the model. The random
+        speaking order is averaged out, and the resulting rounds are iterated until they stop changing the committee
+        (see equilibrium.solve_equilibrium). The model itself is not changed. In split committees (as case 2), where
+        the outcome depends on who speaks first, the averaged limit can differ from what a given run reaches.
+
+        Returns:
+            ``(beliefs, probabilities, decision, residual)``: limiting belief matrix, diagnosis probabilities and
+            final decision of the committee, and largest change of a belief in the last round. An infinite residual
+            means the rounds did not settle within max_iter, and the other values are not a limiting state
+        """
+        mask = None
+        if self.influence_graph is not None:
+            indptr, indices = self.influence_graph
+            mask = numpy.zeros((self.num_agents, self.num_agents))
+            mask[numpy.repeat(numpy.arange(self.num_agents), numpy.diff(indptr)), indices] = 1
+        beliefs, residual, _ = solve_equilibrium(self.belief_matrix, self.influence_vector, self.stubbornness_vector,
+                                                 mask, tol=tol, max_iter=max_iter)
+        probabilities = self.committee_diagnosis(transform_convincing_value(beliefs).sum(axis=0))
+        n_diseases = len(self.diseases)
+        decision = self.diseases[n_diseases - 1 - numpy.argmax(probabilities[::-1])]
+        return beliefs, probabilities, decision, residual
+
+    def influence_neighbours(self, doctor_id):
+        """
+        Returns:
+            Rows of the doctors that ``doctor_id`` can influence, or None if it can influence the whole committee
+        """
+        if self.influence_graph is None:
+            return None
+        indptr, indices = self.influence_graph
+        return indices[indptr[doctor_id]:indptr[doctor_id + 1]]
 
-        print(probabilities)
-        self.diagnosis_probabilities[0] = probabilities[0]
-        self.diagnosis_probabilities[1] = probabilities[1]
+    def record_turn(self, speaker):
+        """
+        Stores the committee diagnosis right after ``speaker`` has finished influencing the others, in
+        ``turn_diagnoses`` and/or the binary trace.
+        """
+        step = self.schedule.steps + 1
+        probabilities = self.committee_diagnosis()
+        if self.trace_turns:
+            self.turn_diagnoses.append((step, speaker._doctor_id, probabilities))
+        if self.trace is not None:
+            self.trace.record(step, speaker._doctor_id, self.belief_matrix, probabilities)
 
-        logger.info("Probability for the diagnosis being {} is: {}".format(self.LIST_OF_DISEASES['X'],
-                                                                           round(probabilities[0], 2)))
-        logger.info("Probability for the diagnosis being {} is: {}".format(self.LIST_OF_DISEASES['Y'],
-                                                                           round(probabilities[1], 2)))
+    def calculate_committee(self):
+        self.diagnosis_probabilities = self.committee_diagnosis()
 
-        disease = self.LIST_OF_DISEASES['X'] if probability_zika > probability_chikv else self.LIST_OF_DISEASES['Y']
+        # Most probable disease. Ties go to the last one, so with two diseases Zika needs to be strictly more probable
+        n_diseases = len(self.diseases)
+        disease = self.diseases[n_diseases - 1 - numpy.argmax(self.diagnosis_probabilities[::-1])]
         self.final_decision = disease
         self.diagnosis_text = "The diagnosis for the patient is: {}.".format(disease)
-        logger.info(self.diagnosis_text)
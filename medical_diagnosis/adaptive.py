@@ -0,0 +1,99 @@
+from statistics import NormalDist
+
+import numpy
+import pandas
+
+from medical_diagnosis.analysis import wilson_interval
+from medical_diagnosis.ensemble import MedicalEnsemble
+from medical_diagnosis.sweep import cell_seed, resolve_root_seed
+
+# What the confidence interval is computed on:
+#   accuracy: share of the committees that reach the correct diagnosis (Wilson interval)
+#   probability: mean probability of the correct diagnosis (normal approximation)
+METRICS = ("accuracy", "probability")
+
+
+def interval_width(data, ground_truth, metric="accuracy", confidence=0.95):
+    """
+    Returns:
+        Width of the confidence interval of ``metric`` over the runs in ``data``
+    """
+    n = len(data)
+    if metric == "accuracy":
+        low, high = wilson_interval(numpy.sum(data["Final_decision"].values == ground_truth), n, confidence)
+        return float(high - low)
+    elif metric == "probability":
+        if n < 2:
+            return numpy.inf
+        z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        return float(2 * z * data[ground_truth].std() / numpy.sqrt(n))
+    raise ValueError("Unknown metric: {}".format(metric))
+
+
+def run_adaptive_batch(n_doctors_range, target_width, batch_size=100, max_runs=10000, metric="accuracy",
+                       ground_truth="Chikungunya", confidence=0.95, n_init_arg=5, sigma=0.25, arg_weight_vector=None,
+                       max_steps=50, seed=None, diseases=None, scenario=None):
+    """
+    Batch sweep over the number of doctors where every N gets as many runs as it needs. Each N keeps simulating
+    ensembles of ``batch_size`` committees until the confidence interval of ``metric`` is at most ``target_width``
+    wide, or it has done ``max_runs`` runs.
+
+    Args:
+        target_width (float): Width of the confidence interval to reach
+        batch_size (int): Committees simulated at once, between two checks of the interval
+        max_runs (int): Budget of runs of every N
+        metric (str): One of METRICS
+        ground_truth (str): Correct diagnosis
+        confidence (float): Confidence level of the interval
+        seed (int): Root seed. Every batch of every N has its own seed derived from it
+
+    The rest of the arguments are the same as in run_ensemble_batch.
+
+    Returns:
+        ``(run_data, report)``: DataFrame with the columns N, Run, Final_decision and one per disease, like
+        run_ensemble_batch, and DataFrame indexed by N with the runs done, the width reached and whether it is
+        within the target
+    """
+    if metric not in METRICS:
+        raise ValueError("Unknown metric: {}".format(metric))
+    seed = resolve_root_seed(seed)
+    frames = []
+    report = []
+    run = 0
+    for n_doctors in n_doctors_range:
+        batches = []
+        runs = 0
+        width = numpy.inf
+        while width > target_width and runs < max_runs:
+            size = min(batch_size, max_runs - runs)
+            ensemble = MedicalEnsemble(size, N=n_doctors, n_init_arg=n_init_arg, sigma=sigma,
+                                       arg_weight_vector=arg_weight_vector,
+                                       seed=cell_seed(seed, "adaptive", n_doctors, len(batches)), diseases=diseases,
+                                       scenario=scenario)
+            ensemble.run(max_steps)
+            batches.append(ensemble.get_model_vars_dataframe())
+            runs += size
+            width = interval_width(pandas.concat(batches, ignore_index=True), ground_truth, metric, confidence)
+        df = pandas.concat(batches, ignore_index=True)
+        df.insert(0, "N", n_doctors)
+        df.insert(1, "Run", run + numpy.arange(runs))
+        run += runs
+        frames.append(df)
+        report.append({"N": n_doctors, "runs": runs, "width": width, "within_target": width <= target_width})
+    return pandas.concat(frames, ignore_index=True), pandas.DataFrame(report).set_index("N")
+
+
+def format_adaptive_report(report, target_width, metric="accuracy"):
+    """
+    Describes the precision reached by an adaptive batch, and the runs it saved with respect to a fixed number of
+    iterations. To reach the same precision in every N, the fixed batch needs as many iterations as the N that needed
+    the most runs.
+    """
+    fixed_runs = len(report) * report.runs.max()
+    lines = ["Confidence interval of the {} (target width {:g}):".format(metric, target_width)]
+    for n_doctors, row in report.iterrows():
+        lines.append("  N={:<5} runs={:<7} width={:.4f}{}".format(n_doctors, row.runs, row.width,
+                                                               "" if row.within_target else " (budget reached)"))
+    lines.append("{} runs in total, {} with a fixed number of iterations ({:.0%} saved)".format(
+        report.runs.sum(), fixed_runs, 1 - report.runs.sum() / fixed_runs))
+    return "\n".join(lines)
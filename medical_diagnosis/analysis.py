@@ -0,0 +1,76 @@
+from statistics import NormalDist
+
+import numpy
+import pandas
+
+from medical_diagnosis.Model import MedicalModel
+
+QUANTILES = (0.05, 0.5, 0.95)
+
+
+def wilson_interval(successes, trials, confidence=0.95):
+    """
+    Wilson score interval of a proportion, which unlike the normal approximation stays within [0, 1] and is usable
+    with few runs or accuracies close to 0 or 1.
+
+    Args:
+        successes (numpy.ndarray): Number of successes of every group
+        trials (numpy.ndarray): Number of trials of every group
+        confidence (float): Confidence level of the interval
+
+    Returns:
+        ``(low, high)`` arrays
+    """
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    trials = numpy.asarray(trials, dtype=float)
+    p = numpy.asarray(successes, dtype=float) / trials
+    center = (p + z ** 2 / (2 * trials)) / (1 + z ** 2 / trials)
+    half_width = z * numpy.sqrt(p * (1 - p) / trials + z ** 2 / (4 * trials ** 2)) / (1 + z ** 2 / trials)
+    return center - half_width, center + half_width
+
+
+def summarise_batch(run_data, ground_truth="Chikungunya", diseases=None, quantiles=QUANTILES, confidence=0.95):
+    """
+    Statistics of a batch sweep for every committee size, computed over a single grouping of the runs by N.
+
+    Args:
+        run_data (pandas.DataFrame): Results of the sweep, with one row per run and the columns N, Final_decision and
+            one per disease. Convergence_step is summarised too when present
+        ground_truth (str): Correct diagnosis
+        diseases (list): Diseases whose probabilities are summarised. Defaults to MedicalModel.LIST_OF_DISEASES
+        quantiles (tuple): Quantiles of the probabilities and of the convergence step
+        confidence (float): Confidence level of the accuracy interval
+
+    Returns:
+        DataFrame indexed by N with the columns runs, correct, accuracy, accuracy_low and accuracy_high, then
+        mean_<disease> and q<percent>_<disease> for every disease, and converged, mean_convergence_step and
+        q<percent>_convergence_step when the convergence step is known
+    """
+    if diseases is None:
+        diseases = list(MedicalModel.LIST_OF_DISEASES.values())
+    columns = {"correct": (run_data["Final_decision"] == ground_truth).astype(int)}
+    for disease in diseases:
+        columns[disease] = run_data[disease].astype(float)
+    has_convergence = "Convergence_step" in run_data.columns
+    if has_convergence:
+        # Runs that did not converge have no convergence step, and are left out of its statistics
+        columns["convergence_step"] = pandas.to_numeric(run_data["Convergence_step"], errors="coerce")
+    grouped = pandas.DataFrame(columns).groupby(run_data["N"].values)
+
+    counts = grouped.count()
+    means = grouped.mean()
+    percentiles = grouped.quantile(list(quantiles)).unstack()
+
+    summary = pandas.DataFrame(index=means.index.rename("N"))
+    summary["runs"] = counts["correct"]
+    summary["correct"] = grouped["correct"].sum()
+    summary["accuracy"] = means["correct"]
+    summary["accuracy_low"], summary["accuracy_high"] = wilson_interval(summary["correct"], summary["runs"],
+                                                                        confidence)
+    for column in diseases + (["convergence_step"] if has_convergence else []):
+        if column == "convergence_step":
+            summary["converged"] = counts[column]
+        summary["mean_" + column] = means[column]
+        for q in quantiles:
+            summary["q{:g}_{}".format(100 * q, column)] = percentiles[(column, q)]
+    return summary
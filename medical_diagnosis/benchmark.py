@@ -0,0 +1,245 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from itertools import cycle
+
+import numpy
+
+from medical_diagnosis.DoctorAgent import default_case_influencing
+from medical_diagnosis.Model import MedicalModel
+from medical_diagnosis.run import run_batch
+
+DEFAULT_DOCTORS = (3, 10, 30, 100, 300, 1000)
+DEFAULT_ARGS = (5, 50, 500)
+BENCHMARKS = ("init", "step", "calculate_committee", "default_case_influencing", "equilibrium")
+# Seconds that importing run.py may take, and the modules that a headless batch run must not import
+IMPORT_TIME_TARGET = 0.5
+HEAVY_MODULES = ("matplotlib", "tornado", "mesa.visualization", "medical_diagnosis.server")
+
+# Imports run.py in a fresh interpreter, and prints the seconds it took and the heavy modules it loaded
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import medical_diagnosis.run
+seconds = time.perf_counter() - start
+print(seconds)
+print(" ".join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+def make_model(n_doctors, n_args, seed=0):
+    """ Batch case model, as used by the sweep, with tracing off and no convergence check. """
+    return MedicalModel(N=n_doctors, n_init_arg=n_args, experiment_case="batch", seed=seed, trace_level="off",
+                        arg_weight_vector=numpy.ones((len(MedicalModel.LIST_OF_DISEASES), n_args)))
+
+
+def time_calls(func, min_time=0.2, max_calls=10000):
+    """
+    Calls ``func`` repeatedly, at least once and until ``min_time`` seconds or ``max_calls`` calls are reached.
+
+    Returns:
+        ``(calls, seconds)``
+    """
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or calls >= max_calls:
+            return calls, elapsed
+
+
+def peak_memory(func):
+    """
+    Returns:
+        Peak number of bytes allocated by python and numpy during one call of ``func``, measured with tracemalloc
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_function(name, n_doctors, n_args, min_time=0.2):
+    """
+    Times one of BENCHMARKS for a committee of ``n_doctors`` doctors and ``n_args`` arguments.
+
+    Returns:
+        dict with the benchmark, its parameters, the number of calls, the seconds they took, the calls per second and
+        the peak memory of one call
+    """
+    if name == "init":
+        func = lambda: make_model(n_doctors, n_args)
+    else:
+        model = make_model(n_doctors, n_args)
+        if name == "step":
+            func = model.step
+        elif name == "calculate_committee":
+            func = model.calculate_committee
+        elif name == "equilibrium":
+            func = model.equilibrium
+        elif name == "default_case_influencing":
+            speakers = cycle(model.schedule.agents)
+            func = lambda: default_case_influencing(next(speakers))
+        else:
+            raise ValueError("Unknown benchmark: {}".format(name))
+    calls, seconds = time_calls(func, min_time)
+    return {"benchmark": name, "n_doctors": n_doctors, "n_args": n_args, "calls": calls, "seconds": seconds,
+            "per_sec": calls / seconds, "peak_memory_bytes": peak_memory(func)}
+
+
+def benchmark_sweep(n_doctors, n_batch_iter, ensemble=False, workers=1, convergence="belief_delta"):
+    """
+    Times the batch sweep of run.py, over committees of 1 to n_doctors - 1 doctors. With several workers the peak
+    memory only covers the main process.
+    """
+    def func():
+        run_batch(n_doctors, 5, n_batch_iter, ensemble=ensemble, workers=workers, seed=0, convergence=convergence)
+
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    runs = (n_doctors - 1) * n_batch_iter
+    return {"benchmark": "ensemble_sweep" if ensemble else "sweep", "n_doctors": n_doctors, "n_args": 5,
+            "iterations": n_batch_iter, "workers": workers, "convergence": convergence, "runs": runs,
+            "seconds": seconds, "runs_per_sec": runs / seconds, "peak_memory_bytes": peak_memory(func)}
+
+
+def benchmark_import(repeat=5, target=IMPORT_TIME_TARGET):
+    """
+    Times the import of run.py, as done when the command starts, in ``repeat`` fresh interpreters.
+
+    Returns:
+        dict with the best time over the repetitions, whether it is within ``target`` seconds and the heavy modules
+        (HEAVY_MODULES) that the import loaded
+    """
+    script = IMPORT_SCRIPT.format(heavy=HEAVY_MODULES)
+    times = []
+    loaded = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", script], stdout=subprocess.PIPE, check=True,
+                                universal_newlines=True).stdout.split("\n")
+        times.append(float(output[0]))
+        loaded = output[1].split()
+    return {"benchmark": "import", "repeat": repeat, "seconds": min(times), "target_seconds": target,
+            "within_target": min(times) <= target and not loaded, "heavy_modules": loaded}
+
+
+def environment():
+    """ Where the benchmark was run, so that results of different commits and machines can be told apart. """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "date": datetime.now().isoformat(), "python": sys.version.split()[0],
+            "numpy": numpy.__version__, "platform": platform.platform(), "processor": platform.processor()}
+
+
+def run_benchmarks(doctors=DEFAULT_DOCTORS, n_args=DEFAULT_ARGS, benchmarks=BENCHMARKS, min_time=0.2,
+                   sweep_doctors=10, sweep_iter=5, workers=1, max_cost=1e9, verbose=True):
+    """
+    Runs every benchmark over the grid of committee sizes and numbers of arguments, plus the batch sweeps.
+
+    Args:
+        max_cost (float): Combinations where N * N * n_args is larger than this are skipped, as a single step of
+            the all-to-all committee would take too long
+
+    Returns:
+        dict with the environment and the list of results
+    """
+    results = []
+
+    def add(result):
+        results.append(result)
+        if verbose:
+            rate = result["per_sec"] if "per_sec" in result else result["runs_per_sec"]
+            print("{:<26} N={:<5} args={:<4} {:>12.1f}/s  peak {:>8.1f} KiB".format(
+                result["benchmark"], result["n_doctors"], result["n_args"], rate,
+                result["peak_memory_bytes"] / 1024))
+
+    for name in benchmarks:
+        for n_doctors in doctors:
+            for args in n_args:
+                if n_doctors * n_doctors * args <= max_cost:
+                    add(benchmark_function(name, n_doctors, args, min_time))
+    if sweep_doctors:
+        add(benchmark_sweep(sweep_doctors, sweep_iter, workers=workers))
+        add(benchmark_sweep(sweep_doctors, sweep_iter, ensemble=True))
+    return {"environment": environment(), "results": results}
+
+
+def compare(old, new):
+    """
+    Prints the speedup of every benchmark in ``new`` with respect to the same benchmark in ``old``, both as returned
+    by run_benchmarks (or loaded from their JSON files).
+    """
+    def key(result):
+        return result["benchmark"], result["n_doctors"], result["n_args"]
+
+    def rate(result):
+        return result["per_sec"] if "per_sec" in result else result["runs_per_sec"]
+
+    old_results = {key(result): result for result in old["results"]}
+    print("Speedup of {} with respect to {}".format(new["environment"]["commit"], old["environment"]["commit"]))
+    for result in new["results"]:
+        if key(result) in old_results:
+            print("{:<26} N={:<5} args={:<4} x{:.2f}".format(*key(result),
+                                                             rate(result) / rate(old_results[key(result)])))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmarks the model and the batch sweep')
+    parser.add_argument('--doctors', type=int, nargs='+', default=list(DEFAULT_DOCTORS),
+                        help='Committee sizes to benchmark.')
+    parser.add_argument('--n_args', type=int, nargs='+', default=list(DEFAULT_ARGS),
+                        help='Numbers of arguments to benchmark.')
+    parser.add_argument('--benchmarks', type=str, nargs='+', default=list(BENCHMARKS), choices=list(BENCHMARKS),
+                        help='Functions to benchmark.')
+    parser.add_argument('--min_time', type=float, default=0.2,
+                        help='Minimum time spent timing each benchmark, in seconds.')
+    parser.add_argument('--max_cost', type=float, default=1e9,
+                        help='Skip the combinations where N * N * n_args is larger than this.')
+    parser.add_argument('--sweep_doctors', type=int, default=10,
+                        help='n_doctors of the benchmarked batch sweep. 0 skips it.')
+    parser.add_argument('--sweep_iter', type=int, default=5,
+                        help='Number of iterations of the benchmarked batch sweep.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes of the benchmarked batch sweep.')
+    parser.add_argument('--import_repeat', type=int, default=5,
+                        help='Number of fresh interpreters in which the import of run.py is timed. 0 skips it.')
+    parser.add_argument('--import_target', type=float, default=IMPORT_TIME_TARGET,
+                        help='Seconds that the import of run.py may take.')
+    parser.add_argument('--output', type=str, default=None,
+                        help='JSON file where the results are written.')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='JSON file of a previous benchmark to compare with.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    report = run_benchmarks(args.doctors, args.n_args, args.benchmarks, args.min_time, args.sweep_doctors,
+                            args.sweep_iter, args.workers, args.max_cost)
+    if args.import_repeat:
+        import_result = benchmark_import(args.import_repeat, args.import_target)
+        report["import"] = import_result
+        print("{:<26} {:.3f} s (target {:.3f} s){}".format(
+            "import run.py", import_result["seconds"], args.import_target,
+            ", loads " + " ".join(import_result["heavy_modules"]) if import_result["heavy_modules"] else ""))
+        if not import_result["within_target"]:
+            print("The import of run.py is over its target")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+from functools import lru_cache
+
+import numpy
+
+CACHE_FILE = "cache.sqlite"
+# Modules whose code determines the result of a run. Any change to them gives a new code version, so results
+# computed by older code are never returned. The modules of the model class and of the reporters are hashed as well
+# (see module_version), so reporters defined elsewhere are covered too
+MODEL_MODULES = ("Model.py", "DoctorAgent.py", "initialisations.py", "topology.py", "equilibrium.py",
+                 "datacollection.py", "profiling.py", "trace.py", "sweep.py")
+
+
+def code_version():
+    """
+    Returns:
+        Hash of the source of MODEL_MODULES
+    """
+    digest = hashlib.sha256()
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in MODEL_MODULES:
+        with open(os.path.join(package_dir, name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+@lru_cache(maxsize=None)
+def module_version(module_name):
+    """
+    Returns:
+        Hash of the source of the module ``module_name``, or None if it has no source file
+    """
+    path = getattr(sys.modules.get(module_name), "__file__", None)
+    if path is None:
+        return None
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+def callable_module(func):
+    """ Name of the module defining ``func``, looking through functools.partial. """
+    while hasattr(func, "func"):
+        func = func.func
+    return getattr(func, "__module__", None)
+
+
+def canonical(value):
+    """
+    Converts a parameter value to something json can serialise in a stable way: numpy arrays become lists and dicts
+    are sorted by key. Anything else json does not know is represented by its repr.
+    """
+    if isinstance(value, dict):
+        return {str(key): canonical(value[key]) for key in sorted(value, key=str)}
+    if isinstance(value, (list, tuple, numpy.ndarray)):
+        return [canonical(item) for item in value]
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
+
+
+def _to_json(value):
+    if isinstance(value, numpy.generic):
+        return value.item()
+    raise TypeError("{} is not JSON serializable".format(type(value).__name__))
+
+
+class SweepCache:
+    """
+        Persistent cache of the reports of single sweep runs, stored in a SQLite file.
+
+        A run is identified by a hash of the model class, its parameters, max_steps, its seed, the names of the
+        reporters and the code version, so a sweep that is widened with more values or iterations (with the same root
+        seed) only has to compute the new runs. When the cache grows beyond ``max_bytes`` the least recently used
+        entries are evicted.
+
+        Attributes:
+            hits (int): Number of runs found in the cache since it was opened
+            misses (int): Number of runs that had to be computed
+            evictions (int): Number of entries evicted since it was opened
+    """
+
+    def __init__(self, directory, max_bytes=256 * 2 ** 20, version=None):
+        """
+        Args:
+            directory (str): Directory of the cache, created if needed
+            max_bytes (int): Maximum total size of the stored reports
+            version (str): Code version tag. Defaults to code_version()
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.version = version if version is not None else code_version()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._db = sqlite3.connect(os.path.join(directory, CACHE_FILE))
+        self._db.execute("CREATE TABLE IF NOT EXISTS runs (key TEXT PRIMARY KEY, report TEXT NOT NULL, "
+                         "size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS runs_last_used ON runs (last_used)")
+        self._db.commit()
+
+    def key(self, model_cls, kwargs, max_steps, seed, model_reporters):
+        """
+        Args:
+            model_reporters (dict): Reporters of the run, keyed by column name
+
+        Returns:
+            Key of the run of ``model_cls(seed=seed, **kwargs)`` for ``max_steps`` steps
+        """
+        modules = {model_cls.__module__} | {callable_module(reporter) for reporter in model_reporters.values()}
+        description = {"model": model_cls.__module__ + "." + model_cls.__name__, "params": canonical(kwargs),
+                       "max_steps": max_steps, "seed": seed, "reporters": sorted(model_reporters),
+                       "version": self.version,
+                       "modules": {name: module_version(name) for name in sorted(modules, key=str) if name}}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def get_many(self, keys):
+        """
+        Looks up several runs at once, and marks the ones found as recently used.
+
+        Returns:
+            dict with the report of every key that is in the cache
+        """
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):  # Stay below SQLite's limit of query parameters
+            batch = keys[i:i + 500]
+            query = "SELECT key, report FROM runs WHERE key IN ({})".format(",".join("?" * len(batch)))
+            found.update((key, json.loads(report)) for key, report in self._db.execute(query, batch))
+        now = time.time()
+        self._db.executemany("UPDATE runs SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+        self._db.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        """
+        Stores the reports of several runs, then evicts the least recently used entries if the cache is too big.
+
+        Args:
+            items: ``(key, report)`` pairs
+        """
+        now = time.time()
+        rows = []
+        for key, report in items:
+            report = json.dumps(report, default=_to_json)
+            rows.append((key, report, len(report), now))
+        self._db.executemany("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)", rows)
+        self._evict()
+        self._db.commit()
+
+    def _evict(self):
+        excess = self.size_bytes - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in self._db.execute("SELECT key, size FROM runs ORDER BY last_used"):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._db.executemany("DELETE FROM runs WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    @property
+    def size_bytes(self):
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM runs").fetchone()[0]
+
+    @property
+    def n_entries(self):
+        return self._db.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    def report(self):
+        """
+        Returns:
+            Text with the hits and misses since the cache was opened, and its current size
+        """
+        lookups = self.hits + self.misses
+        hit_rate = 100. * self.hits / lookups if lookups else 0.
+        return "Sweep cache: {} hits, {} misses ({:.1f}% hit rate), {} evicted. {} runs stored, {:.2f} of {:.2f} " \
+               "MiB".format(self.hits, self.misses, hit_rate, self.evictions, self.n_entries,
+                            self.size_bytes / 2 ** 20, self.max_bytes / 2 ** 20)
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,156 @@
+import copy
+
+import numpy
+
+
+class ColumnarDataCollector:
+    """
+        Records the state of a :class:`MedicalModel` at every step in preallocated numpy buffers, one slice assignment
+        per buffer and step. It is a drop-in replacement for mesa's ``DataCollector`` as used by the model and the
+        visualisation modules: ``model_vars`` and the DataFrame views are only built when they are asked for.
+
+        Attributes:
+            argument_names (list): Names of the arguments, used as columns
+            disease_names (list): Names of the diseases, used as columns
+            n_records (int): Number of steps recorded so far
+    """
+
+    def __init__(self, n_agents, argument_names, disease_names, capacity=51, dtype=float):
+        """
+        Args:
+            n_agents (int): Number of doctors in the committee
+            argument_names (list): Names of the arguments
+            disease_names (list): Names of the diseases
+            capacity (int): Number of steps the buffers can hold before they have to grow, usually max_steps + 1
+            dtype: Float type of the recorded beliefs, the one of the model's belief matrix
+        """
+        self.argument_names = list(argument_names)
+        self.disease_names = list(disease_names)
+        self.n_records = 0
+        n_args = len(self.argument_names)
+        self._steps = numpy.empty(capacity, dtype=int)
+        self._beliefs = numpy.empty((capacity, n_agents, n_args), dtype=dtype)
+        self._avg_beliefs = numpy.empty((capacity, n_args), dtype=dtype)
+        self._probabilities = numpy.empty((capacity, len(self.disease_names)))
+        # Copy on write. A fork borrows the buffers of the collector it was forked from (_borrowed), and copies them
+        # before its first record. The collector that was forked (_lent) can keep appending, as its forks only see the
+        # records made before, but copies the buffers before recording over old records
+        self._borrowed = False
+        self._lent = False
+
+    def _own_buffers(self):
+        for name in ('_steps', '_beliefs', '_avg_beliefs', '_probabilities'):
+            setattr(self, name, getattr(self, name).copy())
+        self._borrowed = self._lent = False
+
+    def fork(self):
+        """
+        Returns:
+            Collector with the same history, which shares the buffers with this one until either of them would write
+            over the other's records
+        """
+        clone = copy.copy(self)
+        clone._borrowed = True
+        self._lent = True
+        return clone
+
+    def truncate(self, n_records=0):
+        """ Forgets the records after the first ``n_records``, so that the next steps are recorded over them. """
+        if self._lent and n_records < self.n_records:
+            self._own_buffers()
+        self.n_records = min(n_records, self.n_records)
+
+    def _grow(self):
+        capacity = 2 * len(self._steps)
+        for name in ('_steps', '_beliefs', '_avg_beliefs', '_probabilities'):
+            old = getattr(self, name)
+            new = numpy.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def collect(self, model):
+        """ Records the current state of the model. """
+        if self.n_records == len(self._steps):
+            self._grow()  # New buffers, which nobody shares
+            self._borrowed = self._lent = False
+        elif self._borrowed:
+            self._own_buffers()
+        i = self.n_records
+        self._steps[i] = model.schedule.steps
+        self._beliefs[i] = model.belief_matrix
+        self._avg_beliefs[i] = model.belief_matrix.mean(axis=0)
+        self._probabilities[i] = model.diagnosis_probabilities
+        self.n_records += 1
+
+    @property
+    def steps(self):
+        return self._steps[:self.n_records]
+
+    @property
+    def beliefs(self):
+        """ (n_records, n_agents, n_args) view of the recorded belief arrays. """
+        return self._beliefs[:self.n_records]
+
+    @property
+    def avg_beliefs(self):
+        """ (n_records, n_args) view of the average belief in every argument. """
+        return self._avg_beliefs[:self.n_records]
+
+    @property
+    def probabilities(self):
+        """ (n_records, n_diseases) view of the committee's diagnosis probabilities. """
+        return self._probabilities[:self.n_records]
+
+    @property
+    def model_vars(self):
+        """
+        Model-level variables keyed by name, like mesa's ``DataCollector.model_vars``. The values are views into the
+        buffers, so building the dict is cheap.
+        """
+        model_vars = {}
+        for i, name in enumerate(self.argument_names):
+            model_vars[name] = self.avg_beliefs[:, i]
+        for i, name in enumerate(self.disease_names):
+            model_vars[name] = self.probabilities[:, i]
+        return model_vars
+
+    def get_model_vars_dataframe(self):
+        """
+        Returns:
+            DataFrame with one column per model variable, and one row per recorded step
+        """
+        import pandas  # Imported here, as the model itself does not need pandas
+
+        return pandas.DataFrame(self.model_vars)
+
+    def get_agent_vars_dataframe(self):
+        """
+        Returns:
+            DataFrame with the belief of every doctor in every argument, indexed by Step and AgentID
+        """
+        import pandas
+
+        n_records, n_agents, n_args = self.beliefs.shape
+        index = pandas.MultiIndex.from_arrays([numpy.repeat(self.steps, n_agents),
+                                               numpy.tile(numpy.arange(n_agents), n_records)],
+                                              names=["Step", "AgentID"])
+        return pandas.DataFrame(self.beliefs.reshape(n_records * n_agents, n_args), index=index,
+                                columns=self.argument_names)
+
+    def to_npz(self, path):
+        """ Saves the recorded buffers to a compressed ``.npz`` file. """
+        numpy.savez_compressed(path, steps=self.steps, beliefs=self.beliefs, avg_beliefs=self.avg_beliefs,
+                               probabilities=self.probabilities, argument_names=self.argument_names,
+                               disease_names=self.disease_names)
+
+    def to_parquet(self, path):
+        """
+        Saves the agent-level variables, together with the model-level variables of the same step, to a Parquet file.
+        Needs one of the Parquet engines supported by pandas (pyarrow or fastparquet).
+        """
+        import pandas
+
+        model_vars = {"avg_" + name: self.avg_beliefs[:, i] for i, name in enumerate(self.argument_names)}
+        model_vars.update({name: self.probabilities[:, i] for i, name in enumerate(self.disease_names)})
+        model_vars = pandas.DataFrame(model_vars, index=pandas.Index(self.steps, name="Step"))
+        self.get_agent_vars_dataframe().join(model_vars, on="Step").reset_index().to_parquet(path)
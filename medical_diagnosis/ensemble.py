@@ -0,0 +1,281 @@
+import numpy
+import pandas
+
+from medical_diagnosis.DoctorAgent import transform_convincing_value
+from medical_diagnosis.initialisations import get_scenario, sample_committees
+from medical_diagnosis.Model import MedicalModel, make_weight_matrix
+from medical_diagnosis.sweep import cell_seed, resolve_root_seed
+
+
+def softmax_rows(x):
+    """
+    Softmax over the last axis, so each row of ``x`` is turned into a probability vector.
+    """
+    e = numpy.exp(x - numpy.max(x, axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def ensemble_influencing(conv_tensor, speakers, eta_factors, workspace, alpha=0.25):
+    """
+    Batched version of :func:`medical_diagnosis.DoctorAgent.influence_colleagues`. Every committee of the ensemble
+    has one speaker, and that speaker influences all of its colleagues at the same time.
+
+    The rule is evaluated directly on convincing values and multiplied by the sign of the speaker's value
+    :math:`s=sign(A')`, where it reads: a colleague can be influenced when :math:`sB' < sA'`, and then moves by
+    :math:`\eta sA'` but never past :math:`sA'`. The speaker's own row is left untouched by construction, as its gap
+    to itself is zero.
+
+    Args:
+        conv_tensor (numpy.ndarray): (n_doctors, n_args, runs) convincing values of every committee. It is updated in
+            place
+        speakers (numpy.ndarray): (runs,) index of the doctor that speaks in each committee
+        eta_factors (tuple): ``(influence, 1 - stubbornness)``, both (n_doctors, runs) arrays
+        workspace (tuple): Two float and one boolean array shaped like ``conv_tensor``, reused between calls to avoid
+            allocating temporaries
+        alpha (float): Constant parameter to better simulate a real speed for convincing other people
+
+    Returns:
+        None
+    """
+    influence, receptiveness = eta_factors
+    gap, delta, can_influence = workspace
+    runs = numpy.arange(conv_tensor.shape[2])
+    agent_conv = conv_tensor[speakers, :, runs].T  # A', (n_args, runs)
+    signs_agent = numpy.sign(agent_conv)
+    agent_level = numpy.abs(agent_conv)
+    # Can't influence others with higher beliefs in that argument
+    numpy.multiply(signs_agent, conv_tensor, out=gap)
+    numpy.subtract(agent_level, gap, out=gap)
+    numpy.greater(gap, 0, out=can_influence)
+    eta = influence[speakers, runs] * receptiveness * alpha  # Regulates the influence, (n_doctors, runs)
+    numpy.multiply(eta[:, None, :], agent_level, out=delta)
+    # An agent can only influence up to the same level of uncertainty that he has
+    numpy.minimum(delta, gap, out=delta)
+    numpy.multiply(delta, can_influence, out=delta)
+    numpy.multiply(delta, signs_agent, out=delta)
+    numpy.add(conv_tensor, delta, out=conv_tensor)
+
+
+class MedicalEnsemble:
+    """
+        Many independent committees of the batch case, stepped together.
+
+        Instead of one :class:`MedicalModel` per run, the beliefs of all the committees are held in a single tensor.
+        Every step each committee gets its own random speaking order, like ``RandomActivation`` does, and the speakers
+        of all committees influence their colleagues at the same time.
+
+        The tensor is stored doctor-major, as (n_doctors, n_args, runs) convincing values, so that the per-committee
+        quantities broadcast along the contiguous last axis. ``belief_tensor`` gives the usual (runs, n_doctors,
+        n_args) view of the beliefs.
+
+        Attributes:
+            conv_tensor (numpy.ndarray): (n_doctors, n_args, runs) convincing values of all the doctors
+            influence (numpy.ndarray): (n_doctors, runs) influence of all the doctors
+            stubbornness (numpy.ndarray): (n_doctors, runs) stubbornness of all the doctors
+            diagnosis_probabilities (numpy.ndarray): (runs, n_diseases) committee probability of each disease
+            final_decision (numpy.ndarray): (runs,) name of the disease chosen by each committee
+            converged_step (numpy.ndarray): (runs,) step at which each committee converged, or -1. Only tracked with a
+                convergence_tol
+    """
+
+    def __init__(self, runs, N=3, n_init_arg=5, sigma=0.25, arg_weight_vector=None, seed=None, diseases=None,
+                 scenario=None, influence_mu=0.5, stubbornness_mu=0.5, groups=None, convergence_tol=None,
+                 dtype=float, initial_state=None):
+        """
+        Args:
+            sigma: Standard deviation of the initial beliefs. A (runs,) array gives every committee its own
+            arg_weight_vector: As in MedicalModel, or a (runs, n_diseases, n_args) array with a weight matrix per
+                committee
+            scenario: Experiment case (1 to 5 or default, see initialisations.SCENARIOS) the committees start from,
+                or a list of roles. None draws them as the batch case does
+            influence_mu: Mean influence of the doctors, a number or a (runs,) array. Not used with a scenario
+            stubbornness_mu: Mean stubbornness of the doctors, a number or a (runs,) array. Not used with a scenario
+            groups (numpy.ndarray): (runs,) group of every committee. Committees of the same group share their random
+                draws and speaking orders (common random numbers), so they only differ by their parameters. Not
+                supported with a scenario
+            convergence_tol (float): If given, ``converged_step`` records the first step in which no belief of the
+                committee changed more than this, as the belief_delta criterion of MedicalModel
+            dtype: Float type of the convincing values, influence and stubbornness. ``numpy.float32`` halves the
+                memory of very large ensembles. The random draws, and so the committees, are the same with either
+                type, and the committee sums are accumulated in float64
+            initial_state (tuple): ``(beliefs, influence, stubbornness)`` of every committee, shaped (runs, N, n_args),
+                (runs, N) and (runs, N) as sample_committees returns them, instead of drawing them. Committees with
+                different scenarios can then be stepped together
+        """
+        self.runs = runs
+        self.num_agents = N
+        self.n_initial_arguments = n_init_arg
+        self.diseases = list(diseases) if diseases is not None else list(MedicalModel.LIST_OF_DISEASES.values())
+        if numpy.ndim(arg_weight_vector) == 3:
+            self.weight_matrix = numpy.asarray(arg_weight_vector, dtype=float)
+            if self.weight_matrix.shape != (runs, len(self.diseases), n_init_arg):
+                raise ValueError("The weight matrices must have shape {}, got {}".format(
+                    (runs, len(self.diseases), n_init_arg), self.weight_matrix.shape))
+        else:
+            self.weight_matrix = make_weight_matrix(arg_weight_vector, self.diseases, n_init_arg)
+        self.rng = numpy.random.default_rng(seed)
+        self.steps = 0
+        self.groups = None if groups is None else numpy.asarray(groups)
+        self.n_groups = None if groups is None else int(self.groups.max()) + 1
+        self.convergence_tol = convergence_tol
+        self.converged_step = numpy.full(runs, -1)
+
+        if initial_state is not None:
+            if scenario is not None or self.groups is not None:
+                raise ValueError("initial_state is not supported with a scenario or groups")
+            belief_tensor, influence, stubbornness = (numpy.asarray(x, dtype=float) for x in initial_state)
+            if belief_tensor.shape != (runs, N, n_init_arg):
+                raise ValueError("The initial beliefs must have shape {}, got {}".format((runs, N, n_init_arg),
+                                                                                         belief_tensor.shape))
+        elif scenario is None:
+            # Same distributions as random_belief_array and random_influence, sampled for every doctor of every run
+            sigma = numpy.reshape(sigma, (-1, 1, 1))
+            influence_mu = numpy.reshape(influence_mu, (-1, 1))
+            stubbornness_mu = numpy.reshape(stubbornness_mu, (-1, 1))
+            if self.groups is None:
+                belief_tensor = self.rng.normal(0.5, sigma, (runs, N, n_init_arg))
+                influence = self.rng.normal(influence_mu, 0.25, (runs, N))
+                stubbornness = self.rng.normal(stubbornness_mu, 0.25, (runs, N))
+            else:
+                belief_tensor = 0.5 + sigma * self.rng.standard_normal((self.n_groups, N, n_init_arg))[self.groups]
+                influence = influence_mu + 0.25 * self.rng.standard_normal((self.n_groups, N))[self.groups]
+                stubbornness = stubbornness_mu + 0.25 * self.rng.standard_normal((self.n_groups, N))[self.groups]
+        elif self.groups is not None:
+            raise ValueError("groups are not supported with a scenario")
+        else:
+            roles = get_scenario(scenario) if isinstance(scenario, (int, str)) else scenario
+            belief_tensor, influence, stubbornness = sample_committees(roles, runs, N, n_init_arg, rng=self.rng)
+        self.conv_tensor = numpy.ascontiguousarray(transform_convincing_value(belief_tensor).transpose(1, 2, 0),
+                                                   dtype=dtype)
+        self.influence = numpy.ascontiguousarray(influence.T, dtype=dtype)
+        self.stubbornness = numpy.ascontiguousarray(stubbornness.T, dtype=dtype)
+        self._workspace = (numpy.empty_like(self.conv_tensor), numpy.empty_like(self.conv_tensor),
+                           numpy.empty(self.conv_tensor.shape, dtype=bool))
+
+        self.diagnosis_probabilities = numpy.zeros((runs, len(self.diseases)))
+        self.final_decision = numpy.empty(runs, dtype=object)
+        self.calculate_committee()
+
+    @property
+    def belief_tensor(self):
+        return transform_convincing_value(self.conv_tensor, inv=True).transpose(2, 0, 1)
+
+    def step(self):
+        """
+            Advance every committee by one argumentation round.
+        """
+        self._argue()
+        self.calculate_committee()
+
+    def _argue(self):
+        if self.groups is None:
+            order = numpy.argsort(self.rng.random((self.num_agents, self.runs)), axis=0)
+        else:
+            order = numpy.argsort(self.rng.random((self.num_agents, self.n_groups)), axis=0)[:, self.groups]
+        previous = self.conv_tensor.copy() if self.convergence_tol is not None else None
+        eta_factors = (self.influence, 1 - self.stubbornness)
+        for turn in range(self.num_agents):
+            ensemble_influencing(self.conv_tensor, order[turn], eta_factors, self._workspace)
+        self.steps += 1
+        if previous is not None:
+            # Beliefs are half the convincing values
+            change = numpy.abs(self.conv_tensor - previous).max(axis=(0, 1)) / 2
+            newly_converged = (change < self.convergence_tol) & (self.converged_step < 0)
+            self.converged_step[newly_converged] = self.steps - 1
+
+    def run(self, max_steps=50, stop_when_converged=False):
+        """
+        Steps the committees up to ``max_steps``. With ``stop_when_converged`` (which needs a convergence_tol), it
+        stops as soon as every committee has converged, as MedicalModel does with the belief_delta criterion.
+        """
+        if stop_when_converged and self.convergence_tol is None:
+            raise ValueError("stop_when_converged needs a convergence_tol")
+        # The committee decision only depends on the beliefs, so it is computed once at the end
+        while self.steps < max_steps:
+            self._argue()
+            if stop_when_converged and numpy.all(self.converged_step >= 0):
+                break
+        self.calculate_committee()
+
+    def calculate_committee(self):
+        # Same aggregation as MedicalModel.calculate_committee, for all the committees at once
+        committee_sum = self.conv_tensor.sum(axis=0, dtype=float).T
+        committee_sum = transform_convincing_value(committee_sum, inv=True)
+        probabilities_committee = softmax_rows(committee_sum)
+        if self.weight_matrix.ndim == 3:
+            disease_scores = numpy.einsum('rda,ra->rd', self.weight_matrix, probabilities_committee)
+        else:
+            disease_scores = probabilities_committee @ self.weight_matrix.T
+        disease_scores /= probabilities_committee.sum(axis=1, keepdims=True)
+        self.diagnosis_probabilities = softmax_rows(disease_scores)
+        # Ties go to the last disease, as in MedicalModel
+        n_diseases = len(self.diseases)
+        decision_idx = n_diseases - 1 - numpy.argmax(disease_scores[:, ::-1], axis=1)
+        self.final_decision = numpy.asarray(self.diseases, dtype=object)[decision_idx]
+
+    def get_model_vars_dataframe(self):
+        """
+        Returns:
+            DataFrame with one row per committee and the same columns as the batch run collector
+            (``Final_decision`` and one probability column per disease)
+        """
+        data = {"Final_decision": self.final_decision}
+        for i, disease in enumerate(self.diseases):
+            data[disease] = self.diagnosis_probabilities[:, i]
+        return pandas.DataFrame(data)
+
+
+def run_ensemble_batch(n_doctors_range, iterations, n_init_arg=5, sigma=0.25, arg_weight_vector=None,
+                       max_steps=50, seed=None, sink=None, diseases=None, scenario=None, dtype=float):
+    """
+    Replacement for the ``BatchRunner`` sweep over the number of doctors. For each N, ``iterations`` committees are
+    simulated as one :class:`MedicalEnsemble`.
+
+    Args:
+        n_doctors_range: Values of N to sweep over
+        iterations (int): Number of committees per value of N
+        n_init_arg (int): Number of initial arguments
+        sigma (float): Standard deviation of the initial belief arrays
+        arg_weight_vector: Relevance of every argument for every disease, as a dict or a (n_diseases, n_args) matrix
+        max_steps (int): Number of argumentation rounds
+        seed (int): Root seed, so that the whole sweep can be reproduced
+        sink (ResultSink): If given, the results of every N are written to it as soon as they are ready, and the
+            values of N it already holds are skipped
+        diseases (list): Names of the diseases. Defaults to MedicalModel.LIST_OF_DISEASES
+        scenario: Experiment case the committees start from, see MedicalEnsemble. None is the batch case
+        dtype: Float type of the ensembles, see MedicalEnsemble
+
+    Returns:
+        DataFrame with the columns ``N``, ``Run``, ``Final_decision`` and one column per disease, like
+        ``BatchRunner.get_model_vars_dataframe``. With a sink nothing is kept in memory and None is returned, the
+        results are read back from the sink
+    """
+    seed = resolve_root_seed(seed, sink)
+    if sink is not None:
+        description = {"seed": seed, "ensemble": True, "variable_params": ["N"], "iterations": iterations,
+                       "max_steps": max_steps, "n_init_arg": n_init_arg, "sigma": sigma,
+                       "arg_weight_vector": repr(arg_weight_vector), "diseases": repr(diseases),
+                       "scenario": repr(scenario)}
+        if numpy.dtype(dtype) != numpy.float64:  # So that float64 sweeps stored before still resume
+            description["dtype"] = numpy.dtype(dtype).name
+        sink.open_sweep(description)
+    frames = []
+    for position, n_doctors in enumerate(n_doctors_range):
+        ensemble_seed = cell_seed(seed, "ensemble", n_doctors)
+        cells = [(n_doctors, iteration, ensemble_seed) for iteration in range(iterations)]
+        if sink is not None and all(sink.is_done(cell) for cell in cells):
+            continue
+        ensemble = MedicalEnsemble(iterations, N=n_doctors, n_init_arg=n_init_arg, sigma=sigma,
+                                   arg_weight_vector=arg_weight_vector, seed=ensemble_seed, diseases=diseases,
+                                   scenario=scenario, dtype=dtype)
+        ensemble.run(max_steps)
+        df = ensemble.get_model_vars_dataframe()
+        df.insert(0, "N", n_doctors)
+        df.insert(1, "Run", position * iterations + numpy.arange(iterations))
+        if sink is not None:
+            sink.write_chunk(df, cells)
+        else:
+            frames.append(df)
+    if sink is not None:
+        return None
+    return pandas.concat(frames, ignore_index=True)
@@ -0,0 +1,100 @@
+import numpy
+
+from medical_diagnosis.DoctorAgent import transform_convincing_value
+
+
+def averaged_round(conv_matrix, influence, receptiveness, mask=None, alpha=0.25, block_elements=2 ** 22):
+    """
+    One argumentation round in which every doctor speaks to the committee as it was at the start of the round, instead
+    of one after the other in a random order. This is the speaking order averaged out of the dynamics of
+    :func:`medical_diagnosis.DoctorAgent.influence_colleagues`: each colleague moves by the sum of what every speaker
+    would move it, and never past the most extreme of the speakers that pull it.
+
+    Args:
+        conv_matrix (numpy.ndarray): (n_doctors, n_args) convincing values of the committee
+        influence (numpy.ndarray): Influence of every doctor
+        receptiveness (numpy.ndarray): ``1 - stubbornness`` of every doctor
+        mask (numpy.ndarray): (n_doctors, n_doctors) 0/1 matrix, whose entry (i, j) says if doctor i can influence
+            doctor j. By default everyone influences everyone
+        alpha (float): Constant parameter to better simulate a real speed for convincing other people
+        block_elements (int): The speakers are processed in blocks of at most this many (speaker, colleague,
+            argument) entries, to bound the memory used by large committees
+
+    Returns:
+        numpy.ndarray with the convincing values after the round
+    """
+    n_doctors, n_args = conv_matrix.shape
+    toward = numpy.zeros_like(conv_matrix)
+    away = numpy.zeros_like(conv_matrix)
+    lower = conv_matrix.copy()
+    upper = conv_matrix.copy()
+    block = max(1, block_elements // max(1, n_doctors * n_args))
+    for start in range(0, n_doctors, block):
+        speakers = conv_matrix[start:start + block]  # A', (block, n_args)
+        signs = numpy.sign(speakers)[:, None, :]
+        # Can't influence others with higher beliefs in that argument. The speaker's own gap is zero
+        gap = signs * (speakers[:, None, :] - conv_matrix[None, :, :])
+        eta = alpha * influence[start:start + block, None] * receptiveness[None, :]
+        if mask is not None:
+            eta = eta * mask[start:start + block]
+        # An agent can only influence up to the same level of uncertainty that he has
+        step = numpy.minimum(eta[:, :, None] * numpy.abs(speakers)[:, None, :], gap)
+        step = numpy.where(gap > 0, step, 0.) * signs
+        # A negative influence (possible with the random influences of the batch case) pushes colleagues away from
+        # the speaker, and that move has no limit
+        pushes = (eta < 0)[:, :, None]
+        away += numpy.where(pushes, step, 0.).sum(axis=0)
+        step = numpy.where(pushes, 0., step)
+        toward += step.sum(axis=0)
+        moved = step != 0
+        upper = numpy.maximum(upper, numpy.where(moved, speakers[:, None, :], -numpy.inf).max(axis=0))
+        lower = numpy.minimum(lower, numpy.where(moved, speakers[:, None, :], numpy.inf).min(axis=0))
+    return numpy.clip(conv_matrix + toward, lower, upper) + away
+
+
+def solve_equilibrium(belief_matrix, influence, stubbornness, mask=None, alpha=0.25, tol=1e-10, max_iter=1000):
+    """
+    Finds where the averaged argumentation (see averaged_round) ends up, by iterating the rounds until they stop
+    changing the committee. Every belief moves by a fixed step until it is clipped at the speaker's value, so the
+    rounds are piecewise linear and usually reach their fixed point exactly after a few iterations. They are not a
+    contraction, which is why they are not extrapolated: an accelerated step can jump to another piece and settle on
+    a consensus the committee never reaches.
+
+    Args:
+        belief_matrix (numpy.ndarray): (n_doctors, n_args) initial beliefs
+        influence (numpy.ndarray): Influence of every doctor
+        stubbornness (numpy.ndarray): Stubbornness of every doctor
+        mask (numpy.ndarray): Who can influence whom, see averaged_round
+        alpha (float): Constant parameter to better simulate a real speed for convincing other people
+        tol (float): The iteration stops once no belief changes more than this in a round
+        max_iter (int): Maximum number of rounds
+
+    Returns:
+        ``(beliefs, residual, iterations)``: (n_doctors, n_args) belief matrix after the last round, largest change of
+        a belief in that round, and number of rounds evaluated. The residual is 0 when an exact fixed point was
+        reached, and infinite when the rounds do not settle, in which case the beliefs are not a limiting state. That
+        happens when negative influences make the committee diverge, and in some large committees whose summed moves
+        overshoot and make the rounds alternate between two states. The iteration stops as soon as it detects such a
+        cycle
+    """
+    shape = numpy.shape(belief_matrix)
+    influence = numpy.asarray(influence, dtype=float)
+    receptiveness = 1 - numpy.asarray(stubbornness, dtype=float)
+    x = transform_convincing_value(numpy.asarray(belief_matrix, dtype=float))
+    residual = numpy.inf
+    iterations = 0
+    previous_x = None
+    while iterations < max_iter:
+        new_x = averaged_round(x, influence, receptiveness, mask, alpha)
+        iterations += 1
+        # In beliefs, which are half the convincing values
+        change = numpy.max(numpy.abs(new_x - x)) / 2 if x.size else 0.
+        if change <= tol:
+            residual = float(change)
+            x = new_x
+            break
+        if not numpy.isfinite(change) or (previous_x is not None
+                                          and numpy.max(numpy.abs(new_x - previous_x)) / 2 <= tol):
+            break  # Diverging, or back where it was two rounds ago
+        previous_x, x = x, new_x
+    return transform_convincing_value(x.reshape(shape), inv=True), residual, iterations
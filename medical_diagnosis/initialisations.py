@@ -1,151 +1,206 @@
-import random
-
-
-def initialisations(nb_doctors, case, n_args):
-    '''
-    We use four standard cases here, namely following cases:
-
-    Case 1: One doctor has strong influence, stubbornness and higher belief in certain conclusion.
-    Other two doctors uncertain about both conclusions and have weak influence and stubbornness.
-    Expectation: committee reaches conclusion early, less number of argumentation steps. As decision
-    is dominated by this doctor.
-
-    Case 2: Two doctor strong influence and stubbornness and third uncertain doctor. Both doctors
-    believe in opposite conclusion. Bipolar committee. Expectation: both try and influence the third doctor,
-    decision from committee depends on how well they can influence the third doctor.
-
-    Case 3: All three doctors with very weak influence and stubbornness and uncertain belief arrays towards
-    both the conclusions. Expectation: more rounds of arguments needed to finally reach a conclusion.
-    The increase should be significant from all the previous cases.
-
-    Case 4: All three doctors with very strong influence and stubbornness and uncertain belief arrays
-    towards both conclusion. Expectation: more rounds of arguments needed to finally reach a conclusion.
-    Similar to case 3.
-
-    Case 5: All three doctors with 0.5 stubbornness and influence. Uncertain belief arrays.
-    Will be an interesting observation.
-
-    :param nb_doctors: number of doctors in the committee
-    :param case: which case would you like to simulate
-    :param  n_args: number of arguments
-    :return: a list of belief arrays and list of stubborn influence value for each doctor
-    '''
-
-    strong_influence_set = (0.8, 0.9, 0.95)
-    strong_stubbornn_set = (0.8, 0.9, 0.95)
-    weak_influence_set = (0.1, 0.2, 0.3)
-    weak_stubbornn_set = (0.1, 0.2, 0.3)
-    uncertain_belief_set = (0.4, 0.5, 0.6)
-    strong_belief_set = (0.8, 0.9, 0.95)
-    weak_belief_set = (0, 0.1, 0.2, 0.3)
-    strong_belief_conclusion = [[0.90, 0.3, 0.90, 0.2, 0.4], [0.3, 0.90, 0.2, 0.80, 0.90]]
-
-    belief_array_list = []
-    influence_stubbornn_list = []
-
-    try:
-        converted_case = int(case)
-    except ValueError:
-        converted_case = case
-
-    if converted_case == 1:
-        '''
-        Case 1: One doctor has strong influence, stubbornness and higher belief in certain conclusion.
-        Other two doctors uncertain about both conclusions and have weak influence and stubbornness.
-        Expectation: committee reaches conclusion early, less number of argumentation steps. As decision
-        is dominated by this doctor.
-        '''
-        for doctor in range(nb_doctors):
-            if doctor == 0:
-                influence = random.choice(strong_influence_set)
-                stubbornn = random.choice(strong_stubbornn_set)
-                belief_array = random.choice(strong_belief_conclusion)
-                influence_stubbornn_list.append((influence, stubbornn))
-                belief_array_list.append(belief_array)
-            else:
-                influence = random.choice(weak_influence_set)
-                stubbornn = random.choice(weak_stubbornn_set)
-                belief_array = [random.choice(uncertain_belief_set) for x in range(n_args)]
-                influence_stubbornn_list.append((influence, stubbornn))
-                belief_array_list.append((belief_array))
-
-        return (belief_array_list, influence_stubbornn_list)
-
-    elif converted_case == 2:
-        '''
-        Case 2: Two doctor strong influence and stubbornness and third uncertain doctor. Both doctors
-        believe in opposite conclusion. Bipolar committee. Expectation: both try and influence the third doctor,
-        decision from committee depends on how well they can influence the third doctor.
-        '''
-        for doctor in range(nb_doctors):
-            if doctor == 0:
-                influence = random.choice(strong_influence_set)
-                stubbornn = random.choice(strong_stubbornn_set)
-                belief_array = strong_belief_conclusion[0]
-                influence_stubbornn_list.append((influence, stubbornn))
-                belief_array_list.append(belief_array)
-            if doctor == 1:
-                influence = random.choice(strong_influence_set)
-                stubbornn = random.choice(strong_stubbornn_set)
-                belief_array = strong_belief_conclusion[1]
-                influence_stubbornn_list.append((influence, stubbornn))
-                belief_array_list.append(belief_array)
-            elif doctor == 2:
-                influence = random.choice(weak_influence_set)
-                stubbornn = random.choice(weak_stubbornn_set)
-                belief_array = [random.choice(uncertain_belief_set) for x in range(n_args)]
-                influence_stubbornn_list.append((influence, stubbornn))
-                belief_array_list.append((belief_array))
-
-        return (belief_array_list, influence_stubbornn_list)
-
-    elif converted_case == 3:
-        '''
-        Case 3: All three doctors with very weak influence and stubbornness and uncertain belief arrays towards
-        both the conclusions. Expectation: more rounds of arguments needed to finally reach a conclusion.
-        The increase should be significant from all the previous cases.
-        '''
-        for doctor in range(nb_doctors):
-            influence = random.choice(weak_influence_set)
-            stubbornn = random.choice(weak_stubbornn_set)
-            belief_array = [random.choice(uncertain_belief_set) for x in range(n_args)]
-            influence_stubbornn_list.append((influence, stubbornn))
-            belief_array_list.append((belief_array))
-
-        return (belief_array_list, influence_stubbornn_list)
-
-    elif converted_case == 4:
-        '''
-        Case 4: All three doctors with very strong influence and stubbornness and uncertain belief arrays
-        towards both conclusion. Expectation: more rounds of arguments needed to finally reach a conclusion.
-        Similar to case 3.
-        '''
-        for doctor in range(nb_doctors):
-            influence = random.choice(strong_influence_set)
-            stubbornn = random.choice(strong_stubbornn_set)
-            belief_array = [random.choice(uncertain_belief_set) for x in range(n_args)]
-            influence_stubbornn_list.append((influence, stubbornn))
-            belief_array_list.append((belief_array))
-
-        return (belief_array_list, influence_stubbornn_list)
-
-    elif converted_case == 5:
-        '''
-        Case 5: All three doctors with 0.5 stubbornness and influence. Uncertain belief arrays.
-        Will be an interesting observation.
-        '''
-        for doctor in range(nb_doctors):
-            influence = 0.5
-            stubbornn = 0.5
-            belief_array = [random.choice(uncertain_belief_set) for x in range(n_args)]
-            influence_stubbornn_list.append((influence, stubbornn))
-            belief_array_list.append((belief_array))
-
-        return (belief_array_list, influence_stubbornn_list)
-
-    else:  # default case
-        belief_array = [[0.75, 0.30, 0.80, 0.50, 0.50],
-                        [0.80, 0.50, 0.70, 0.40, 0.50],
-                        [0.40, 0.70, 0.55, 0.75, 0.98]]
-        influence_stubbornn_list = [(0.5, 0.5), (0.5, 0.5), (0.75, 0.75)]
-        return belief_array, influence_stubbornn_list
+'''
+Scenarios describe how the committees of an experiment case start. A scenario is a list of doctor roles, and each role
+says how the belief array, the influence and the stubbornness of its doctors are drawn. sample_committees draws the
+initial state of any number of committees of any size at once, with one numpy call per role and quantity.
+
+We use five standard cases, plus the default one:
+
+Case 1: One doctor has strong influence, stubbornness and higher belief in certain conclusion.
+Other doctors uncertain about both conclusions and have weak influence and stubbornness.
+Expectation: committee reaches conclusion early, less number of argumentation steps. As decision
+is dominated by this doctor.
+
+Case 2: Two doctor strong influence and stubbornness and the rest uncertain doctors. Both doctors
+believe in opposite conclusion. Bipolar committee. Expectation: both try and influence the other doctors,
+decision from committee depends on how well they can influence them.
+
+Case 3: All doctors with very weak influence and stubbornness and uncertain belief arrays towards
+both the conclusions. Expectation: more rounds of arguments needed to finally reach a conclusion.
+The increase should be significant from all the previous cases.
+
+Case 4: All doctors with very strong influence and stubbornness and uncertain belief arrays
+towards both conclusion. Expectation: more rounds of arguments needed to finally reach a conclusion.
+Similar to case 3.
+
+Case 5: All doctors with 0.5 stubbornness and influence. Uncertain belief arrays.
+Will be an interesting observation.
+'''
+
+import numpy
+
+STRONG_INFLUENCE_SET = (0.8, 0.9, 0.95)
+STRONG_STUBBORNN_SET = (0.8, 0.9, 0.95)
+WEAK_INFLUENCE_SET = (0.1, 0.2, 0.3)
+WEAK_STUBBORNN_SET = (0.1, 0.2, 0.3)
+UNCERTAIN_BELIEF_SET = (0.4, 0.5, 0.6)
+STRONG_BELIEF_CONCLUSION = [[0.90, 0.3, 0.90, 0.2, 0.4], [0.3, 0.90, 0.2, 0.80, 0.90]]
+
+
+class Choice:
+    """ Every value is picked uniformly from a set of values. """
+
+    def __init__(self, values):
+        self.values = numpy.asarray(values, dtype=float)
+
+    def sample(self, rng, shape):
+        return rng.choice(self.values, size=shape)
+
+
+class Normal:
+    def __init__(self, mu=0.5, sigma=0.25):
+        self.mu = mu
+        self.sigma = sigma
+
+    def sample(self, rng, shape):
+        return rng.normal(self.mu, self.sigma, shape)
+
+
+class Uniform:
+    def __init__(self, low=0., high=1.):
+        self.low = low
+        self.high = high
+
+    def sample(self, rng, shape):
+        return rng.uniform(self.low, self.high, shape)
+
+
+class Constant:
+    def __init__(self, value):
+        self.value = value
+
+    def sample(self, rng, shape):
+        return numpy.full(shape, self.value, dtype=float)
+
+
+class Profiles:
+    """
+    Every belief array is one of a set of whole belief arrays (profiles), picked uniformly. Profiles shorter or longer
+    than the number of arguments are repeated or cut to fit it.
+    """
+
+    def __init__(self, profiles):
+        self.profiles = numpy.atleast_2d(numpy.asarray(profiles, dtype=float))
+
+    def sample(self, rng, shape):
+        *leading, n_args = shape
+        profiles = numpy.array([numpy.resize(profile, n_args) for profile in self.profiles])
+        return profiles[rng.integers(len(profiles), size=leading)]
+
+
+def as_distribution(spec):
+    """
+    Returns:
+        The distribution described by ``spec``: a number is a Constant, a tuple or list of numbers is a Choice, and
+        anything with a ``sample(rng, shape)`` method is used as is
+    """
+    if hasattr(spec, "sample"):
+        return spec
+    if isinstance(spec, (tuple, list)):
+        return Choice(spec)
+    return Constant(float(spec))
+
+
+class Role:
+    """
+        A kind of doctor in a scenario.
+
+        Args:
+            belief: Distribution of every value of the belief array, or Profiles of whole belief arrays
+            influence: Distribution of the influence
+            stubbornness: Distribution of the stubbornness
+            count (int): Number of doctors with this role. None shares the doctors that the roles with a count leave
+                between the roles without one, according to their ``proportion``
+            proportion (float): Relative share of a role without count
+    """
+
+    def __init__(self, belief, influence, stubbornness, count=None, proportion=1.):
+        self.belief = as_distribution(belief)
+        self.influence = as_distribution(influence)
+        self.stubbornness = as_distribution(stubbornness)
+        self.count = count
+        self.proportion = proportion
+
+
+def role_counts(roles, n_doctors):
+    """
+    Splits a committee of ``n_doctors`` between the roles. The roles with a count are filled first, in order, and
+    cut if the committee is too small for all of them. The rest of the doctors are shared between the roles without
+    count in proportion to their ``proportion``, rounding by largest remainder.
+
+    Returns:
+        List with the number of doctors of every role, which adds up to n_doctors
+    """
+    counts = []
+    left = n_doctors
+    for role in roles:
+        count = min(role.count, left) if role.count is not None else 0
+        counts.append(count)
+        left -= count
+    shared = [i for i, role in enumerate(roles) if role.count is None]
+    if left and not shared:
+        raise ValueError("The scenario describes {} doctors, the committee has {}".format(n_doctors - left,
+                                                                                          n_doctors))
+    if shared:
+        proportions = numpy.array([roles[i].proportion for i in shared], dtype=float)
+        quotas = left * proportions / proportions.sum()
+        shares = numpy.floor(quotas).astype(int)
+        # Largest remainders first, ties to the first declared role
+        for j in numpy.argsort(-(quotas - shares), kind="stable")[:left - shares.sum()]:
+            shares[j] += 1
+        for i, share in zip(shared, shares):
+            counts[i] = int(share)
+    return counts
+
+
+def sample_committees(roles, runs, n_doctors, n_args, rng=None):
+    """
+    Draws the initial state of ``runs`` committees of ``n_doctors`` doctors. The doctors are ordered role by role, in
+    the order of ``roles``, so in the scripted cases doctor 0 is the one with the first role.
+
+    Args:
+        roles (list): Roles of the scenario, e.g. ``SCENARIOS["1"]``
+        runs (int): Number of committees
+        n_doctors (int): Number of doctors of every committee
+        n_args (int): Number of arguments
+        rng: numpy Generator, or a seed for one
+
+    Returns:
+        ``(beliefs, influence, stubbornness)``, of shapes (runs, n_doctors, n_args), (runs, n_doctors) and
+        (runs, n_doctors)
+    """
+    rng = numpy.random.default_rng(rng)
+    beliefs = numpy.empty((runs, n_doctors, n_args))
+    influence = numpy.empty((runs, n_doctors))
+    stubbornness = numpy.empty((runs, n_doctors))
+    start = 0
+    for role, count in zip(roles, role_counts(roles, n_doctors)):
+        doctors = slice(start, start + count)
+        beliefs[:, doctors] = role.belief.sample(rng, (runs, count, n_args))
+        influence[:, doctors] = role.influence.sample(rng, (runs, count))
+        stubbornness[:, doctors] = role.stubbornness.sample(rng, (runs, count))
+        start += count
+    return beliefs, influence, stubbornness
+
+
+SCENARIOS = {
+    "1": [Role(Profiles(STRONG_BELIEF_CONCLUSION), STRONG_INFLUENCE_SET, STRONG_STUBBORNN_SET, count=1),
+          Role(UNCERTAIN_BELIEF_SET, WEAK_INFLUENCE_SET, WEAK_STUBBORNN_SET)],
+    "2": [Role(Profiles(STRONG_BELIEF_CONCLUSION[0]), STRONG_INFLUENCE_SET, STRONG_STUBBORNN_SET, count=1),
+          Role(Profiles(STRONG_BELIEF_CONCLUSION[1]), STRONG_INFLUENCE_SET, STRONG_STUBBORNN_SET, count=1),
+          Role(UNCERTAIN_BELIEF_SET, WEAK_INFLUENCE_SET, WEAK_STUBBORNN_SET)],
+    "3": [Role(UNCERTAIN_BELIEF_SET, WEAK_INFLUENCE_SET, WEAK_STUBBORNN_SET)],
+    "4": [Role(UNCERTAIN_BELIEF_SET, STRONG_INFLUENCE_SET, STRONG_STUBBORNN_SET)],
+    "5": [Role(UNCERTAIN_BELIEF_SET, 0.5, 0.5)],
+    # Three fixed doctors. Larger committees get more doctors like the third one
+    "default": [Role(Profiles([0.75, 0.30, 0.80, 0.50, 0.50]), 0.5, 0.5, count=1),
+                Role(Profiles([0.80, 0.50, 0.70, 0.40, 0.50]), 0.5, 0.5, count=1),
+                Role(Profiles([0.40, 0.70, 0.55, 0.75, 0.98]), 0.75, 0.75)],
+}
+
+
+def get_scenario(case):
+    """
+    Returns:
+        Roles of an experiment case (1 to 5, as int or str). Any other case is the default one
+    """
+    return SCENARIOS.get(str(case), SCENARIOS["default"])
@@ -0,0 +1,43 @@
+/**
+ * Table with the belief of every doctor in every argument. A frame either holds the whole matrix, or the flat indices
+ * and values of the cells that changed, which are updated in place.
+ */
+var BeliefDeltaModule = function() {
+    var div = $("<div style='max-height: 400px; overflow: auto'></div>");
+    $("#elements").append(div);
+    var cells = [];  // Flat, in the order of the belief matrix
+
+    var build = function(argumentNames, beliefs) {
+        var table = $("<table class='table table-condensed'></table>");
+        var header = $("<tr><th></th></tr>");
+        argumentNames.forEach(function(name) { header.append($("<th></th>").text(name)); });
+        table.append(header);
+        cells = [];
+        beliefs.forEach(function(row, doctor) {
+            var tr = $("<tr></tr>").append($("<th></th>").text("Doctor " + doctor));
+            row.forEach(function(value) {
+                var td = document.createElement("td");
+                td.textContent = value;
+                tr.append(td);
+                cells.push(td);
+            });
+            table.append(tr);
+        });
+        div.empty().append(table);
+    };
+
+    this.render = function(data) {
+        if (data.full) {
+            build(data.argument_names, data.full);
+            return;
+        }
+        for (var i = 0; i < data.values.length; i++) {
+            cells[data.indices[i]].textContent = data.values[i];
+        }
+    };
+
+    this.reset = function() {
+        div.empty();
+        cells = [];
+    };
+};
@@ -0,0 +1,52 @@
+/**
+ * Controls of the streaming server: shows the step of the last frame, runs the model headless on the server ("Fast
+ * forward"), sending frames at most frame_rate times per second, and jumps to a given step without rendering.
+ *
+ * It has to be the first element, as it sets control.tick to the step of the frame before the charts use it.
+ */
+var FrameControl = function(frame_rate) {
+    var div = $("<div class='well'></div>");
+    var stepLabel = $("<span class='label label-default' style='margin-right: 15px'>Step 0</span>");
+    var fastForwardButton = $("<button class='btn btn-default' type='button'>Fast forward</button>");
+    var rateInput = $("<input type='number' min='0.1' step='0.1' style='width: 60px; margin: 0 15px 0 5px'/>");
+    var jumpInput = $("<input type='number' min='0' style='width: 80px; margin: 0 5px'/>");
+    var jumpButton = $("<button class='btn btn-default' type='button'>Jump to step</button>");
+    rateInput.val(frame_rate);
+    div.append(stepLabel, fastForwardButton, " frames/s", rateInput, jumpButton, jumpInput);
+    $("#elements").append(div);
+
+    var streaming = false;
+    var setStreaming = function(value) {
+        streaming = value;
+        fastForwardButton.text(streaming ? "Pause" : "Fast forward");
+    };
+
+    fastForwardButton.on('click', function() {
+        if (streaming) {
+            send({"type": "pause"});
+            setStreaming(false);
+        } else if (!control.done) {
+            send({"type": "fast_forward", "frame_rate": Number(rateInput.val())});
+            setStreaming(true);
+        }
+    });
+
+    jumpButton.on('click', function() {
+        if (!control.done && jumpInput.val() !== "") {
+            send({"type": "jump", "step": Number(jumpInput.val())});
+        }
+    });
+
+    this.render = function(data) {
+        control.tick = data.step;
+        stepLabel.text("Step " + data.step);
+        if (!data.streaming) {
+            setStreaming(false);
+        }
+    };
+
+    this.reset = function() {
+        stepLabel.text("Step 0");
+        setStreaming(false);
+    };
+};
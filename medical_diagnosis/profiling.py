@@ -0,0 +1,105 @@
+import json
+from time import perf_counter
+
+# Phases of MedicalModel.step that are timed. influencing is the time spent in the doctors' turns, so it is part of
+# schedule, which also includes the shuffling of the speaking order
+PHASES = ("schedule", "influencing", "calculate_committee", "logging", "convergence", "collect")
+
+
+class PhaseProfiler:
+    """
+        Cumulative wall-time and call counters for every phase of :meth:`MedicalModel.step`. A model only has one when
+        it runs with ``profile=True``, otherwise the phases are not timed at all.
+
+        Optionally, the timings of every single step are passed to a callback and/or appended to a file, one JSON
+        object per line.
+
+        Attributes:
+            calls (dict): Number of times each phase ran, keyed by phase
+            seconds (dict): Total wall-time spent in each phase, keyed by phase
+    """
+
+    def __init__(self, step_callback=None, step_file=None):
+        """
+        Args:
+            step_callback: Called after every step as ``step_callback(step, timings)``, with the seconds spent in each
+                phase during that step
+            step_file (str): File where the timings of every step are appended
+        """
+        self.reset()
+        self.step_callback = step_callback
+        self._step_file = open(step_file, "a") if step_file is not None else None
+        self._step_timings = None
+        self._lap_start = None
+
+    def reset(self):
+        """ Sets all the counters back to zero. """
+        self.calls = dict.fromkeys(PHASES, 0)
+        self.seconds = dict.fromkeys(PHASES, 0.)
+
+    def add(self, phase, seconds):
+        self.calls[phase] += 1
+        self.seconds[phase] += seconds
+        if self._step_timings is not None:
+            self._step_timings[phase] = self._step_timings.get(phase, 0.) + seconds
+
+    def start_step(self):
+        self._step_timings = {} if self.step_callback is not None or self._step_file is not None else None
+        self._lap_start = perf_counter()
+
+    def lap(self, phase):
+        """ Charges the time since the previous lap (or the start of the step) to ``phase``. """
+        now = perf_counter()
+        self.add(phase, now - self._lap_start)
+        self._lap_start = now
+
+    def end_step(self, step):
+        if self._step_timings is None:
+            return
+        if self.step_callback is not None:
+            self.step_callback(step, self._step_timings)
+        if self._step_file is not None:
+            self._step_file.write(json.dumps({"step": step, "timings": self._step_timings}) + "\n")
+            self._step_file.flush()
+
+    def as_dict(self):
+        """
+        Returns:
+            ``{phase: {"calls": ..., "seconds": ...}}``
+        """
+        return {phase: {"calls": self.calls[phase], "seconds": self.seconds[phase]} for phase in PHASES}
+
+    def close(self):
+        """ Closes the step file. The counters are kept, and the later steps are not written anymore. """
+        if self._step_file is not None:
+            self._step_file.close()
+            self._step_file = None
+
+
+def get_phase_seconds(phase, model):
+    return model.profiler.seconds[phase]
+
+
+def get_phase_calls(phase, model):
+    return model.profiler.calls[phase]
+
+
+def aggregate_profiles(run_data):
+    """
+    Adds up the counters of every run of a batch sweep, as reported by get_phase_seconds and get_phase_calls in the
+    ``Time_<phase>`` and ``Calls_<phase>`` columns.
+
+    Args:
+        run_data (pandas.DataFrame): Results of the sweep
+
+    Returns:
+        DataFrame with the total calls and seconds of every phase, and the share of the time of the step
+    """
+    import pandas  # Imported here, as the model itself does not need pandas
+
+    profile = pandas.DataFrame({"calls": [int(run_data["Calls_" + phase].sum()) for phase in PHASES],
+                                "seconds": [float(run_data["Time_" + phase].sum()) for phase in PHASES]},
+                               index=pandas.Index(PHASES, name="phase"))
+    total = profile.seconds.drop("influencing").sum()
+    profile["share"] = profile.seconds / total
+    return profile
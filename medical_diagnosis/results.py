@@ -0,0 +1,126 @@
+import json
+import os
+
+import pandas
+
+MANIFEST_FILE = "manifest.jsonl"
+SWEEP_FILE = "sweep.json"
+
+
+class ResultSink:
+    """
+        Streams the results of a batch sweep to a directory, in append-only CSV chunks.
+
+        Every chunk is first written under a temporary name and then renamed, and only after that it is listed in the
+        manifest, together with the sweep cells it contains. A sweep that was interrupted can therefore be resumed from
+        the same directory: the cells listed in the manifest are done, and anything else (e.g. a half-written chunk)
+        is simply ignored.
+
+        The directory looks like::
+
+            sweep.json          description of the sweep (root seed and parameters), checked when resuming
+            manifest.jsonl      one line per chunk: {"chunk": "chunk_00000.csv", "cells": [[N, iteration, seed], ...]}
+            chunk_00000.csv
+            chunk_00001.csv
+            ...
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._chunks = []
+        self._completed = set()
+        manifest_path = os.path.join(directory, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                lines = f.read().split("\n")
+            # The last line is incomplete if we crashed while writing it. It is dropped, so that new entries start on
+            # a line of their own
+            complete_lines = [line for line in lines[:-1] if line]
+            if lines[-1]:
+                with open(manifest_path, "w") as f:
+                    f.writelines(line + "\n" for line in complete_lines)
+            for line in complete_lines:
+                entry = json.loads(line)
+                self._chunks.append(entry["chunk"])
+                self._completed.update(tuple(cell) for cell in entry["cells"])
+
+    def stored_sweep(self):
+        """
+        Returns:
+            The description of the sweep stored in the directory, or None if it is a new one
+        """
+        path = os.path.join(self.directory, SWEEP_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def open_sweep(self, description):
+        """
+        Stores the description of the sweep, or checks it against the stored one when resuming.
+
+        Args:
+            description (dict): JSON-serialisable description of the sweep, including its root seed
+        """
+        description = json.loads(json.dumps(description))  # Same types as the ones read back from the file
+        stored = self.stored_sweep()
+        if stored is None:
+            with open(os.path.join(self.directory, SWEEP_FILE), "w") as f:
+                json.dump(description, f)
+        elif stored != description:
+            raise ValueError("The results in {} belong to a different sweep: {}".format(self.directory, stored))
+
+    def is_done(self, cell):
+        return tuple(cell) in self._completed
+
+    @property
+    def n_completed(self):
+        return len(self._completed)
+
+    def write_chunk(self, records, cells):
+        """
+        Appends a chunk of results.
+
+        Args:
+            records: One dict per run, or a DataFrame
+            cells (list): Sweep cells, e.g. ``(N, iteration, seed)``, that the records complete
+        """
+        name = "chunk_{:05d}.csv".format(len(self._chunks))
+        path = os.path.join(self.directory, name)
+        pandas.DataFrame(records).to_csv(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+        cells = [list(cell) for cell in cells]
+        with open(os.path.join(self.directory, MANIFEST_FILE), "a") as f:
+            f.write(json.dumps({"chunk": name, "cells": cells}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._chunks.append(name)
+        self._completed.update(tuple(cell) for cell in cells)
+
+    def iter_chunks(self, columns=None):
+        """
+        Reads the results back one chunk at a time.
+
+        Args:
+            columns (list): Only read these columns
+
+        Yields:
+            One DataFrame per chunk
+        """
+        for name in self._chunks:
+            # round_trip parsing, so the probabilities are exactly the ones the runs computed
+            yield pandas.read_csv(os.path.join(self.directory, name), usecols=columns, float_precision="round_trip")
+
+    def load(self, columns=None):
+        """
+        Returns:
+            DataFrame with all the results written so far, sorted by run
+        """
+        chunks = list(self.iter_chunks(columns))
+        if not chunks:
+            return pandas.DataFrame(columns=columns)
+        run_data = pandas.concat(chunks, ignore_index=True)
+        if "Run" in run_data.columns:
+            run_data = run_data.sort_values("Run").reset_index(drop=True)
+        return run_data
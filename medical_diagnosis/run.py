@@ -3,12 +3,20 @@ import logging
 from functools import partial
 
 import numpy as np
-import matplotlib.pyplot as plt
 
 from medical_diagnosis.Model import MedicalModel
-from medical_diagnosis.Model import get_diagnosis_probabilities, get_final_decision
-from medical_diagnosis.server import ServerClass
-from mesa.batchrunner import BatchRunner
+from medical_diagnosis.Model import get_diagnosis_probabilities, get_final_decision, get_convergence_step
+from medical_diagnosis.profiling import PHASES, aggregate_profiles, get_phase_calls, get_phase_seconds
+from medical_diagnosis.topology import TOPOLOGIES
+
+# Only what every experiment case needs is imported above. pandas (batch run), matplotlib (plot of the batch run) and
+# tornado with mesa's visualisation (server) are imported where they are used, so the command starts fast
+
+# Let's do that experiment_case is a batch run of the default case, so diseases are the same. Also,
+# ground truth remains Chikunguya.
+# Hard coding the weight vectors for the default case, as we feel like they should be..
+BATCH_WEIGHTS = {"Zika": np.asarray([0.4, 0., 0.6, 0., 0.]),
+                 "Chikungunya": np.asarray([0., 0.25, 0., 0.25, 0.5])}
 
 
 def parse_arguments():
@@ -21,88 +29,263 @@ def parse_arguments():
     parser.add_argument('--experiment_case', type=str, default="default",
                         choices=['1', '2', '3', '4', '5', 'default', 'batch'],
                         help='Which experiment to run.')
+    parser.add_argument('--scenario', type=str, default=None, choices=['1', '2', '3', '4', '5', 'default'],
+                        help='For the batch run, start every committee from this scripted case instead of random '
+                             'beliefs. Works with any number of doctors.')
     parser.add_argument('--n_batch_iter', type=int, default=5,
                         help='Number of iterations in the batch run.')
+    parser.add_argument('--ensemble', action='store_true',
+                        help='For the batch run, simulate all the iterations of each N together as one ensemble '
+                             'instead of one model at a time.')
+    parser.add_argument('--target_width', type=float, default=None,
+                        help='Adaptive batch run: simulate ensembles of --n_batch_iter committees for every N until '
+                             'the confidence interval of --metric is at most this wide.')
+    parser.add_argument('--max_runs', type=int, default=10000,
+                        help='With --target_width, maximum number of runs of every N.')
+    parser.add_argument('--metric', type=str, default="accuracy", choices=["accuracy", "probability"],
+                        help='With --target_width, estimate the rate of correct diagnoses or the mean probability '
+                             'of the correct diagnosis.')
+    parser.add_argument('--float32', action='store_true',
+                        help='For the batch run, keep the beliefs, influence and stubbornness in float32, which halves '
+                             'their memory in very large committees and ensembles.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes for the batch run.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Root seed of the batch run. The results do not depend on the number of workers.')
+    parser.add_argument('--convergence', type=str, default="belief_delta",
+                        choices=['none'] + list(MedicalModel.CONVERGENCE_CRITERIA),
+                        help='Criterion used to stop each run of the batch once the committee has converged.')
+    parser.add_argument('--convergence_window', type=int, default=None,
+                        help='Number of consecutive steps the convergence criterion must hold. Defaults to 1 for '
+                             'belief_delta, 5 for probabilities and 20 for decision, which needs at least 2.')
+    parser.add_argument('--convergence_tol', type=float, default=1e-6,
+                        help='Tolerance of the belief_delta and probabilities criteria.')
+    parser.add_argument('--trace_level', type=str, default=None, choices=list(MedicalModel.TRACE_LEVELS),
+                        help='How much each model reports. Defaults to off for the batch run and summary otherwise. '
+                             'full (a binary trace of every turn in trace.bin) is only for single simulations.')
+    parser.add_argument('--results_dir', type=str, default=None,
+                        help='Directory where the batch results are streamed as they are computed. Running again with '
+                             'the same directory resumes an interrupted batch.')
+    parser.add_argument('--queue_dir', type=str, default=None,
+                        help='Shared directory through which the batch run is distributed. This command queues the '
+                             'runs, runs --workers of them locally (0 to only coordinate), and merges the results. '
+                             'Workers on other nodes join with: python -m medical_diagnosis.workqueue <queue_dir>. '
+                             'Running again with the same directory resumes the batch.')
+    parser.add_argument('--lease_seconds', type=float, default=300,
+                        help='With --queue_dir, seconds without heartbeat after which the runs of a worker are given '
+                             'to another one. Give the same value to every worker.')
+    parser.add_argument('--topology', type=str, default=None, choices=list(TOPOLOGIES),
+                        help='Influence graph of the batch run. By default every doctor influences every other '
+                             'doctor. Not supported with --ensemble.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Time every phase of the model step during the batch run, and print the totals.')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Directory of a persistent cache of batch runs. Runs with the same parameters and seed '
+                             'are not computed again, so give a --seed to reuse them between batches.')
+    parser.add_argument('--cache_size', type=float, default=256,
+                        help='Maximum size of the cache, in MiB. The least recently used runs are evicted.')
+    parser.add_argument('--fast_ui', action='store_true',
+                        help='Run the visualisation headless, sending the browser only the beliefs that changed.')
+    parser.add_argument('--steps_per_frame', type=int, default=1,
+                        help='With --fast_ui, number of steps the Step and Start buttons advance per frame.')
+    parser.add_argument('--frame_rate', type=float, default=10,
+                        help='With --fast_ui, maximum number of frames per second while fast forwarding.')
+    parser.add_argument('--sessions', action='store_true',
+                        help='Serve an independent simulation to every browser tab, each one with its own experiment '
+                             'case. Uses the same interface as --fast_ui.')
+    parser.add_argument('--session_workers', type=int, default=4,
+                        help='With --sessions, number of threads stepping the simulations.')
+    parser.add_argument('--no_plot', '--no-plot', action='store_true',
+                        help='Write the summary of the batch run to --summary_file instead of plotting it. '
+                             'matplotlib is not needed then.')
+    parser.add_argument('--summary_file', type=str, default="batch_summary.csv",
+                        help='CSV file where --no_plot writes the accuracy, diagnosis probabilities and convergence '
+                             'steps per number of doctors.')
     args = parser.parse_args()
-    return args.n_doctors, args.n_init_arg, args.experiment_case, args.n_batch_iter
+    if args.topology is not None and args.ensemble:
+        parser.error('--topology is not supported with --ensemble')
+    if args.profile and args.ensemble:
+        parser.error('--profile is not supported with --ensemble')
+    if args.cache_dir is not None and args.ensemble:
+        parser.error('--cache_dir is not supported with --ensemble')
+    if args.queue_dir is not None and (args.ensemble or args.cache_dir is not None or args.results_dir is not None):
+        parser.error('--queue_dir is not supported with --ensemble, --cache_dir or --results_dir')
+    if args.target_width is not None and (args.topology is not None or args.profile or args.cache_dir is not None
+                                          or args.results_dir is not None or args.queue_dir is not None):
+        parser.error('--target_width is not supported with --topology, --profile, --cache_dir, --results_dir or '
+                     '--queue_dir')
+    if args.workers < 1 and args.queue_dir is None:
+        parser.error('--workers must be at least 1 without --queue_dir')
+    if args.convergence == "decision" and args.convergence_window is not None and args.convergence_window < 2:
+        parser.error('--convergence decision needs a --convergence_window of at least 2')
+    if args.trace_level == "full" and args.experiment_case == "batch":
+        # Every run would write the same trace file
+        parser.error('--trace_level full is not supported with the batch run')
+    # Values derived from the options
+    if args.convergence == 'none':
+        args.convergence = None
+    if args.trace_level is None:
+        args.trace_level = "off" if args.experiment_case == "batch" else "summary"
+    return args
 
 
-if __name__ == '__main__':
-    # create logger with 'medical_diagnosis'
-    logger = logging.getLogger('medical_diagnosis')
-    logger.setLevel(logging.DEBUG)
-    # create file handler which logs even debug messages
-    fh = logging.FileHandler('output.log', mode='w')
-    fh.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(message)s', datefmt='%I:%M:%S %p')
-    fh.setFormatter(formatter)
-    logger.addHandler(fh)
+def run_batch(n_doctors, n_init_arg, n_batch_iter, ensemble=False, workers=1, seed=None, convergence="belief_delta",
+              trace_level="off", results_dir=None, topology=None, profile=False, cache_dir=None, cache_size=256,
+              scenario=None, queue_dir=None, lease_seconds=300, float32=False, convergence_window=None,
+              convergence_tol=1e-6):
+    """
+    Runs the batch sweep over the number of doctors, from 1 to n_doctors - 1. With a scenario (one of the scripted
+    experiment cases), the committees start from it instead of random beliefs. With a queue_dir, the sweep is
+    distributed through that directory (see medical_diagnosis.workqueue), and ``workers`` are the local workers.
+    With float32, the committees are kept in float32 (see the dtype of MedicalModel and MedicalEnsemble). The
+    convergence criterion, window and tolerance are the ones of MedicalModel, and are not used by the ensemble.
 
-    logger.debug("Initiating Simulation")
+    Returns:
+        DataFrame with one row per run, with at least the columns N, Final_decision and one per disease. When
+        profiling, also the Time_<phase> and Calls_<phase> columns of every phase
+    """
+    from medical_diagnosis.cache import SweepCache
+    from medical_diagnosis.ensemble import run_ensemble_batch
+    from medical_diagnosis.results import ResultSink
+    from medical_diagnosis.sweep import run_sweep
 
-    arguments = parse_arguments()
-    n_doctors, n_init_arg, experiment_case, n_batch_iter = arguments
-    if experiment_case == "batch":  # Batch run
-        # Let's do that experiment_case is a batch run of the default case, so diseases are the same. Also,
-        # ground truth remains Chikunguya.
-        # Hard coding the weight vectors for the default case, as we feel like they should be..
-        arg_weight_vector = {"Zika": np.asarray([0.4, 0., 0.6, 0., 0.]),
-                             "Chikungunya": np.asarray([0., 0.25, 0., 0.25, 0.5])}
+    experiment_case = "batch" if scenario is None else scenario
+    arg_weight_vector = BATCH_WEIGHTS
+    sink = ResultSink(results_dir) if results_dir is not None else None
+    if ensemble:
+        run_data = run_ensemble_batch(range(1, n_doctors, 1), n_batch_iter, n_init_arg=n_init_arg, sigma=0.25,
+                                      arg_weight_vector=arg_weight_vector, max_steps=50, seed=seed, sink=sink,
+                                      scenario=scenario, dtype=np.float32 if float32 else float)
+    else:
         fixed_params = {
             "n_init_arg": n_init_arg,
             "experiment_case": experiment_case,
             "sigma": 0.25,
-            "arg_weight_vector": arg_weight_vector
+            "arg_weight_vector": arg_weight_vector,
+            "convergence": convergence,
+            "trace_level": trace_level
         }
+        if topology is not None:
+            fixed_params["topology"] = topology
+        if profile:
+            fixed_params["profile"] = True
+        if float32:
+            fixed_params["dtype"] = np.float32
+        # Only passed when they are not the defaults, so that cached and stored sweeps still match
+        if convergence_window is not None:
+            fixed_params["convergence_window"] = convergence_window
+        if convergence_tol != 1e-6:
+            fixed_params["convergence_tol"] = convergence_tol
         variable_params = {
             "N": range(1, n_doctors, 1)
         }
 
         # Create dictionary where the diagnosis probabilities will be tracked
-        dict_batch_collector = {"Final_decision": get_final_decision}
+        dict_batch_collector = {"Final_decision": get_final_decision, "Convergence_step": get_convergence_step}
         for i, disease in enumerate(MedicalModel.LIST_OF_DISEASES.values()):
             disease_prob = partial(get_diagnosis_probabilities, i)
             dict_batch_collector[disease] = disease_prob
+        if profile:
+            for phase in PHASES:
+                dict_batch_collector["Time_" + phase] = partial(get_phase_seconds, phase)
+                dict_batch_collector["Calls_" + phase] = partial(get_phase_calls, phase)
+
+        if queue_dir is not None:
+            from medical_diagnosis.workqueue import run_distributed_sweep
 
-        batch_run = BatchRunner(
+            return run_distributed_sweep(queue_dir, MedicalModel, variable_params, fixed_params,
+                                         iterations=n_batch_iter, max_steps=50, model_reporters=dict_batch_collector,
+                                         seed=seed, local_workers=workers, lease_seconds=lease_seconds)
+
+        cache = SweepCache(cache_dir, max_bytes=int(cache_size * 2 ** 20)) if cache_dir is not None else None
+        run_data = run_sweep(
             MedicalModel,
             variable_params,
             fixed_params,
             iterations=n_batch_iter,
             max_steps=50,
-            model_reporters=dict_batch_collector
+            model_reporters=dict_batch_collector,
+            workers=workers,
+            seed=seed,
+            sink=sink,
+            cache=cache
         )
+        if cache is not None:
+            print(cache.report())
+            cache.close()
+    if sink is not None:
+        # Only read back what the analysis below needs
+        columns = ["N", "Final_decision"] + list(MedicalModel.LIST_OF_DISEASES.values())
+        if not ensemble:
+            columns.append("Convergence_step")
+        if profile:
+            columns += ["Time_" + phase for phase in PHASES] + ["Calls_" + phase for phase in PHASES]
+        run_data = sink.load(columns=columns)
+
+    return run_data
+
+
+def plot_summary(summary, n_batch_iter):
+    """ Bar chart of the correct diagnoses per number of doctors, with the confidence interval of the accuracy. """
+    import matplotlib.pyplot as plt
 
-        batch_run.run_all()
-
-        run_data = batch_run.get_model_vars_dataframe()
-        # All this dictionary approach is in case we want to show something else than just counting the correct
-        # answers..
-
-        # Create dict that contains the correct_diagnosis dictionaries keyed by the number of agents
-        dict_correct_diagnosis = {}
-        for i in range(1, n_doctors, 1):
-            # Get the data frame relevant for N = i
-            df = run_data[run_data.N == i]  # for i number of doctors
-            # Create dict that contains the tuples of probabilities for the diseases where the diagnosis was correct,
-            # keyed by the run number it was made.
-            correct_diagnosis = {}
-            for row in df.iterrows():
-                if row[1].Final_decision == "Chikungunya":
-                    correct_diagnosis[row[0]] = (row[1].Zika, row[1].Chikungunya)
-            dict_correct_diagnosis[i] = correct_diagnosis
-
-        n_total_correct_diagnosis = []
-        for num_doct in dict_correct_diagnosis.keys():
-            n_total_correct_diagnosis.append(len(dict_correct_diagnosis[num_doct]))
-
-        ind = np.arange(len(n_total_correct_diagnosis))
-        bar_chart = plt.bar(ind, n_total_correct_diagnosis)
-        plt.xlabel('Number of doctors during argumentation')
-        plt.ylabel('Number of correct diagnosis')
-        plt.title('Number of correct diagnosis per {} cases'.format(n_batch_iter))
-        plt.xticks(ind, tuple(np.arange(1, n_doctors, 1).astype(str)))
-        plt.show()
+    ind = np.arange(len(summary))
+    errors = np.vstack([summary.correct - summary.accuracy_low * summary.runs,
+                        summary.accuracy_high * summary.runs - summary.correct])
+    bar_chart = plt.bar(ind, summary.correct, yerr=errors, capsize=3)
+    plt.xlabel('Number of doctors during argumentation')
+    plt.ylabel('Number of correct diagnosis')
+    plt.title('Number of correct diagnosis per {} cases'.format(n_batch_iter))
+    plt.xticks(ind, tuple(summary.index.astype(str)))
+    plt.show()
+
+
+if __name__ == '__main__':
+    # create logger with 'medical_diagnosis'
+    logger = logging.getLogger('medical_diagnosis')
+    logger.setLevel(logging.DEBUG)
+    # create file handler which logs even debug messages
+    fh = logging.FileHandler('output.log', mode='w')
+    fh.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(message)s', datefmt='%I:%M:%S %p')
+    fh.setFormatter(formatter)
+    logger.addHandler(fh)
+
+    logger.debug("Initiating Simulation")
+
+    args = parse_arguments()
+    if args.experiment_case == "batch":  # Batch run
+        if args.target_width is not None:
+            from medical_diagnosis.adaptive import run_adaptive_batch, format_adaptive_report
+
+            run_data, report = run_adaptive_batch(range(1, args.n_doctors, 1), args.target_width,
+                                                  batch_size=args.n_batch_iter, max_runs=args.max_runs,
+                                                  metric=args.metric, n_init_arg=args.n_init_arg,
+                                                  arg_weight_vector=BATCH_WEIGHTS, seed=args.seed,
+                                                  scenario=args.scenario)
+            print(format_adaptive_report(report, args.target_width, args.metric))
+        else:
+            run_data = run_batch(args.n_doctors, args.n_init_arg, args.n_batch_iter, ensemble=args.ensemble,
+                                 workers=args.workers, seed=args.seed, convergence=args.convergence,
+                                 trace_level=args.trace_level, results_dir=args.results_dir, topology=args.topology,
+                                 profile=args.profile, cache_dir=args.cache_dir, cache_size=args.cache_size,
+                                 scenario=args.scenario, queue_dir=args.queue_dir, lease_seconds=args.lease_seconds,
+                                 float32=args.float32, convergence_window=args.convergence_window,
+                                 convergence_tol=args.convergence_tol)
+        if args.profile:
+            print(aggregate_profiles(run_data))
+
+        from medical_diagnosis.analysis import summarise_batch
+
+        summary = summarise_batch(run_data)
+        if args.no_plot:
+            summary.to_csv(args.summary_file)
+            print("Summary written to {}".format(args.summary_file))
+        else:
+            plot_summary(summary, args.n_batch_iter)
     else:
-        server = ServerClass(n_doctors, n_init_arg, experiment_case)
+        from medical_diagnosis.server import ServerClass
+
+        server = ServerClass(args.n_doctors, args.n_init_arg, args.experiment_case, args.trace_level, args.fast_ui,
+                             args.steps_per_frame, args.frame_rate, args.sessions, args.session_workers)
         server.server.launch()
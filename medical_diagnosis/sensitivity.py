@@ -0,0 +1,243 @@
+import argparse
+import time
+
+import numpy
+import pandas
+
+from medical_diagnosis.ensemble import MedicalEnsemble
+from medical_diagnosis.Model import MedicalModel, DEFAULT_CASE_WEIGHTS, argument_names, make_weight_matrix
+from medical_diagnosis.sweep import cell_seed, resolve_root_seed
+
+# Outputs of every evaluation whose sensitivity is reported
+OUTPUTS = ("Chikungunya", "Convergence_step")
+
+
+def parameter_space(n_init_arg=5, diseases=None, weights=True):
+    """
+    Ranges of the parameters of the batch case: the means of the influence and stubbornness drawn by random_influence,
+    the sigma of the initial beliefs, and (with ``weights``) every entry of the weight matrix, named
+    ``weight_<disease>_<argument>``.
+
+    Returns:
+        dict with the ``(low, high)`` range of every parameter
+    """
+    if diseases is None:
+        diseases = list(MedicalModel.LIST_OF_DISEASES.values())
+    space = {"influence_mu": (0., 1.), "stubbornness_mu": (0., 1.), "sigma": (0.05, 0.5)}
+    if weights:
+        for disease in diseases:
+            for argument in argument_names(n_init_arg):
+                space["weight_{}_{}".format(disease, argument)] = (0., 1.)
+    return space
+
+
+def scale(unit_design, space):
+    """ Maps a design in the unit hypercube to the ranges of ``space``, one column per parameter. """
+    low, high = numpy.array(list(space.values()), dtype=float).T
+    return low + unit_design * (high - low)
+
+
+def saltelli_design(space, n, rng=None):
+    """
+    Sample design of Saltelli's scheme for Sobol indices: the matrices A and B of ``n`` random points each, followed
+    by the matrices AB_i, which are A with the column i taken from B.
+
+    Returns:
+        ``(design, groups)``: ((d + 2) * n, d) points, and the row of A every point comes from, so that the points
+        that only differ by the parameters share their random draws
+    """
+    rng = numpy.random.default_rng(rng)
+    d = len(space)
+    a, b = rng.random((n, d)), rng.random((n, d))
+    blocks = [a, b]
+    for i in range(d):
+        ab = a.copy()
+        ab[:, i] = b[:, i]
+        blocks.append(ab)
+    return scale(numpy.vstack(blocks), space), numpy.tile(numpy.arange(n), d + 2)
+
+
+def sobol_indices(y, n, d):
+    """
+    First-order (Saltelli 2010) and total (Jansen) Sobol indices of an output evaluated on a saltelli_design.
+
+    Returns:
+        ``(first_order, total)``, arrays with one index per parameter
+    """
+    y = numpy.asarray(y, dtype=float)
+    f_a, f_b = y[:n], y[n:2 * n]
+    f_ab = y[2 * n:].reshape(d, n)
+    variance = numpy.var(y[:2 * n])
+    if variance == 0:
+        return numpy.zeros(d), numpy.zeros(d)
+    first_order = numpy.mean(f_b * (f_ab - f_a), axis=1) / variance
+    total = 0.5 * numpy.mean((f_a - f_ab) ** 2, axis=1) / variance
+    return first_order, total
+
+
+def morris_design(space, r, levels=4, rng=None):
+    """
+    Sample design of Morris' elementary effects: ``r`` trajectories on a grid of ``levels`` levels, each changing one
+    parameter at a time, in a random order, by :math:`\\Delta = levels / (2 (levels - 1))` of its range.
+
+    Returns:
+        ``(design, groups)``: (r * (d + 1), d) points, and the trajectory of every point
+    """
+    rng = numpy.random.default_rng(rng)
+    d = len(space)
+    delta = levels / (2 * (levels - 1))
+    starts = rng.integers(0, levels // 2, size=(r, d)) / (levels - 1)  # So that x + delta is still in the grid
+    steps = numpy.tril(numpy.ones((d + 1, d)), -1) * delta  # Row k has the first k parameters moved
+    orders = numpy.argsort(rng.random((r, d)), axis=1)
+    design = starts[:, None, :] + numpy.take_along_axis(steps[None, :, :].repeat(r, axis=0),
+                                                        numpy.argsort(orders, axis=1)[:, None, :], axis=2)
+    return scale(design.reshape(r * (d + 1), d), space), numpy.repeat(numpy.arange(r), d + 1)
+
+
+def morris_indices(y, design, r, space):
+    """
+    Morris statistics of an output evaluated on a morris_design.
+
+    Returns:
+        ``(mu_star, mu, sigma)``: mean absolute, mean and standard deviation of the elementary effects of every
+        parameter, in units of the output per unit of the parameter's range
+    """
+    d = len(space)
+    low, high = numpy.array(list(space.values()), dtype=float).T
+    unit = ((design - low) / (high - low)).reshape(r, d + 1, d)
+    moves = numpy.diff(unit, axis=1)  # (r, d, d), one parameter moved per row
+    moved = numpy.argmax(numpy.abs(moves), axis=2)
+    effects = numpy.diff(numpy.asarray(y, dtype=float).reshape(r, d + 1), axis=1)
+    effects = effects / numpy.take_along_axis(moves, moved[:, :, None], axis=2)[:, :, 0]
+    by_parameter = numpy.empty((r, d))
+    numpy.put_along_axis(by_parameter, moved, effects, axis=1)
+    return numpy.abs(by_parameter).mean(axis=0), by_parameter.mean(axis=0), by_parameter.std(axis=0)
+
+
+def evaluate(design, space, groups, n_doctors=3, n_init_arg=5, max_steps=50, convergence_tol=1e-6, seed=None,
+             batch_size=20000, diseases=None, base_weights=DEFAULT_CASE_WEIGHTS):
+    """
+    Simulates one committee of the batch case per point of the design, as MedicalEnsemble batches of at most
+    ``batch_size`` committees. The points of a group are always simulated in the same batch, with common random
+    numbers.
+
+    Args:
+        design (numpy.ndarray): (n_points, d) values of the parameters of ``space``
+        groups (numpy.ndarray): (n_points,) group of every point
+        base_weights: Weight matrix of the entries that are not in the design
+
+    Returns:
+        DataFrame with one row per point, with the probability of every disease and the Convergence_step
+        (``max_steps`` for the committees that did not converge)
+    """
+    if diseases is None:
+        diseases = list(MedicalModel.LIST_OF_DISEASES.values())
+    seed = resolve_root_seed(seed)
+    names = list(space)
+    columns = {name: design[:, i] for i, name in enumerate(names)}
+    base_weights = make_weight_matrix(base_weights, diseases, n_init_arg)
+    weight_columns = [(d, a, "weight_{}_{}".format(disease, argument))
+                      for d, disease in enumerate(diseases) for a, argument in enumerate(argument_names(n_init_arg))]
+    weight_columns = [column for column in weight_columns if column[2] in columns]
+
+    # Batches made of whole groups, cut before the group that would make them larger than batch_size
+    order = numpy.argsort(groups, kind="stable")
+    group_bounds = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(groups[order])) + 1, [len(design)]))
+    cuts = [0]
+    for previous, bound in zip(group_bounds[:-1], group_bounds[1:]):
+        if bound - cuts[-1] > batch_size and previous > cuts[-1]:
+            cuts.append(previous)
+    cuts.append(len(design))
+    default = {"influence_mu": 0.5, "stubbornness_mu": 0.5, "sigma": 0.25}
+    results = numpy.empty((len(design), len(diseases) + 1))
+    for batch, (start, end) in enumerate(zip(cuts[:-1], cuts[1:])):
+        rows = order[start:end]
+        _, batch_groups = numpy.unique(groups[rows], return_inverse=True)
+        weights = None
+        if weight_columns:
+            weights = numpy.repeat(base_weights[None], len(rows), axis=0)
+            for d, a, name in weight_columns:
+                weights[:, d, a] = columns[name][rows]
+        params = {name: columns[name][rows] if name in columns else value for name, value in default.items()}
+        ensemble = MedicalEnsemble(len(rows), N=n_doctors, n_init_arg=n_init_arg,
+                                   arg_weight_vector=weights if weights is not None else base_weights,
+                                   seed=cell_seed(seed, "sensitivity", batch), diseases=diseases,
+                                   groups=batch_groups, convergence_tol=convergence_tol, **params)
+        ensemble.run(max_steps)
+        results[rows, :-1] = ensemble.diagnosis_probabilities
+        results[rows, -1] = numpy.where(ensemble.converged_step < 0, max_steps, ensemble.converged_step)
+    return pandas.DataFrame(results, columns=diseases + ["Convergence_step"])
+
+
+def sensitivity_analysis(method="sobol", samples=1024, space=None, outputs=OUTPUTS, seed=None, **kwargs):
+    """
+    Samples a design over ``space`` (by default parameter_space()), evaluates it and computes the sensitivity
+    indices of every output.
+
+    Args:
+        method (str): ``sobol`` (``samples`` base points, ``(d + 2) * samples`` evaluations) or ``morris``
+            (``samples`` trajectories, ``(d + 1) * samples`` evaluations)
+        kwargs: Passed to evaluate
+
+    Returns:
+        DataFrame indexed by parameter, with the columns ``<output>_S1`` and ``<output>_ST`` for sobol, or
+        ``<output>_mu_star``, ``<output>_mu`` and ``<output>_sigma`` for morris
+    """
+    if space is None:
+        space = parameter_space(kwargs.get("n_init_arg", 5), kwargs.get("diseases"))
+    seed = resolve_root_seed(seed)
+    rng = numpy.random.default_rng(cell_seed(seed, "design"))
+    if method == "sobol":
+        design, groups = saltelli_design(space, samples, rng)
+    elif method == "morris":
+        design, groups = morris_design(space, samples, rng=rng)
+    else:
+        raise ValueError("Unknown method: {}".format(method))
+    y = evaluate(design, space, groups, seed=seed, **kwargs)
+
+    report = pandas.DataFrame(index=pandas.Index(list(space), name="parameter"))
+    for output in outputs:
+        if method == "sobol":
+            report[output + "_S1"], report[output + "_ST"] = sobol_indices(y[output].values, samples, len(space))
+        else:
+            (report[output + "_mu_star"], report[output + "_mu"],
+             report[output + "_sigma"]) = morris_indices(y[output].values, design, samples, space)
+    return report
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Global sensitivity analysis of the batch case')
+    parser.add_argument('--method', type=str, default="sobol", choices=["sobol", "morris"],
+                        help='Sobol indices (Saltelli design) or Morris elementary effects.')
+    parser.add_argument('--samples', type=int, default=1024,
+                        help='Base points of the Sobol design, or trajectories of the Morris design.')
+    parser.add_argument('--n_doctors', type=int, default=3,
+                        help='Number of doctors of every committee.')
+    parser.add_argument('--n_init_arg', type=int, default=5,
+                        help='Number of initial arguments.')
+    parser.add_argument('--no_weights', action='store_true',
+                        help='Only vary the influence, stubbornness and sigma, and not the weight matrix.')
+    parser.add_argument('--max_steps', type=int, default=50,
+                        help='Number of argumentation rounds of every committee.')
+    parser.add_argument('--batch_size', type=int, default=20000,
+                        help='Maximum number of committees simulated at once.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Root seed of the design and of the committees.')
+    parser.add_argument('--output', type=str, default=None,
+                        help='CSV file where the indices are written.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    start = time.perf_counter()
+    report = sensitivity_analysis(args.method, args.samples,
+                                  parameter_space(args.n_init_arg, weights=not args.no_weights), seed=args.seed,
+                                  n_doctors=args.n_doctors, n_init_arg=args.n_init_arg, max_steps=args.max_steps,
+                                  batch_size=args.batch_size)
+    d = len(report)
+    evaluations = args.samples * (d + 2 if args.method == "sobol" else d + 1)
+    print(report.round(3).to_string())
+    print("{} evaluations in {:.1f} s".format(evaluations, time.perf_counter() - start))
+    if args.output is not None:
+        report.to_csv(args.output)
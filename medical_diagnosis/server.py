@@ -4,7 +4,9 @@ from mesa.visualization.ModularVisualization import ModularServer
 from mesa.visualization.modules import ChartModule, TextElement, BarChartModule
 from mesa.visualization.UserParam import UserSettableParameter
 
-from medical_diagnosis.Model import MedicalModel, ARGUMENT_NAMES, COLORS
+from medical_diagnosis.Model import MedicalModel, argument_names, argument_colors
+from medical_diagnosis.sessions import SessionServer
+from medical_diagnosis.streaming import BeliefDeltaElement, FrameControl, StreamingServer
 
 
 class PrintedDiagnosis(TextElement):
@@ -49,27 +51,39 @@ class LegendElement(TextElement):
 
 
 class ServerClass:
-    def __init__(self, n_doctors=3, n_init_arg=5, experiment_case=1):
+    def __init__(self, n_doctors=3, n_init_arg=5, experiment_case=1, trace_level="summary", fast=False,
+                 steps_per_frame=1, frame_rate=10, sessions=False, workers=4):
+        """
+        Args:
+            fast (bool): Use the StreamingServer, that runs the model headless and only sends the changes of the
+                belief arrays to the browser, every steps_per_frame steps or at most frame_rate times per second
+            sessions (bool): Use the SessionServer, where every browser tab has its own simulation and can choose its
+                experiment case. Its interface is the same as with fast
+            workers (int): Number of threads stepping the simulations of the SessionServer
+        """
         self.n_init_arg = n_init_arg
 
+        arg_names = argument_names(self.n_init_arg)
+        colors = argument_colors(max(self.n_init_arg, len(MedicalModel.LIST_OF_DISEASES)))
+
         # Create a line chart tracking avg_belief for all the initial arguments
         list_var = []
         for i in range(self.n_init_arg):
-            dict = {"Label": ARGUMENT_NAMES[i], "Color": COLORS[i]}
+            dict = {"Label": arg_names[i], "Color": colors[i]}
             list_var.append(dict)
         avg_belief_line_chart = ChartModule(list_var)
 
         # Create a line chart tracking the committee decision progress
         list_var = []
         for i, disease in enumerate(MedicalModel.LIST_OF_DISEASES.values()):
-            dict = {"Label": disease, "Color": COLORS[i]}
+            dict = {"Label": disease, "Color": colors[i]}
             list_var.append(dict)
         disease_line_chart = ChartModule(list_var)
 
         # Create bar chart to display the agents belief arrays
         list_var = []
         for i in range(self.n_init_arg):
-            dict = {"Label": ARGUMENT_NAMES[i], "Color": COLORS[i]}
+            dict = {"Label": arg_names[i], "Color": colors[i]}
             list_var.append(dict)
         bar_chart = BarChartModule(list_var, scope="agent")
 
@@ -84,6 +98,12 @@ class ServerClass:
 
         list_of_visualizations = [legend_belief_array, bar_chart, legend_conclusion, disease_line_chart, diagnosis,
                                   legend_avg_belief, avg_belief_line_chart]
+        if fast or sessions:
+            legend_belief_array = LegendElement('<font size="5"><b>1. </b></font> The table below displays the belief '
+                                                'array for each of the doctors (e.g. Doctor 0, Doctor 1..)')
+            list_of_visualizations = [FrameControl(frame_rate), legend_belief_array, BeliefDeltaElement(),
+                                      legend_conclusion, disease_line_chart, diagnosis, legend_avg_belief,
+                                      avg_belief_line_chart]
         model_legend = """<h1>Default Case Scenario.</h1><br><h3>The initial set of arguments is the 
         following:</h3><br>
         """
@@ -94,8 +114,20 @@ class ServerClass:
             "Legend": UserSettableParameter('static_text', value=model_legend),
             "N": n_doctors,
             "n_init_arg": n_init_arg,
-            "experiment_case": experiment_case
+            "experiment_case": experiment_case,
+            "trace_level": trace_level
         }
+        if sessions:
+            model_params["experiment_case"] = UserSettableParameter('choice', 'Experiment case',
+                                                                    value=experiment_case,
+                                                                    choices=['1', '2', '3', '4', '5', 'default'])
         # Create server
-        self.server = ModularServer(MedicalModel, list_of_visualizations, "ABM medical diagnosis", model_params)
+        if sessions:
+            self.server = SessionServer(MedicalModel, list_of_visualizations, "ABM medical diagnosis", model_params,
+                                        workers=workers, steps_per_frame=steps_per_frame)
+        elif fast:
+            self.server = StreamingServer(MedicalModel, list_of_visualizations, "ABM medical diagnosis", model_params,
+                                          steps_per_frame=steps_per_frame)
+        else:
+            self.server = ModularServer(MedicalModel, list_of_visualizations, "ABM medical diagnosis", model_params)
         self.server.port = 8521
@@ -0,0 +1,376 @@
+import argparse
+import json
+import os
+import queue
+import socketserver
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+import numpy
+
+from medical_diagnosis.ensemble import MedicalEnsemble
+from medical_diagnosis.initialisations import SCENARIOS, Normal, Role, sample_committees
+from medical_diagnosis.Model import MedicalModel, DEFAULT_CASE_WEIGHTS, make_weight_matrix
+
+# Committee profiles a case can ask for: the scripted experiment cases, or the random committees of the batch case
+PROFILE_ROLES = dict(SCENARIOS, batch=[Role(Normal(0.5, 0.25), Normal(0.5, 0.25), Normal(0.5, 0.25))])
+PROFILES = tuple(PROFILE_ROLES)
+EVIDENCE = tuple(MedicalModel.LIST_OF_ARGUMENTS)
+MAX_DOCTORS = 1000
+
+
+def parse_case(case):
+    """
+    Validates a patient case, as sent to the service::
+
+        {"evidence": ["A", "D", "E"], "profile": "default", "n_doctors": 3, "id": "any value, echoed back"}
+
+    ``evidence`` lists the items of MedicalModel.LIST_OF_ARGUMENTS that apply to the patient. The ones that do not
+    apply weigh nothing in the diagnosis. ``profile`` (one of PROFILES, default ``default``) and ``n_doctors``
+    (default 3) describe the committee.
+
+    Returns:
+        ``(profile, n_doctors, mask, case_id)``, where mask is the 0/1 vector of the evidence that applies
+    """
+    if not isinstance(case, dict):
+        raise ValueError("A case must be a JSON object, got {}".format(type(case).__name__))
+    evidence = case.get("evidence", EVIDENCE)
+    if isinstance(evidence, str) or not isinstance(evidence, (list, tuple)):
+        raise ValueError("evidence must be a list of items of LIST_OF_ARGUMENTS, got {}".format(evidence))
+    not_text = [item for item in evidence if not isinstance(item, str)]
+    if not_text:
+        raise ValueError("Evidence items must be strings, got {}".format(", ".join(map(repr, not_text))))
+    unknown = set(evidence) - set(EVIDENCE)
+    if unknown:
+        raise ValueError("Unknown evidence: {}".format(", ".join(sorted(map(str, unknown)))))
+    profile = str(case.get("profile", "default"))
+    if profile not in PROFILES:
+        raise ValueError("Unknown profile: {}".format(profile))
+    n_doctors = case.get("n_doctors", 3)
+    if isinstance(n_doctors, bool) or not isinstance(n_doctors, int) or not 1 <= n_doctors <= MAX_DOCTORS:
+        raise ValueError("n_doctors must be an integer from 1 to {}, got {}".format(MAX_DOCTORS, n_doctors))
+    mask = numpy.isin(EVIDENCE, list(evidence)).astype(float)
+    return profile, n_doctors, mask, case.get("id")
+
+
+class LatencyStats:
+    """
+        Latency of the last ``window`` cases, from the moment they were submitted to the moment their diagnosis was
+        ready, and throughput since the service started. It can be used from several threads.
+    """
+
+    def __init__(self, window=10000):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.cases = 0
+        self.batches = 0
+        self.started = perf_counter()
+
+    def add_batch(self, latencies):
+        with self._lock:
+            self._latencies.extend(latencies)
+            self.cases += len(latencies)
+            self.batches += 1
+
+    def reset(self):
+        with self._lock:
+            self._latencies.clear()
+            self.cases = self.batches = 0
+            self.started = perf_counter()
+
+    def report(self):
+        """
+        Returns:
+            dict with the number of ``cases`` and ``batches``, the ``mean_batch_size``, the ``p50_ms`` and
+            ``p99_ms`` latencies and the ``throughput`` in cases per second
+        """
+        with self._lock:
+            latencies = numpy.array(self._latencies)
+            cases, batches, elapsed = self.cases, self.batches, perf_counter() - self.started
+        p50, p99 = numpy.percentile(latencies, [50, 99]) * 1000 if len(latencies) else (numpy.nan, numpy.nan)
+        return {"cases": cases, "batches": batches, "mean_batch_size": cases / batches if batches else 0.,
+                "p50_ms": float(p50), "p99_ms": float(p99), "throughput": cases / elapsed if elapsed > 0 else 0.}
+
+
+class DiagnosisService:
+    """
+        Diagnoses a stream of patient cases with micro-batching. Cases can be submitted from any number of threads. A
+        single batching thread takes the cases that arrive within ``max_wait`` seconds of the first one (at most
+        ``max_batch`` of them), and simulates the ones with committees of the same size as one MedicalEnsemble,
+        every case with its own committee profile and weight matrix. The ensemble stops once every committee has
+        converged. The cost of a batch grows much slower than the number of cases in it.
+
+        Everything that does not depend on the cases (the weight matrices, the random generator and numpy's code
+        paths, warmed up by ``start``) is kept between batches.
+
+        Attributes:
+            stats (LatencyStats): Latency and throughput of the cases diagnosed so far
+    """
+
+    def __init__(self, max_batch=256, max_wait=0.002, max_steps=50, convergence_tol=1e-6, seed=None,
+                 arg_weight_vector=None):
+        """
+        Args:
+            max_batch (int): Maximum number of cases simulated at once
+            max_wait (float): Seconds the batching thread waits for more cases after the first one of a batch
+            max_steps (int): Maximum argumentation rounds of every committee
+            convergence_tol (float): A committee has converged once no belief changes more than this in a round. None
+                always runs max_steps rounds
+            seed (int): Seed of the committees, so that the same stream of batches can be reproduced
+            arg_weight_vector: Relevance of every argument for every disease, as in MedicalModel. Defaults to
+                DEFAULT_CASE_WEIGHTS
+        """
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_steps = max_steps
+        self.convergence_tol = convergence_tol
+        self.diseases = list(MedicalModel.LIST_OF_DISEASES.values())
+        self.weight_matrix = make_weight_matrix(arg_weight_vector if arg_weight_vector is not None else
+                                                DEFAULT_CASE_WEIGHTS, self.diseases, len(EVIDENCE))
+        self.stats = LatencyStats()
+        self._rng = numpy.random.default_rng(seed)
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self, warm_up=True):
+        """ Starts the batching thread. With ``warm_up``, first simulates a batch of every profile. """
+        if warm_up:
+            for profile in PROFILES:
+                self.diagnose_batch([({"profile": profile}, None)])
+            self.stats.reset()
+        self._thread = threading.Thread(target=self._batch_loop, name="diagnosis-batcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Diagnoses the cases already submitted and stops the batching thread. """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, case):
+        """
+        Queues a case, see parse_case.
+
+        Returns:
+            Future of the diagnosis, a dict with the ``final_decision``, the ``diagnosis_probabilities`` of every
+            disease and the ``id`` of the case
+        """
+        if self._thread is None:
+            raise ValueError("The service is not started")
+        parse_case(case)  # Invalid cases are rejected here, and not in the batch of the other cases
+        future = Future()
+        self._queue.put((case, future, perf_counter()))
+        return future
+
+    def diagnose(self, case, timeout=None):
+        return self.submit(case).result(timeout)
+
+    def _batch_loop(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0., deadline - perf_counter()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                results = self.diagnose_batch([(case, submitted) for case, future, submitted in batch])
+            except Exception as exc:
+                for case, future, submitted in batch:
+                    future.set_exception(exc)
+            else:
+                for (case, future, submitted), result in zip(batch, results):
+                    future.set_result(result)
+
+    def diagnose_batch(self, cases):
+        """
+        Simulates a batch of cases at once, one ensemble per committee size.
+
+        Args:
+            cases (list): ``(case, submitted)`` pairs, where ``submitted`` is the perf_counter time the case was
+                submitted at, or None to leave it out of the stats
+
+        Returns:
+            List with the diagnosis of every case, see submit
+        """
+        parsed = [parse_case(case) for case, submitted in cases]
+        results = [None] * len(cases)
+        n_args = len(EVIDENCE)
+        by_size = {}
+        for i, (profile, n_doctors, mask, case_id) in enumerate(parsed):
+            by_size.setdefault(n_doctors, []).append(i)
+        for n_doctors, members in by_size.items():
+            runs = len(members)
+            beliefs = numpy.empty((runs, n_doctors, n_args))
+            influence = numpy.empty((runs, n_doctors))
+            stubbornness = numpy.empty((runs, n_doctors))
+            profiles = numpy.array([parsed[i][0] for i in members])
+            for profile in numpy.unique(profiles):
+                rows = numpy.flatnonzero(profiles == profile)
+                beliefs[rows], influence[rows], stubbornness[rows] = sample_committees(
+                    PROFILE_ROLES[profile], len(rows), n_doctors, n_args, rng=self._rng)
+            weights = self.weight_matrix[None] * numpy.array([parsed[i][2] for i in members])[:, None, :]
+            ensemble = MedicalEnsemble(runs, N=n_doctors, n_init_arg=n_args, arg_weight_vector=weights,
+                                       seed=self._rng, diseases=self.diseases, convergence_tol=self.convergence_tol,
+                                       initial_state=(beliefs, influence, stubbornness))
+            ensemble.run(self.max_steps, stop_when_converged=self.convergence_tol is not None)
+            for row, i in enumerate(members):
+                results[i] = {"id": parsed[i][3], "final_decision": ensemble.final_decision[row],
+                              "diagnosis_probabilities": dict(zip(self.diseases,
+                                                                  ensemble.diagnosis_probabilities[row].tolist()))}
+        done = perf_counter()
+        latencies = [done - submitted for case, submitted in cases if submitted is not None]
+        if latencies:
+            self.stats.add_batch(latencies)
+        return results
+
+
+class DiagnosisHandler(BaseHTTPRequestHandler):
+    """
+        ``POST /diagnose`` with a case, or a list of cases, returns their diagnosis. ``GET /stats`` returns the
+        latency and throughput of the service. Connections are kept alive between requests.
+    """
+    protocol_version = "HTTP/1.1"
+    service = None  # Set by make_server
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._reply(200, self.service.stats.report())
+        else:
+            self._reply(404, {"error": "Unknown path: {}".format(self.path)})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != "/diagnose":
+            self._reply(404, {"error": "Unknown path: {}".format(self.path)})
+            return
+        try:
+            cases = json.loads(body)
+            if isinstance(cases, list):
+                futures = [self.service.submit(case) for case in cases]
+                self._reply(200, [future.result() for future in futures])
+            else:
+                self._reply(200, self.service.submit(cases).result())
+        except ValueError as exc:  # Includes malformed JSON
+            self._reply(400, {"error": str(exc)})
+        except Exception as exc:
+            self._reply(500, {"error": repr(exc)})
+
+    def log_message(self, format, *args):
+        # One line per request would cost more than the diagnosis itself
+        pass
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("local", 0)  # BaseHTTPRequestHandler expects a (host, port) address
+
+
+def make_server(service, host="127.0.0.1", port=8765, unix_socket=None):
+    """
+    Returns:
+        HTTP server of the service, listening on ``host:port``, or on the ``unix_socket`` path if given
+    """
+    handler = type("BoundDiagnosisHandler", (DiagnosisHandler,), {"service": service})
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, handler)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def load_test(service, n_cases=10000, concurrency=64, seed=None):
+    """
+    Submits ``n_cases`` random cases from ``concurrency`` client threads, each waiting for its diagnosis before
+    sending the next case, as a set of synchronous clients would.
+
+    Returns:
+        The stats of the service over the test, see LatencyStats.report
+    """
+    rng = numpy.random.default_rng(seed)
+    cases = [{"evidence": [e for e in EVIDENCE if rng.random() < 0.6], "profile": str(rng.choice(PROFILES)),
+              "n_doctors": int(rng.integers(3, 6)), "id": i} for i in range(n_cases)]
+    service.stats.reset()
+
+    def client(start):
+        for case in cases[start::concurrency]:
+            service.diagnose(case)
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(client, range(concurrency)))
+    return service.stats.report()
+
+
+def format_stats(stats):
+    return ("{cases} cases in {batches} batches ({mean_batch_size:.1f} cases per batch), latency p50 {p50_ms:.2f} ms "
+            "p99 {p99_ms:.2f} ms, {throughput:.0f} cases/s".format(**stats))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Committee diagnosis service for streams of patient cases')
+    parser.add_argument('--host', type=str, default="127.0.0.1",
+                        help='Address the service listens on.')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='Port the service listens on.')
+    parser.add_argument('--unix_socket', type=str, default=None,
+                        help='Listen on this Unix socket instead of a TCP port.')
+    parser.add_argument('--max_batch', type=int, default=256,
+                        help='Maximum number of cases simulated at once.')
+    parser.add_argument('--max_wait_ms', type=float, default=2.,
+                        help='Milliseconds the service waits for more cases before simulating a batch.')
+    parser.add_argument('--max_steps', type=int, default=50,
+                        help='Argumentation rounds of every committee.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of the committees.')
+    parser.add_argument('--load_test', type=int, default=None,
+                        help='Instead of serving, diagnose this many random cases in process and print the latency '
+                             'and throughput.')
+    parser.add_argument('--concurrency', type=int, default=64,
+                        help='With --load_test, number of concurrent clients.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    service = DiagnosisService(args.max_batch, args.max_wait_ms / 1000, args.max_steps, seed=args.seed).start()
+    if args.load_test is not None:
+        print(format_stats(load_test(service, args.load_test, args.concurrency, args.seed)))
+        service.stop()
+    else:
+        server = make_server(service, args.host, args.port, args.unix_socket)
+        print("Serving on {}".format(args.unix_socket or "http://{}:{}".format(args.host, args.port)))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            service.stop()
+            print(format_stats(service.stats.report()))
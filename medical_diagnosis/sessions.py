@@ -0,0 +1,288 @@
+import itertools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import tornado.escape
+import tornado.ioloop
+import tornado.websocket
+from mesa.visualization.ModularVisualization import ModularServer
+from mesa.visualization.UserParam import UserSettableParameter
+
+from medical_diagnosis.cache import canonical
+from medical_diagnosis.streaming import YIELD_INTERVAL, FrameControl, frame_interval
+
+
+class ModelPool:
+    """
+        Idle models kept for reuse, keyed by their parameters. Acquiring a model with the same parameters as an idle
+        one recycles it (see MedicalModel.recycle) instead of building a new one. It can be used from several threads.
+
+        Attributes:
+            built (int): Number of models that had to be built
+            recycled (int): Number of models that were recycled
+    """
+
+    def __init__(self, model_cls, max_idle=16):
+        """
+        Args:
+            model_cls: Class of the models. It must have a ``recycle(seed)`` method
+            max_idle (int): Maximum number of idle models kept. Models released beyond that are dropped
+        """
+        self.model_cls = model_cls
+        self.max_idle = max_idle
+        self.built = 0
+        self.recycled = 0
+        self._idle = {}  # Idle models keyed by their parameters
+        self._n_idle = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(params):
+        return json.dumps(canonical(params), sort_keys=True)
+
+    def acquire(self, params, seed=None):
+        """
+        Returns:
+            A model at step 0, as ``model_cls(seed=seed, **params)`` would return
+        """
+        key = self.key(params)
+        with self._lock:
+            idle = self._idle.get(key)
+            model = idle.pop() if idle else None
+            if model is None:
+                self.built += 1
+            else:
+                self._n_idle -= 1
+                self.recycled += 1
+        if model is None:
+            return self.model_cls(seed=seed, **params)
+        model.recycle(seed)
+        return model
+
+    def release(self, model, params):
+        """ Gives back a model that is not used anymore. """
+        if getattr(model, "trace", None) is not None:  # Recycling would end its trace
+            return
+        with self._lock:
+            if self._n_idle < self.max_idle:
+                self._idle.setdefault(self.key(params), []).append(model)
+                self._n_idle += 1
+
+
+class Session:
+    """
+        One independent simulation, owned by one browser connection.
+
+        Attributes:
+            params (dict): Parameters for the session's next model, changed from the sidebar
+            model: The session's model, None until the browser asks for the first reset
+            model_params (dict): Parameters the current model was built with
+            streaming (bool): Whether the model is being fast forwarded
+    """
+
+    def __init__(self, session_id, params):
+        self.session_id = session_id
+        self.params = params
+        self.model = None
+        self.model_params = None
+        self.streaming = False
+        self.lock = threading.Lock()  # Held by the worker thread that steps or renders the model
+
+
+class SessionSocketHandler(tornado.websocket.WebSocketHandler):
+    """
+    Websocket handler of the SessionServer. Every connection gets its own Session, and understands the same messages
+    as StreamingSocketHandler. The model is only stepped and rendered in the server's worker threads, so the IOLoop is
+    free to serve the other sessions meanwhile.
+    """
+
+    def check_origin(self, origin):
+        return True
+
+    def open(self):
+        application = self.application
+        self.session = None
+        if len(application.sessions) >= application.max_sessions:
+            self.close(reason="Too many sessions")
+            return
+        self.session = application.open_session()
+
+    def on_close(self):
+        if self.session is not None:
+            self.session.streaming = False
+            self.application.close_session(self.session)
+
+    def send_frame(self, frame):
+        if frame is not None:
+            self.write_message({"type": "viz_state", "data": frame})
+
+    async def on_message(self, message):
+        msg = tornado.escape.json_decode(message)
+        application = self.application
+        session = self.session
+        if msg["type"] == "get_step":
+            if session.model is None or not session.model.running:
+                self.write_message({"type": "end"})
+            else:
+                self.send_frame(await application.submit(application.step_session, session,
+                                                         application.steps_per_frame))
+        elif msg["type"] == "reset":
+            session.streaming = False
+            self.send_frame(await application.submit(application.reset_session, session))
+        elif msg["type"] == "fast_forward":
+            if not session.streaming:
+                session.streaming = True
+                tornado.ioloop.IOLoop.current().spawn_callback(self.run_headless,
+                                                               frame_interval=frame_interval(
+                                                                   msg, application.visualization_elements))
+        elif msg["type"] == "jump":
+            session.streaming = False
+            tornado.ioloop.IOLoop.current().spawn_callback(self.run_headless, target_step=int(msg["step"]))
+        elif msg["type"] == "pause":
+            session.streaming = False
+        elif msg["type"] == "submit_params":
+            if msg["param"] in application.user_params:
+                session.params[msg["param"]] = msg["value"]
+        elif msg["type"] == "get_params":
+            self.write_message({"type": "model_params", "params": application.user_params})
+
+    async def run_headless(self, target_step=None, frame_interval=None):
+        """
+        Like StreamingSocketHandler.run_headless, but the steps run in the server's worker threads, in slices of
+        YIELD_INTERVAL seconds.
+        """
+        application = self.application
+        session = self.session
+        model = session.model
+        last_frame = perf_counter()
+        try:
+            while session.model is model and model is not None and model.running and \
+                    model.schedule.steps < application.max_steps:
+                if target_step is None and not session.streaming:
+                    break
+                if target_step is not None and model.schedule.steps >= target_step:
+                    break
+                await application.submit(application.advance_session, session, model, YIELD_INTERVAL, target_step)
+                if frame_interval is not None and perf_counter() - last_frame >= frame_interval:
+                    self.send_frame(await application.submit(application.render_session, session))
+                    last_frame = perf_counter()
+            if target_step is None:
+                session.streaming = False
+            if session.model is model and model is not None:
+                self.send_frame(await application.submit(application.render_session, session))
+                if not model.running:
+                    self.write_message({"type": "end"})
+        except tornado.websocket.WebSocketClosedError:
+            session.streaming = False
+
+
+class SessionServer(ModularServer):
+    """
+        Visualisation server hosting many independent simulations at once, one per browser connection, instead of a
+        single model shared by everyone. The sessions are served by one asyncio loop, their models are stepped by a
+        bounded pool of worker threads, and the models of closed or reset sessions are pooled and recycled.
+
+        Use it with the same elements as the StreamingServer. The parameters given as UserSettableParameter can be
+        changed by every session independently.
+    """
+    socket_handler = (r'/ws', SessionSocketHandler)
+    handlers = [ModularServer.page_handler, socket_handler, ModularServer.static_handler, ModularServer.local_handler]
+
+    def __init__(self, model_cls, visualization_elements, name="Mesa Model", model_params={}, workers=4,
+                 max_sessions=64, max_idle=16, steps_per_frame=1):
+        """
+        Args:
+            workers (int): Number of worker threads that step and render the models
+            max_sessions (int): Maximum number of sessions open at the same time. Further connections are closed
+            max_idle (int): Maximum number of idle models kept in the pool
+            steps_per_frame (int): Number of steps the Step and Start buttons advance per frame
+        """
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pool = ModelPool(model_cls, max_idle)
+        self.sessions = {}
+        self.max_sessions = max_sessions
+        self.steps_per_frame = steps_per_frame
+        self._session_ids = itertools.count()
+        super().__init__(model_cls, visualization_elements, name, model_params)
+
+    def reset_model(self):
+        # There is no shared model, every session builds its own
+        self.model = None
+
+    def submit(self, func, *args):
+        """ Runs ``func(*args)`` in a worker thread. Returns an awaitable with its result. """
+        return tornado.ioloop.IOLoop.current().run_in_executor(self.executor, func, *args)
+
+    def open_session(self):
+        params = {}
+        for key, val in self.model_kwargs.items():
+            if isinstance(val, UserSettableParameter):
+                if val.param_type == 'static_text':  # static_text is never used for setting params
+                    continue
+                params[key] = val.value
+            else:
+                params[key] = val
+        session = Session(next(self._session_ids), params)
+        self.sessions[session.session_id] = session
+        return session
+
+    def close_session(self, session):
+        del self.sessions[session.session_id]
+        if session.model is not None:
+            self.submit(self.release_model, session)
+
+    # The methods below run in the worker threads
+
+    def release_model(self, session):
+        with session.lock:
+            if session.model is not None:
+                self.pool.release(session.model, session.model_params)
+                session.model = None
+
+    def reset_session(self, session):
+        with session.lock:
+            if session.model is not None:
+                self.pool.release(session.model, session.model_params)
+            session.model_params = dict(session.params)
+            session.model = self.pool.acquire(session.model_params)
+            for element in self.visualization_elements:
+                if hasattr(element, "forget"):
+                    element.forget(session.model)
+            return self._render(session)
+
+    def step_session(self, session, n_steps):
+        with session.lock:
+            if session.model is None:  # Closed meanwhile
+                return None
+            for _ in range(n_steps):
+                if not session.model.running:
+                    break
+                session.model.step()
+            return self._render(session)
+
+    def advance_session(self, session, model, seconds, target_step=None):
+        """ Steps ``model`` for about ``seconds`` seconds, or until it reaches ``target_step``. """
+        end = perf_counter() + seconds
+        with session.lock:
+            while session.model is model and model.running and model.schedule.steps < self.max_steps and \
+                    perf_counter() < end:
+                if target_step is not None and model.schedule.steps >= target_step:
+                    break
+                model.step()
+
+    def render_session(self, session):
+        with session.lock:
+            if session.model is None:  # Closed meanwhile
+                return None
+            return self._render(session)
+
+    def _render(self, session):
+        visualization_state = []
+        for element in self.visualization_elements:
+            element_state = element.render(session.model)
+            if isinstance(element, FrameControl):
+                element_state["streaming"] = session.streaming
+            visualization_state.append(element_state)
+        return visualization_state
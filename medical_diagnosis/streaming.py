@@ -0,0 +1,185 @@
+import json
+import os
+from time import perf_counter
+from weakref import WeakKeyDictionary
+
+import numpy
+import tornado.escape
+import tornado.gen
+import tornado.ioloop
+import tornado.websocket
+from mesa.visualization.ModularVisualization import ModularServer, SocketHandler, VisualizationElement
+
+JS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "js")
+# While running headless, control goes back to the IOLoop at least this often (in seconds), so that pause, reset and
+# other messages are handled
+YIELD_INTERVAL = 0.05
+
+
+def read_js(file_name):
+    with open(os.path.join(JS_DIR, file_name)) as f:
+        return f.read()
+
+
+class FrameControl(VisualizationElement):
+    """
+    Step counter and controls of the StreamingServer: fast forward at a given frame rate, and jump to a step. It must
+    be the first element of the visualization.
+    """
+
+    def __init__(self, frame_rate=10):
+        self.frame_rate = frame_rate
+        self.js_code = read_js("FrameControl.js") + "elements.push(new FrameControl({}));".format(
+            json.dumps(frame_rate))
+
+    def render(self, model):
+        # StreamingServer adds whether it is fast forwarding
+        return {"step": model.schedule.steps}
+
+
+def frame_interval(msg, visualization_elements):
+    """
+    Seconds between two frames while fast forwarding, from the ``frame_rate`` of a fast_forward message. The message
+    comes from the browser, so a missing rate, or one that is not a positive number, falls back to the frame rate of
+    the FrameControl among ``visualization_elements``.
+    """
+    frame_rate = msg.get("frame_rate")
+    if isinstance(frame_rate, bool) or not isinstance(frame_rate, (int, float)) or not 0 < frame_rate < float("inf"):
+        frame_rate = next((element.frame_rate for element in visualization_elements
+                           if isinstance(element, FrameControl)), 10)
+    return 1 / frame_rate
+
+
+class BeliefDeltaElement(VisualizationElement):
+    """
+    Table with the belief arrays of all the doctors. Instead of re-rendering the whole table on every frame, only the
+    values that changed (once rounded to ``decimals``) since the previous frame are sent, with their flat index in the
+    belief matrix. If most of them changed the whole matrix is cheaper to send, and it is sent instead.
+
+    What has been sent is tracked for every model, so one element can serve several models at once (see sessions.py).
+    """
+
+    def __init__(self, decimals=3):
+        self.decimals = decimals
+        self.js_code = read_js("BeliefDeltaModule.js") + "elements.push(new BeliefDeltaModule());"
+        self._shown = WeakKeyDictionary()  # Beliefs of every model as they are displayed in the browser
+
+    def forget(self, model):
+        """ The browser cleared the table of ``model``, so the next frame has to hold everything. """
+        self._shown.pop(model, None)
+
+    def render(self, model):
+        beliefs = numpy.round(model.belief_matrix, self.decimals)
+        shown = self._shown.get(model)
+        changed = numpy.flatnonzero(beliefs != shown) if shown is not None else None
+        if changed is None or 2 * len(changed) > beliefs.size:
+            # New model (e.g. after a reset) or too many changes, send everything
+            self._shown[model] = beliefs
+            return {"full": beliefs.tolist(), "argument_names": model.argument_names}
+        values = beliefs.flat[changed]
+        shown.flat[changed] = values
+        return {"indices": changed.tolist(), "values": values.tolist()}
+
+
+class StreamingSocketHandler(SocketHandler):
+    """
+    Websocket handler of the StreamingServer. Besides mesa's messages, it understands:
+
+        fast_forward: ``{"type": "fast_forward", "frame_rate": 10}`` runs the model headless at full speed, sending
+            at most frame_rate frames per second, until it stops running or a pause message arrives
+        pause: ``{"type": "pause"}`` stops fast forwarding
+        jump: ``{"type": "jump", "step": 500}`` runs the model headless up to the given step and sends one frame
+    """
+
+    def on_message(self, message):
+        msg = tornado.escape.json_decode(message)
+        application = self.application
+        if msg["type"] == "get_step":
+            if not application.model.running:
+                self.write_message({"type": "end"})
+            else:
+                application.advance(application.steps_per_frame)
+                self.write_message(self.viz_state_message)
+        elif msg["type"] == "fast_forward":
+            if not application.streaming:
+                application.streaming = True
+                tornado.ioloop.IOLoop.current().spawn_callback(self.run_headless,
+                                                               frame_interval=frame_interval(
+                                                                   msg, application.visualization_elements))
+        elif msg["type"] == "jump":
+            application.streaming = False
+            tornado.ioloop.IOLoop.current().spawn_callback(self.run_headless, target_step=int(msg["step"]))
+        elif msg["type"] == "pause":
+            application.streaming = False
+        else:
+            if msg["type"] == "reset":
+                application.streaming = False
+            super().on_message(message)
+
+    def on_close(self):
+        self.application.streaming = False
+
+    async def run_headless(self, target_step=None, frame_interval=None):
+        """
+        Steps the model without rendering, giving control back to the IOLoop every YIELD_INTERVAL seconds.
+
+        Args:
+            target_step (int): Step to jump to. If None, runs while ``application.streaming`` is set
+            frame_interval (float): Minimum number of seconds between two frames. If None, only the final state is
+                sent
+        """
+        application = self.application
+        model = application.model
+        last_frame = last_yield = perf_counter()
+        try:
+            while model is application.model and model.running and model.schedule.steps < application.max_steps:
+                if target_step is None and not application.streaming:
+                    break
+                if target_step is not None and model.schedule.steps >= target_step:
+                    break
+                model.step()
+                now = perf_counter()
+                if frame_interval is not None and now - last_frame >= frame_interval:
+                    self.write_message(self.viz_state_message)
+                    last_frame = now
+                if now - last_yield >= YIELD_INTERVAL:
+                    await tornado.gen.sleep(0)
+                    last_yield = perf_counter()
+            if target_step is None:
+                application.streaming = False
+            if model is application.model:
+                self.write_message(self.viz_state_message)
+                if not model.running:
+                    self.write_message({"type": "end"})
+        except tornado.websocket.WebSocketClosedError:
+            application.streaming = False
+
+
+class StreamingServer(ModularServer):
+    """
+        ModularServer for large committees. The model can run headless at full speed while the browser gets a frame
+        only every ``steps_per_frame`` steps (Step and Start buttons) or at most ``frame_rate`` times per second (fast
+        forward). Use it with a FrameControl as first element, and a BeliefDeltaElement instead of the bar chart of the
+        belief arrays.
+    """
+    socket_handler = (r'/ws', StreamingSocketHandler)
+    handlers = [ModularServer.page_handler, socket_handler, ModularServer.static_handler, ModularServer.local_handler]
+
+    def __init__(self, model_cls, visualization_elements, name="Mesa Model", model_params={}, steps_per_frame=1):
+        self.steps_per_frame = steps_per_frame
+        self.streaming = False
+        super().__init__(model_cls, visualization_elements, name, model_params)
+
+    def advance(self, n_steps):
+        """ Steps the model up to ``n_steps`` times, without rendering. """
+        for _ in range(n_steps):
+            if not self.model.running:
+                break
+            self.model.step()
+
+    def render_model(self):
+        visualization_state = super().render_model()
+        for element, state in zip(self.visualization_elements, visualization_state):
+            if isinstance(element, FrameControl):
+                state["streaming"] = self.streaming
+        return visualization_state
@@ -0,0 +1,206 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+from itertools import product
+
+import numpy
+import pandas
+
+
+def new_root_seed():
+    """
+    Returns:
+        A fresh root seed taken from the OS entropy, to be stored with the results so the sweep can be reproduced
+    """
+    return int(numpy.random.SeedSequence().entropy)
+
+
+def resolve_root_seed(seed, sink=None):
+    """
+    Returns:
+        ``seed`` if given. Otherwise the root seed stored in ``sink`` when resuming a sweep, or a fresh one
+    """
+    if seed is None and sink is not None and sink.stored_sweep() is not None:
+        seed = sink.stored_sweep()["seed"]
+    if seed is None:
+        seed = new_root_seed()
+    return seed
+
+
+def cell_seed(root_seed, *key):
+    """
+    Derives the seed of one cell of a sweep from the root seed, using numpy's ``SeedSequence``. The seed only depends
+    on the root seed and the key of the cell (e.g. its parameter values and iteration), so it is the same no matter
+    how the cells are distributed, or whether the sweep is later widened with more values or iterations.
+
+    Args:
+        root_seed (int): Root seed of the sweep
+        key: Values that identify the cell
+
+    Returns:
+        Integer seed, valid for both ``random.Random`` and ``numpy.random.default_rng``
+    """
+    digest = hashlib.sha256(repr(key).encode()).digest()
+    spawn_key = tuple(int.from_bytes(digest[i:i + 4], 'little') for i in range(0, 16, 4))
+    state = numpy.random.SeedSequence(root_seed, spawn_key=spawn_key).generate_state(4)
+    return int.from_bytes(state.tobytes(), 'little')
+
+
+def make_sweep_cells(variable_params, fixed_params, iterations):
+    """
+    Expands the grid of variable parameters, in the same order as mesa's ``BatchRunner``.
+
+    Returns:
+        List of ``(param_values, iteration, kwargs)`` tuples, ``iterations`` times each combination
+    """
+    param_names, param_ranges = zip(*variable_params.items())
+    cells = []
+    for param_values in product(*param_ranges):
+        kwargs = dict(zip(param_names, param_values))
+        kwargs.update(fixed_params)
+        cells.extend((param_values, iteration, kwargs) for iteration in range(iterations))
+    return cells
+
+
+def run_chunk(model_cls, chunk, max_steps, model_reporters):
+    """
+    Runs a chunk of the sweep. This is the unit of work sent to every worker process.
+
+    Args:
+        model_cls: Class of the model to run
+        chunk (list): ``(run, param_values, iteration, kwargs, seed)`` tuples
+        max_steps (int): Maximum number of steps of every run
+        model_reporters (dict): Reporters evaluated on every model once it has finished
+
+    Returns:
+        List with the reports of every run of the chunk
+    """
+    results = []
+    for run, param_values, iteration, kwargs, seed in chunk:
+        model = model_cls(seed=seed, **kwargs)
+        while model.running and model.schedule.steps < max_steps:
+            model.step()
+        results.append({var: reporter(model) for var, reporter in model_reporters.items()})
+        if hasattr(model, "close"):  # Files the model writes, such as its trace
+            model.close()
+    return results
+
+
+def make_records(param_names, chunk, reports):
+    """
+    Returns:
+        One dict per run of the chunk, with its variable parameters, its ``Run`` number and its reports
+    """
+    records = []
+    for (run, param_values, iteration, kwargs, run_seed), run_reports in zip(chunk, reports):
+        record = dict(zip(param_names, param_values))
+        record["Run"] = run
+        record.update(run_reports)
+        records.append(record)
+    return records
+
+
+def make_sweep_work(variable_params, fixed_params, iterations, seed):
+    """
+    Returns:
+        List with the ``(run, param_values, iteration, kwargs, seed)`` of every run of the sweep, as run_chunk takes
+    """
+    return [(run, param_values, iteration, kwargs, cell_seed(seed, param_values, iteration))
+            for run, (param_values, iteration, kwargs) in enumerate(make_sweep_cells(variable_params, fixed_params,
+                                                                                    iterations))]
+
+
+def records_frame(records, param_names):
+    """
+    Returns:
+        DataFrame of the records sorted by run, with the variable parameters and Run first
+    """
+    index_cols = list(param_names) + ["Run"]
+    df = pandas.DataFrame(records).sort_values("Run").reset_index(drop=True)
+    return df[index_cols + sorted(set(df.columns) - set(index_cols))]
+
+
+def run_sweep(model_cls, variable_params, fixed_params, iterations, max_steps, model_reporters, workers=1,
+              chunk_size=None, seed=None, sink=None, cache=None):
+    """
+    Parallel replacement for mesa's ``BatchRunner``. The grid of ``variable_params`` times ``iterations`` is split in
+    chunks that are run by a pool of worker processes. Every run gets its own seed derived from ``seed`` and its cell,
+    so the results are identical whatever the number of workers.
+
+    Args:
+        model_cls: Class of the model to run. It must accept a ``seed`` keyword
+        variable_params (dict): Values to sweep over, keyed by parameter name
+        fixed_params (dict): Parameters shared by every run
+        iterations (int): Number of runs for each combination of the variable parameters
+        max_steps (int): Maximum number of steps of every run
+        model_reporters (dict): Reporters evaluated on every model once it has finished. They must be picklable
+        workers (int): Number of worker processes. With 1 everything runs in this process
+        chunk_size (int): Number of runs per unit of work. By default the runs are split in about 4 chunks per worker
+        seed (int): Root seed of the sweep
+        sink (ResultSink): If given, every chunk is written to it as soon as it finishes, and the cells it already
+            holds are skipped, so an interrupted sweep can be resumed
+        cache (SweepCache): If given, the runs found in it are not computed again, and the new ones are added to it
+
+    Returns:
+        DataFrame with the variable parameters, the ``Run`` number (position in the grid) and the reporters, like
+        ``BatchRunner.get_model_vars_dataframe``. With a sink nothing is kept in memory and None is returned, the
+        results are read back from the sink
+    """
+    if workers < 1:
+        raise ValueError("Invalid number of workers: {}".format(workers))
+    seed = resolve_root_seed(seed, sink)
+    param_names = list(variable_params.keys())
+    if sink is not None:
+        # The number of iterations and the values of the variable parameters are left out, so a sweep can also be
+        # widened in the same directory
+        sink.open_sweep({"seed": seed, "variable_params": param_names, "max_steps": max_steps,
+                         "fixed_params": {name: repr(value) for name, value in fixed_params.items()}})
+
+    work = [cell for cell in make_sweep_work(variable_params, fixed_params, iterations, seed)
+            if sink is None or not sink.is_done(cell[1] + (cell[2], cell[4]))]
+
+    records = []
+
+    def chunk_done(chunk, reports):
+        chunk_records = make_records(param_names, chunk, reports)
+        if sink is not None:
+            sink.write_chunk(chunk_records, [param_values + (iteration, run_seed)
+                                             for run, param_values, iteration, kwargs, run_seed in chunk])
+        else:
+            records.extend(chunk_records)
+
+    def cache_key(cell):
+        run, param_values, iteration, kwargs, run_seed = cell
+        return cache.key(model_cls, kwargs, max_steps, run_seed, model_reporters)
+
+    def computed(chunk, reports):
+        if cache is not None:
+            cache.put_many(zip(map(cache_key, chunk), reports))
+        chunk_done(chunk, reports)
+
+    if cache is not None:
+        keys = [cache_key(cell) for cell in work]
+        found = cache.get_many(keys)
+        hits = [cell for cell, key in zip(work, keys) if key in found]
+        if hits:
+            chunk_done(hits, [found[key] for key in keys if key in found])
+        work = [cell for cell, key in zip(work, keys) if key not in found]
+
+    if chunk_size is None:
+        chunk_size = max(1, -(-len(work) // (4 * workers)))
+    chunks = [work[i:i + chunk_size] for i in range(0, len(work), chunk_size)]
+
+    if workers == 1:
+        for chunk in chunks:
+            computed(chunk, run_chunk(model_cls, chunk, max_steps, model_reporters))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run_chunk, model_cls, chunk, max_steps, model_reporters): chunk
+                       for chunk in chunks}
+            for future in as_completed(futures):
+                computed(futures[future], future.result())
+
+    if sink is not None:
+        return None
+    if not records:  # Nothing to run, e.g. no iterations
+        return pandas.DataFrame(columns=param_names + ["Run"] + sorted(model_reporters))
+    return records_frame(records, param_names)
@@ -0,0 +1,110 @@
+import random
+
+import numpy
+
+# networkx is only imported by the generators, so that the model (and a batch run without topology) starts without it
+
+# Names of the generated topologies, usable as the ``topology`` of a MedicalModel
+TOPOLOGIES = ("complete", "small_world", "scale_free", "hierarchical")
+
+
+def small_world(n, k=6, p=0.1, rng=random):
+    """
+    Watts-Strogatz small-world network: every doctor talks to its ``k`` nearest colleagues on a ring, and each of
+    those links is rewired to a random colleague with probability ``p``.
+    """
+    import networkx
+
+    k = min(k, n - 1)
+    return networkx.watts_strogatz_graph(n, k, p, seed=rng)
+
+
+def scale_free(n, m=3, rng=random):
+    """
+    Barabasi-Albert scale-free network: a few very connected doctors (hubs) and many with only ``m`` or so links.
+    """
+    import networkx
+
+    m = max(1, min(m, n - 1))
+    return networkx.barabasi_albert_graph(n, m, seed=rng) if n > 1 else networkx.empty_graph(n)
+
+
+def hierarchical(n, department_size=10, p_within=1.0, rng=random):
+    """
+    Hospital made of departments. Doctors talk to the colleagues of their own department with probability
+    ``p_within``, and the first doctor of every department is its head, which also talks to all the other heads.
+    """
+    import networkx
+
+    graph = networkx.empty_graph(n)
+    heads = list(range(0, n, department_size))
+    for head in heads:
+        department = range(head, min(head + department_size, n))
+        graph.add_edges_from((i, j) for i in department for j in department if i < j and rng.random() < p_within)
+    graph.add_edges_from((i, j) for i in heads for j in heads if i < j)
+    return graph
+
+
+def make_topology(name, n, rng=random, **kwargs):
+    """
+    Generates one of the TOPOLOGIES for a committee of ``n`` doctors.
+
+    Args:
+        name (str): One of TOPOLOGIES
+        n (int): Number of doctors
+        rng (random.Random): Random generator used to build the graph
+        kwargs: Parameters of the generator, e.g. ``k`` and ``p`` for small_world
+
+    Returns:
+        networkx.Graph with the doctors 0 to n-1 as nodes
+    """
+    if name == "complete":
+        import networkx
+
+        return networkx.complete_graph(n)
+    elif name == "small_world":
+        return small_world(n, rng=rng, **kwargs)
+    elif name == "scale_free":
+        return scale_free(n, rng=rng, **kwargs)
+    elif name == "hierarchical":
+        return hierarchical(n, rng=rng, **kwargs)
+    raise ValueError("Unknown topology: {}".format(name))
+
+
+def neighbour_lists(topology, n):
+    """
+    Converts an influence graph to compressed sparse row (CSR) form, so that the colleagues a doctor can influence are
+    a contiguous slice ``indices[indptr[i]:indptr[i + 1]]``. Self-loops are dropped, as a doctor does not influence
+    themselves.
+
+    Args:
+        topology: A networkx graph with the doctors 0 to n-1 as nodes (for a directed graph, a speaker influences its
+            successors), a scipy.sparse adjacency matrix, or an ``(indptr, indices)`` tuple
+        n (int): Number of doctors
+
+    Returns:
+        ``(indptr, indices)`` numpy arrays
+    """
+    if hasattr(topology, "neighbors"):  # networkx graph
+        graph = topology
+        neighbours = [sorted(j for j in graph.neighbors(i) if j != i) for i in range(n)]
+        indptr = numpy.zeros(n + 1, dtype=numpy.intp)
+        indptr[1:] = numpy.cumsum([len(row) for row in neighbours])
+        indices = numpy.fromiter((j for row in neighbours for j in row), dtype=numpy.intp, count=indptr[-1])
+        return indptr, indices
+    if hasattr(topology, "tocsr"):
+        adjacency = topology.tocsr()
+        adjacency.sort_indices()
+        indptr, indices = adjacency.indptr, adjacency.indices
+    else:
+        indptr, indices = topology
+    indptr = numpy.asarray(indptr, dtype=numpy.intp)
+    indices = numpy.asarray(indices, dtype=numpy.intp)
+    if len(indptr) != n + 1:
+        raise ValueError("The influence graph must have {} rows, got {}".format(n, len(indptr) - 1))
+    rows = numpy.repeat(numpy.arange(n), numpy.diff(indptr))
+    keep = indices != rows
+    if not keep.all():
+        indptr = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(rows[keep], minlength=n))))
+        indices = indices[keep]
+    return indptr, indices
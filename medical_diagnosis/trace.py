@@ -0,0 +1,59 @@
+import numpy
+
+TRACE_MAGIC = b'MDTRACE1'
+
+
+def trace_dtype(n_doctors, n_args, n_diseases):
+    """
+    Fixed-width record of the trace file. Every record holds the state of the committee right after one speaker's
+    turn (speaker -1 is used for the initial state).
+    """
+    return numpy.dtype([('step', '<i4'),
+                        ('speaker', '<i4'),
+                        ('beliefs', '<f8', (n_doctors, n_args)),
+                        ('probabilities', '<f8', (n_diseases,))])
+
+
+class TraceRecorder:
+    """
+        Appends binary trace records to a file. The file starts with a short header (magic bytes plus the number of
+        doctors, arguments and diseases) so it can be read back with :func:`read_trace`.
+    """
+
+    def __init__(self, path, n_doctors, n_args, n_diseases):
+        self.path = path
+        self._record = numpy.zeros(1, dtype=trace_dtype(n_doctors, n_args, n_diseases))  # Reused for every record
+        self._file = open(path, 'wb')
+        self._file.write(TRACE_MAGIC)
+        numpy.asarray([n_doctors, n_args, n_diseases], dtype='<i4').tofile(self._file)
+
+    def record(self, step, speaker, beliefs, probabilities):
+        record = self._record
+        record['step'] = step
+        record['speaker'] = speaker
+        record['beliefs'] = beliefs
+        record['probabilities'] = probabilities
+        self._file.write(record.tobytes())
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_trace(path):
+    """
+    Reads a trace file written by :class:`TraceRecorder`.
+
+    Args:
+        path (str): Path of the trace file
+
+    Returns:
+        numpy structured array with the fields step, speaker, beliefs and probabilities
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError("{} is not a trace file".format(path))
+        n_doctors, n_args, n_diseases = numpy.fromfile(f, dtype='<i4', count=3)
+        return numpy.fromfile(f, dtype=trace_dtype(n_doctors, n_args, n_diseases))
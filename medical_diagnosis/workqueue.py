@@ -0,0 +1,301 @@
+import argparse
+import json
+import os
+import pickle
+import threading
+import time
+from multiprocessing import Process
+
+import pandas
+
+from medical_diagnosis.sweep import make_records, make_sweep_work, records_frame, resolve_root_seed, run_chunk
+
+SWEEP_FILE = "sweep.json"
+TASK_DIRS = ("tasks", "leased", "results")
+
+
+class WorkQueue:
+    """
+        Work queue of a sweep in a shared directory, so that workers on any node that can see the directory can run
+        it, with no broker. Every operation is an atomic rename, which shared filesystems such as NFS support:
+
+        - The coordinator writes every chunk of the sweep as a pickled task in ``tasks/``.
+        - A worker leases a task by renaming it to ``leased/``. Only one worker can win that rename. While it runs
+          the task, the worker touches the leased file every few seconds (heartbeat).
+        - The worker writes the results as a CSV shard in ``results/``, first under a temporary name, and then
+          removes the leased file.
+        - A leased file that has not been touched for ``lease_seconds`` belongs to a worker that died, and the task
+          is moved back to ``tasks/``. If that worker was only slow and finishes anyway, its shard is the same, as
+          the runs are seeded.
+
+        The directory looks like::
+
+            sweep.json                  description of the sweep (root seed, parameters and number of tasks),
+                                        checked when resuming
+            tasks/task_00000.pkl        tasks waiting for a worker
+            leased/task_00001.pkl       tasks being run
+            results/task_00002.csv      results of the finished tasks
+    """
+
+    def __init__(self, directory, lease_seconds=300):
+        self.directory = directory
+        self.lease_seconds = lease_seconds
+        for name in TASK_DIRS:
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    def _path(self, folder, name=""):
+        return os.path.join(self.directory, folder, name)
+
+    def stored_sweep(self):
+        """
+        Returns:
+            The description of the sweep stored in the directory, or None if it is a new one
+        """
+        path = os.path.join(self.directory, SWEEP_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def open_sweep(self, description, tasks):
+        """
+        Stores the description of the sweep, with its number of tasks, and queues its tasks. When resuming a sweep
+        (the same description is already stored) nothing is queued, as its tasks are already in the directory.
+
+        Args:
+            description (dict): JSON-serialisable description of the sweep, including its root seed
+            tasks (list): Picklable tasks
+
+        Returns:
+            True if the tasks were queued
+        """
+        description = json.loads(json.dumps(dict(description, tasks=len(tasks))))  # Same types as read back
+        stored = self.stored_sweep()
+        if stored is not None:
+            if stored != description:
+                raise ValueError("The queue in {} belongs to a different sweep: {}".format(self.directory, stored))
+            return False
+        for i, task in enumerate(tasks):
+            path = self._path("tasks", self._task_name(i))
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(task, f)
+            os.replace(path + ".tmp", path)
+        # Written last, so that an interrupted submission is submitted again
+        with open(os.path.join(self.directory, SWEEP_FILE), "w") as f:
+            json.dump(description, f)
+        return True
+
+    @staticmethod
+    def _task_name(i):
+        return "task_{:05d}.pkl".format(i)
+
+    @staticmethod
+    def _result_name(name):
+        return os.path.splitext(name)[0] + ".csv"
+
+    def lease(self):
+        """
+        Takes the first waiting task.
+
+        Returns:
+            ``(name, task)``, or None if no task is waiting
+        """
+        for name in sorted(os.listdir(self._path("tasks"))):
+            if not name.endswith(".pkl"):
+                continue
+            try:
+                # A rename keeps the mtime, so the task is touched first, or it would look expired once leased
+                os.utime(self._path("tasks", name))
+                os.rename(self._path("tasks", name), self._path("leased", name))
+                if os.path.exists(self._path("results", self._result_name(name))):
+                    # Finished by a worker whose lease had expired
+                    self.release(name)
+                    continue
+                with open(self._path("leased", name), "rb") as f:
+                    return name, pickle.load(f)
+            except FileNotFoundError:  # Another worker was faster, or the lease was taken back meanwhile
+                continue
+        return None
+
+    def heartbeat(self, name):
+        """ Renews the lease of a task. """
+        try:
+            os.utime(self._path("leased", name))
+        except FileNotFoundError:  # The lease expired and the task went back to the queue
+            pass
+
+    def release(self, name):
+        try:
+            os.remove(self._path("leased", name))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, name, records):
+        """ Writes the results of a leased task, and releases it. """
+        path = self._path("results", self._result_name(name))
+        pandas.DataFrame(records).to_csv(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+        self.release(name)
+
+    def requeue_expired(self):
+        """
+        Moves the tasks whose lease has expired back to the queue.
+
+        Returns:
+            Number of tasks moved back
+        """
+        now = time.time()
+        requeued = 0
+        for name in os.listdir(self._path("leased")):
+            try:
+                expired = now - os.path.getmtime(self._path("leased", name)) > self.lease_seconds
+                if not expired:
+                    continue
+                if os.path.exists(self._path("results", self._result_name(name))):
+                    self.release(name)
+                else:
+                    os.rename(self._path("leased", name), self._path("tasks", name))
+                    requeued += 1
+            except FileNotFoundError:  # Finished or requeued meanwhile
+                continue
+        return requeued
+
+    def status(self):
+        """
+        Returns:
+            dict with the number of ``waiting``, ``leased`` and ``done`` tasks. The counts are read one folder after
+            the other, so they are only indicative while tasks move
+        """
+        def count(folder, extension):
+            return sum(name.endswith(extension) for name in os.listdir(self._path(folder)))
+
+        return {"waiting": count("tasks", ".pkl"), "leased": count("leased", ".pkl"),
+                "done": count("results", ".csv")}
+
+    def missing_results(self):
+        """
+        Returns:
+            Names of the tasks of the stored sweep that have no result yet, or None if no sweep is stored
+        """
+        stored = self.stored_sweep()
+        if stored is None:
+            return None
+        results = set(os.listdir(self._path("results")))
+        return [self._task_name(i) for i in range(stored["tasks"])
+                if self._result_name(self._task_name(i)) not in results]
+
+    def finished(self):
+        """ Whether every task of the stored sweep has its result. """
+        return self.missing_results() == []
+
+    def merge(self, param_names):
+        """
+        Returns:
+            DataFrame with the results of all the tasks, sorted by run as run_sweep returns them
+        """
+        missing = self.missing_results()
+        if missing is None or missing:
+            raise ValueError("The sweep in {} is not finished, tasks without results: {}".format(self.directory,
+                                                                                               missing))
+        stored = self.stored_sweep()
+        # round_trip parsing, so the probabilities are exactly the ones the workers computed
+        shards = [pandas.read_csv(self._path("results", self._result_name(self._task_name(i))),
+                                  float_precision="round_trip") for i in range(stored["tasks"])]
+        return records_frame(pandas.concat(shards, ignore_index=True), param_names)
+
+
+def run_worker(directory, lease_seconds=300, poll=1.):
+    """
+    Runs tasks of the queue in ``directory`` until every task of the sweep has its result, waiting for the sweep
+    if it is not submitted yet. Expired leases of other workers are also moved back to the queue, so the sweep
+    finishes even if the coordinator stops.
+
+    Returns:
+        Number of tasks run by this worker
+    """
+    queue = WorkQueue(directory, lease_seconds)
+    done = 0
+    while True:
+        leased = queue.lease()
+        if leased is None:
+            if queue.requeue_expired():
+                continue
+            if queue.finished():
+                return done
+            time.sleep(poll)
+            continue
+        name, task = leased
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(lease_seconds / 3):
+                queue.heartbeat(name)
+
+        beating = threading.Thread(target=heartbeat, daemon=True)
+        beating.start()
+        try:
+            reports = run_chunk(task["model_cls"], task["chunk"], task["max_steps"], task["model_reporters"])
+        finally:
+            stop.set()
+            beating.join()
+        queue.complete(name, make_records(task["param_names"], task["chunk"], reports))
+        done += 1
+
+
+def run_distributed_sweep(directory, model_cls, variable_params, fixed_params, iterations, max_steps,
+                          model_reporters, seed=None, chunk_size=100, local_workers=0, lease_seconds=300, poll=1.,
+                          verbose=True):
+    """
+    Coordinator of a sweep run through the work queue in ``directory``. It queues the sweep in chunks of
+    ``chunk_size`` runs (or resumes the one already queued there), starts ``local_workers`` worker processes, moves
+    the tasks of dead workers back to the queue, and merges the results once every task is done. Workers on other
+    nodes join with ``python -m medical_diagnosis.workqueue <directory>``.
+
+    The arguments of the sweep are the same as in run_sweep, and the results are identical.
+
+    Returns:
+        DataFrame like the one run_sweep returns
+    """
+    queue = WorkQueue(directory, lease_seconds)
+    seed = resolve_root_seed(seed, queue)
+    param_names = list(variable_params.keys())
+    work = make_sweep_work(variable_params, fixed_params, iterations, seed)
+    tasks = [{"model_cls": model_cls, "chunk": work[i:i + chunk_size], "max_steps": max_steps,
+              "model_reporters": model_reporters, "param_names": param_names}
+             for i in range(0, len(work), chunk_size)]
+    queue.open_sweep({"seed": seed, "variable_params": {name: list(values) for name, values in
+                                                        variable_params.items()},
+                      "iterations": iterations, "max_steps": max_steps, "chunk_size": chunk_size,
+                      "fixed_params": {name: repr(value) for name, value in fixed_params.items()}}, tasks)
+
+    workers = [Process(target=run_worker, args=(directory, lease_seconds, poll), daemon=True)
+               for _ in range(local_workers)]
+    for worker in workers:
+        worker.start()
+    last_status = None
+    while not queue.finished():
+        queue.requeue_expired()
+        status = queue.status()
+        if verbose and status != last_status:
+            print("Queue: {waiting} waiting, {leased} leased, {done} done".format(**status))
+            last_status = status
+        time.sleep(poll)
+    for worker in workers:
+        worker.join()
+    return queue.merge(param_names)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Worker of a sweep distributed through a shared directory')
+    parser.add_argument('directory', type=str,
+                        help='Directory of the work queue, as given to the coordinator with --queue_dir.')
+    parser.add_argument('--lease_seconds', type=float, default=300,
+                        help='Seconds without heartbeat after which a task is given to another worker.')
+    parser.add_argument('--poll', type=float, default=1.,
+                        help='Seconds between checks of the queue when no task is waiting.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    print("Ran {} tasks".format(run_worker(args.directory, args.lease_seconds, args.poll)))